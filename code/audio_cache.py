@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import argparse
+import threading
+import numpy as np
+
+from result_cache import hash_file
+from utilities import float32_to_int16, int16_to_float32
+import config
+
+
+def get_audio_key(audio_path, sample_rate, res_type, dtype, file_hash=None):
+    """Key of a decoded audio file: the content hash of the source file and
+    every setting that affects the decoded signal.
+
+    Args:
+      audio_path: str
+      sample_rate: int
+      res_type: str
+      dtype: 'float32' | 'int16'
+      file_hash: str | None, hash_file() of audio_path if already computed, 
+        e.g. for the result cache key
+
+    Returns:
+      key: str
+    """
+    if file_hash is None:
+        file_hash = hash_file(audio_path)
+
+    settings_json = json.dumps({'sample_rate': sample_rate, 
+        'res_type': res_type, 'dtype': dtype, 'mono': True}, sort_keys=True)
+    return hashlib.sha256('{}:{}'.format(file_hash, 
+        settings_json).encode('utf-8')).hexdigest()
+
+
+class AudioCache(object):
+    def __init__(self, cache_dir, max_bytes=None, dtype='float32'):
+        """Persistent on-disk cache of decoded and resampled mono audio. Each
+        entry is a .npy file named by its key, which is loaded memory mapped, 
+        so a hit neither runs ffmpeg nor reads the signal before it is used.
+        The least recently used entries are evicted when the cache exceeds
+        max_bytes.
+
+        Args:
+          cache_dir: str
+          max_bytes: int | None, None for no cap
+          dtype: 'float32' | 'int16'. int16 halves the size of entries and
+            quantizes the signal to 16 bits.
+        """
+        if dtype not in ['float32', 'int16']:
+            raise ValueError('Unsupported dtype: {}'.format(dtype))
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.lock = threading.RLock()
+
+    def get_key(self, audio_path, sample_rate, res_type, file_hash=None):
+        return get_audio_key(audio_path, sample_rate, res_type, self.dtype, 
+            file_hash=file_hash)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, '{}.npy'.format(key))
+
+    def get(self, key):
+        """Look up decoded audio and mark it as recently used.
+
+        Args:
+          key: str, from get_key()
+
+        Returns:
+          audio: (audio_samples,) | None, read-only memory map if float32
+        """
+        path = self.get_path(key)
+
+        with self.lock:
+            if not os.path.isfile(path):
+                return None
+
+            os.utime(path)     # Recency for LRU eviction
+
+        audio = np.load(path, mmap_mode='r')
+
+        if audio.dtype == np.int16:
+            audio = int16_to_float32(audio)
+
+        return audio
+
+    def put(self, key, audio):
+        """Store decoded audio. The file is written under a temporary name and
+        renamed, so readers never see a partial entry.
+
+        Args:
+          key: str
+          audio: (audio_samples,)
+
+        Returns:
+          audio: (audio_samples,), the stored signal as get() returns it, so
+            that a miss and later hits transcribe the same samples
+        """
+        if self.dtype == 'int16':
+            stored = float32_to_int16(np.clip(audio, -1., 1.))
+        else:
+            stored = np.asarray(audio, dtype=np.float32)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = '{}.tmp-{}-{}.npy'.format(path, os.getpid(), 
+            threading.get_ident())
+
+        np.save(tmp_path, stored)
+
+        with self.lock:
+            os.replace(tmp_path, path)
+            self.evict(keep=key)
+
+        return self.get(key)
+
+    def get_entries(self):
+        """Entries as a list of (key, bytes, last used time), least recently
+        used first."""
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or '.tmp-' in name or \
+                not name.endswith('.npy'):
+                continue
+            entries.append((name[: -len('.npy')], os.path.getsize(path), 
+                os.path.getmtime(path)))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes.
+        Memory maps of removed entries stay valid until they are released.
+
+        Args:
+          keep: str | None, key that must not be removed
+        """
+        if self.max_bytes is None:
+            return
+
+        with self.lock:
+            entries = self.get_entries()
+            total_bytes = sum(entry[1] for entry in entries)
+
+            for (key, entry_bytes, _) in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if key != keep:
+                    try:
+                        os.remove(self.get_path(key))
+                    except FileNotFoundError:
+                        pass
+                    total_bytes -= entry_bytes
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            for (key, _, _) in self.get_entries():
+                os.remove(self.get_path(key))
+
+
+audio_cache = AudioCache(config.audio_cache_dir, 
+    max_bytes=config.audio_cache_max_bytes, dtype=config.audio_cache_dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    subparsers.add_parser('stats')
+    subparsers.add_parser('clear')
+
+    args = parser.parse_args()
+
+    if args.mode == 'stats':
+        entries = audio_cache.get_entries()
+        print('Cache: {}, {} entries, {:.1f} MB'.format(audio_cache.cache_dir, 
+            len(entries), sum(entry[1] for entry in entries) / 1e6))
+
+    elif args.mode == 'clear':
+        audio_cache.clear()
+        print('Cleared {}'.format(audio_cache.cache_dir))
+
+    else:
+        raise Exception('Incorrect argument!')
@@ -0,0 +1,976 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import mir_eval
+
+import torch
+
+from model_registry import load_model, get_scripted_path
+from pytorch_utils import forward
+from inference import PianoTranscription
+from utilities import (load_audio, read_midi, TargetProcessor, resample, 
+    get_audio_backend, RegressionPostProcessor, 
+    IncrementalRegressionPostProcessor, NoteEvents, PedalEvents, load_activations)
+import piano_vad
+import config
+
+
+def get_random_segments(segments_num, segment_seconds, seed=1234):
+    """Random noise segments. Runtime of the models does not depend on the
+    content of the audio."""
+    random_state = np.random.RandomState(seed)
+    segment_samples = int(config.sample_rate * segment_seconds)
+    segments = random_state.uniform(-0.1, 0.1, (segments_num, segment_samples))
+    return segments.astype(np.float32)
+
+
+def time_forward(model, segments, batch_size, repeats):
+    """Forward segments and measure throughput.
+
+    Returns:
+      output_dict: dict, outputs of the last repeat
+      segments_per_second: float, best of repeats
+    """
+    forward(model, segments[0 : batch_size], batch_size)    # Warm up
+    best_time = np.inf
+
+    for _ in range(repeats):
+        forward_time = time.time()
+        output_dict = forward(model, segments, batch_size)
+        best_time = min(best_time, time.time() - forward_time)
+
+    return output_dict, len(segments) / best_time
+
+
+def max_abs_diff(output_dict1, output_dict2):
+    return max(np.max(np.abs(output_dict1[key] - output_dict2[key]))
+        for key in output_dict1.keys())
+
+
+def benchmark_torchscript(args):
+    """Compare segments per second of the eager and the TorchScript model on
+    CPU. Export the TorchScript model with export_model.py first.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      scripted_path: str | None
+      segments_num: int
+      segment_seconds: float
+      batch_size: int
+      repeats: int
+      threads: int | None
+    """
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    scripted_path = args.scripted_path or get_scripted_path(
+        args.checkpoint_path, args.model_type)
+    segments = get_random_segments(args.segments_num, args.segment_seconds)
+
+    eager_model = load_model(args.model_type, args.checkpoint_path, 'cpu',
+        scripted=False)
+    scripted_model = torch.jit.load(scripted_path, map_location='cpu')
+
+    (eager_dict, eager_speed) = time_forward(eager_model, segments,
+        args.batch_size, args.repeats)
+    (scripted_dict, scripted_speed) = time_forward(scripted_model, segments,
+        args.batch_size, args.repeats)
+
+    print('Threads: {}, batch size: {}'.format(torch.get_num_threads(), args.batch_size))
+    print('Eager:       {:.3f} segments/s'.format(eager_speed))
+    print('TorchScript: {:.3f} segments/s'.format(scripted_speed))
+    print('Speed up: {:.2f}x'.format(scripted_speed / eager_speed))
+    print('Max abs diff: {:.2e}'.format(max_abs_diff(eager_dict, scripted_dict)))
+
+
+def benchmark_branches(args):
+    """Per-segment latency of the note model with its four acoustic branches
+    run one after another and concurrently. Segments are forwarded one at a 
+    time, as in live transcription. Run on a multi-core CPU; with fewer 
+    intra-op threads per branch the concurrent branches use the idle cores. 
+    The speed up has only been measured on a single core so far, where there 
+    is none, which is why parallel branches are opt-in.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      segments_num: int
+      segment_seconds: float
+      repeats: int
+      threads: int | None, intra-op threads
+    """
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = load_model(args.model_type, args.checkpoint_path, 'cpu', 
+        scripted=False)
+    segments = get_random_segments(args.segments_num, args.segment_seconds)
+    latencies = {}
+    output_dicts = {}
+
+    for parallel in [False, True]:
+        forward(model, segments[0 : 1], 1, parallel=parallel)   # Warm up
+        best_time = np.inf
+
+        for _ in range(args.repeats):
+            forward_time = time.time()
+            output_dicts[parallel] = forward(model, segments, 1, 
+                parallel=parallel)
+            best_time = min(best_time, time.time() - forward_time)
+
+        latencies[parallel] = best_time / len(segments)
+
+    print('CPUs: {}, intra-op threads: {}'.format(os.cpu_count(), 
+        torch.get_num_threads()))
+    print('Sequential branches: {:.1f} ms/segment'.format(latencies[False] * 1e3))
+    print('Parallel branches:   {:.1f} ms/segment'.format(latencies[True] * 1e3))
+    print('Speed up: {:.2f}x'.format(latencies[False] / latencies[True]))
+    print('Max abs diff: {:.2e}'.format(max_abs_diff(output_dicts[False], 
+        output_dicts[True])))
+
+
+def get_rss():
+    """Resident memory of this process in bytes: total, private (anonymous) 
+    and file backed, which is shared with other processes mapping the file."""
+    rss = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS', 'RssAnon', 'RssFile')):
+                (key, value) = line.split(':')
+                rss[key] = int(value.split()[0]) * 1024
+    return rss
+
+
+def benchmark_load(args):
+    """Load the model in this process, forward one second of audio so that 
+    every weight is read, and print timings and RSS as JSON. Run by 
+    benchmark_startup() in fresh processes."""
+    rss_bgn = get_rss()
+
+    load_time = time.time()
+    model = load_model(args.model_type, args.checkpoint_path, 'cpu', 
+        scripted=False, mmap=args.mmap)
+    load_time = time.time() - load_time
+
+    forward_time = time.time()
+    forward(model, np.zeros((1, config.sample_rate), dtype=np.float32), 1)
+    forward_time = time.time() - forward_time
+
+    rss_fin = get_rss()
+    print(json.dumps({'load_time': load_time, 'forward_time': forward_time, 
+        'rss': {key: rss_fin[key] - rss_bgn[key] for key in rss_fin.keys()}}))
+
+
+def benchmark_startup(args):
+    """Start up time and memory of worker processes loading the pickled 
+    checkpoint and the memory-mapped weights. processes workers start at once,
+    as on a host serving several transcriptions. Convert the checkpoint with 
+    export_model.py safetensors first. Run once before measuring to compare 
+    with a warm page cache.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      processes: int
+    """
+    for mmap in [False, True]:
+        command = [sys.executable, os.path.abspath(__file__), 'load', 
+            '--model_type', args.model_type, '--checkpoint_path', 
+            args.checkpoint_path] + (['--mmap'] if mmap else [])
+
+        start_time = time.time()
+        workers = [subprocess.Popen(command, stdout=subprocess.PIPE, 
+            stderr=subprocess.DEVNULL) for _ in range(args.processes)]
+        results = []
+
+        for worker in workers:
+            (stdout, _) = worker.communicate()
+            results.append(json.loads(stdout.decode().strip().split('\n')[-1]))
+
+        print('{} x {}:'.format(args.processes, 
+            'memory-mapped weights' if mmap else 'pickled checkpoint'))
+        print('  Wall time of all processes: {:.3f} s'.format(time.time() - start_time))
+        print('  Load time: {:.3f} s, first forward: {:.3f} s'.format(
+            np.mean([result['load_time'] for result in results]), 
+            np.mean([result['forward_time'] for result in results])))
+        print('  RSS per process: {:.1f} MB, private {:.1f} MB, file backed {:.1f} MB'.format(
+            *[np.mean([result['rss'][key] for result in results]) / 1e6 
+            for key in ['VmRSS', 'RssAnon', 'RssFile']]))
+
+
+# Modules that the transcription entry point must not import
+TRAINING_ONLY_MODULES = ['matplotlib', 'h5py', 'pandas', 'sklearn', 'mir_eval', 
+    'mido', 'librosa', 'torchlibrosa', 'soundfile']
+
+
+def benchmark_imports(args):
+    """Import time of the transcription entry point in fresh interpreters, 
+    best of repeats. Exits with an error if it exceeds max_seconds or if a 
+    module in TRAINING_ONLY_MODULES is imported. Exported TorchScript or ONNX 
+    models are served without importing models.py and its frontend.
+
+    Args:
+      module: str, e.g. 'inference'
+      repeats: int
+      max_seconds: float
+    """
+    code = ('import sys, time; bgn = time.time(); import {}; '
+        'print(time.time() - bgn); print(",".join(sys.modules))').format(args.module)
+    import_times = []
+
+    for _ in range(args.repeats):
+        output = subprocess.check_output([sys.executable, '-c', code], 
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        (import_time, modules) = output.decode().strip().split('\n')[-2 :]
+        import_times.append(float(import_time))
+
+    imported = sorted(set(module.split('.')[0] for module in modules.split(',')) 
+        & set(TRAINING_ONLY_MODULES))
+
+    print('Import time of {}: {:.3f} s (best of {})'.format(args.module, 
+        min(import_times), args.repeats))
+    print('Training only modules imported: {}'.format(imported or 'none'))
+
+    if imported:
+        raise Exception('{} imports {}'.format(args.module, ', '.join(imported)))
+
+    if min(import_times) > args.max_seconds:
+        raise Exception('Import time {:.3f} s exceeds {} s'.format(
+            min(import_times), args.max_seconds))
+
+
+def get_audio(audio_path, seconds, seed=1234):
+    """Load audio_path, or random noise if it is None."""
+    if audio_path:
+        (audio, _) = load_audio(audio_path, sr=config.sample_rate, mono=True)
+    else:
+        random_state = np.random.RandomState(seed)
+        audio = random_state.uniform(-0.1, 0.1, int(config.sample_rate * seconds))
+    return audio.astype(np.float32)
+
+
+def benchmark_onnx(args):
+    """Parity and speed of the onnxruntime backend against PyTorch. Both 
+    backends transcribe the same audio and every key of the deframed 
+    output_dict is compared. Exits with an error if any difference exceeds 
+    atol. Export the ONNX model with export_model.py onnx first.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      audio_path: str | None, random noise of audio_seconds if None
+      audio_seconds: float
+      atol: float
+    """
+    audio = get_audio(args.audio_path, args.audio_seconds)
+    transcribed_dicts = {}
+
+    for backend in ['torch', 'onnxruntime']:
+        transcriptor = PianoTranscription(args.model_type, device='cpu', 
+            checkpoint_path=args.checkpoint_path, backend=backend)
+
+        transcribe_time = time.time()
+        transcribed_dicts[backend] = transcriptor.transcribe(audio, midi_path=None)
+        print('{}: transcribe time {:.3f} s'.format(backend, 
+            time.time() - transcribe_time))
+
+    # Post processing adds thresholded outputs to output_dict, only compare 
+    # the outputs of the model
+    model_keys = transcriptor.get_skipped_output().keys()
+    torch_dict = transcribed_dicts['torch']['output_dict']
+    onnx_dict = transcribed_dicts['onnxruntime']['output_dict']
+    max_diff = 0.
+
+    for key in model_keys:
+        diff = np.max(np.abs(torch_dict[key] - onnx_dict[key]))
+        max_diff = max(max_diff, diff)
+        print('{}: max abs diff {:.2e}'.format(key, diff))
+
+    print('Notes: {} (torch), {} (onnxruntime)'.format(
+        len(transcribed_dicts['torch']['est_note_events']), 
+        len(transcribed_dicts['onnxruntime']['est_note_events'])))
+
+    if max_diff > args.atol:
+        raise Exception('onnxruntime outputs differ from PyTorch by {:.2e}'.format(max_diff))
+
+
+def read_note_events(midi_path, duration):
+    """Ground truth note events of a MAESTRO style MIDI file."""
+    midi_dict = read_midi(midi_path)
+    target_processor = TargetProcessor(segment_seconds=duration, 
+        frames_per_second=config.frames_per_second, 
+        begin_note=config.begin_note, classes_num=config.classes_num)
+
+    (_, note_events, _) = target_processor.process(start_time=0, 
+        midi_events_time=midi_dict['midi_event_time'], 
+        midi_events=midi_dict['midi_event'])
+
+    return note_events
+
+
+def get_onset_f1(ref_note_events, est_note_events):
+    """Note onset F1 with the 50 ms tolerance of mir_eval, offsets ignored."""
+    def _to_arrays(note_events):
+        intervals = np.array([[e['onset_time'], e['offset_time']] 
+            for e in note_events]).reshape(-1, 2)
+        # mir_eval rejects notes of zero duration
+        intervals[:, 1] = np.maximum(intervals[:, 1], 
+            intervals[:, 0] + 1. / config.frames_per_second)
+        pitches = np.array([440. * 2 ** ((e['midi_note'] - 69) / 12) 
+            for e in note_events])
+        return intervals, pitches
+
+    (ref_intervals, ref_pitches) = _to_arrays(ref_note_events)
+    (est_intervals, est_pitches) = _to_arrays(est_note_events)
+
+    (_, _, f1, _) = mir_eval.transcription.precision_recall_f1_overlap(
+        ref_intervals, ref_pitches, est_intervals, est_pitches, 
+        offset_ratio=None)
+
+    return f1
+
+
+def benchmark_trunk(args):
+    """Transcription time with the convolutional trunk run once per 
+    overlapping segment and once per frame (shared_trunk). With 50% overlap 
+    the shared trunk computes the frontend and convolutions of each frame once
+    instead of twice. Also reports the largest difference of the model 
+    outputs, which comes from segment edges.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      audio_path: str | None, random noise of audio_seconds if None
+      audio_seconds: float
+      batch_size: int
+    """
+    audio = get_audio(args.audio_path, args.audio_seconds)
+    audio_seconds = len(audio) / config.sample_rate
+    transcribed_dicts = {}
+
+    for shared_trunk in [False, True]:
+        transcriptor = PianoTranscription(args.model_type, device='cpu', 
+            checkpoint_path=args.checkpoint_path, batch_size=args.batch_size, 
+            shared_trunk=shared_trunk)
+
+        transcribe_time = time.time()
+        transcribed_dicts[shared_trunk] = transcriptor.transcribe(audio, 
+            midi_path=None)
+        transcribe_time = time.time() - transcribe_time
+
+        print('Shared trunk: {}, {:.3f} s per audio second'.format(shared_trunk, 
+            transcribe_time / audio_seconds))
+
+    model_keys = transcriptor.get_skipped_output().keys()
+    print('Max abs diff: {:.2e}'.format(max(np.max(np.abs(
+        transcribed_dicts[False]['output_dict'][key] - 
+        transcribed_dicts[True]['output_dict'][key])) for key in model_keys)))
+
+
+def benchmark_int8(args):
+    """Speed and accuracy of int8 dynamic quantization against fp32 on CPU. 
+    Reports segments per second of both models and the onset F1 of both 
+    transcriptions, against the ground truth in midi_path if given, or 
+    against the fp32 transcription otherwise. Exits with an error if int8 
+    loses more than max_f1_drop onset F1.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      audio_path: str | None, random noise of audio_seconds if None
+      midi_path: str | None
+      audio_seconds: float
+      segments_num: int
+      batch_size: int
+      repeats: int
+      max_f1_drop: float
+    """
+    audio = get_audio(args.audio_path, args.audio_seconds)
+    segments = get_random_segments(args.segments_num, 10.)
+    note_events = {}
+
+    for precision in ['fp32', 'int8']:
+        transcriptor = PianoTranscription(args.model_type, device='cpu', 
+            checkpoint_path=args.checkpoint_path, precision=precision)
+
+        (_, speed) = time_forward(transcriptor.model, segments, 
+            args.batch_size, args.repeats)
+        print('{}: {:.3f} segments/s'.format(precision, speed))
+
+        note_events[precision] = transcriptor.transcribe(audio, 
+            midi_path=None)['est_note_events']
+
+    if args.midi_path:
+        ref_note_events = read_note_events(args.midi_path, 
+            len(audio) / config.sample_rate)
+    else:
+        ref_note_events = note_events['fp32']
+
+    fp32_f1 = get_onset_f1(ref_note_events, note_events['fp32'])
+    int8_f1 = get_onset_f1(ref_note_events, note_events['int8'])
+
+    print('Reference: {}'.format(args.midi_path or 'fp32 transcription'))
+    print('Onset F1: {:.4f} (fp32), {:.4f} (int8), delta {:+.4f}'.format(
+        fp32_f1, int8_f1, int8_f1 - fp32_f1))
+
+    if fp32_f1 - int8_f1 > args.max_f1_drop:
+        raise Exception('int8 onset F1 drop {:.4f} exceeds {}'.format(
+            fp32_f1 - int8_f1, args.max_f1_drop))
+
+
+def benchmark_resample(args):
+    """Speed of the resamplers of load_audio() and their effect on the 
+    transcription. The audio is decoded once at its native sample rate and 
+    resampled to config.sample_rate with each res_type. Reports the real-time 
+    factor of resampling, i.e. resampling time over audio duration, and the 
+    onset F1 of each transcription against the ground truth in midi_path if 
+    given, or against the transcription of the first res_type otherwise.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      audio_path: str | None, random noise of audio_seconds at orig_sr if None
+      midi_path: str | None
+      orig_sr: int, sample rate of the random noise
+      audio_seconds: float
+      res_types: list of str
+      repeats: int
+    """
+    if args.audio_path:
+        (audio, orig_sr) = load_audio(args.audio_path, sr=None, mono=True)
+    else:
+        orig_sr = args.orig_sr
+        random_state = np.random.RandomState(1234)
+        audio = random_state.uniform(-0.1, 0.1, int(orig_sr * args.audio_seconds))
+        audio = audio.astype(np.float32)
+
+    audio_seconds = len(audio) / orig_sr
+    print('Audio: {:.1f} s at {} Hz'.format(audio_seconds, orig_sr))
+
+    if args.midi_path:
+        ref_note_events = read_note_events(args.midi_path, audio_seconds)
+    else:
+        ref_note_events = None
+
+    transcriptor = PianoTranscription(args.model_type, device='cpu', 
+        checkpoint_path=args.checkpoint_path)
+
+    for res_type in args.res_types:
+        best_time = np.inf
+
+        for _ in range(args.repeats):
+            resample_time = time.time()
+            resampled = resample(audio, orig_sr, config.sample_rate, 
+                res_type=res_type).astype(np.float32)
+            best_time = min(best_time, time.time() - resample_time)
+
+        note_events = transcriptor.transcribe(resampled, 
+            midi_path=None)['est_note_events']
+
+        if ref_note_events is None:
+            ref_note_events = note_events
+
+        print('{}: real-time factor {:.4f}, onset F1 {:.4f}'.format(res_type, 
+            best_time / audio_seconds, get_onset_f1(ref_note_events, note_events)))
+
+    print('Reference: {}'.format(args.midi_path or 
+        '{} transcription'.format(args.res_types[0])))
+
+
+def benchmark_decode(args):
+    """Decoding throughput of load_audio() per format, with the automatically
+    selected backend and with ffmpeg. Test files of random noise are written 
+    with soundfile for each format; compressed files, e.g. MP3, can be added 
+    with audio_paths. Throughput is seconds of audio decoded per second, best 
+    of repeats. Resampling is excluded unless sr is given.
+
+    Args:
+      audio_seconds: float
+      orig_sr: int
+      channels: int
+      audio_paths: list of str, additional files
+      sr: int | None, target sample rate of load_audio()
+      res_type: str
+      repeats: int
+    """
+    import audioread
+    import soundfile
+
+    formats = [('wav_pcm16', 'WAV', 'PCM_16'), ('wav_float', 'WAV', 'FLOAT'), 
+        ('wav_pcm24', 'WAV', 'PCM_24'), ('flac', 'FLAC', 'PCM_16')]
+
+    random_state = np.random.RandomState(1234)
+    audio = random_state.uniform(-0.5, 0.5, 
+        (int(args.orig_sr * args.audio_seconds), args.channels))
+
+    def _time_load(audio_path, backends):
+        best_time = np.inf
+        for _ in range(args.repeats):
+            load_time = time.time()
+            (y, _) = load_audio(audio_path, sr=args.sr, mono=True, 
+                res_type=args.res_type, backends=backends)
+            best_time = min(best_time, time.time() - load_time)
+        return best_time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_paths = []
+        for (name, format, subtype) in formats:
+            audio_path = os.path.join(tmp_dir, '{}.{}'.format(name, 
+                format.lower()))
+            soundfile.write(audio_path, audio, args.orig_sr, format=format, 
+                subtype=subtype)
+            audio_paths.append(audio_path)
+
+        for audio_path in audio_paths + args.audio_paths:
+            if get_audio_backend(audio_path) == 'soundfile':
+                audio_seconds = soundfile.info(audio_path).duration
+            else:
+                (y, file_sr) = load_audio(audio_path, sr=None)
+                audio_seconds = y.shape[-1] / file_sr
+            results = []
+
+            for (backend, backends) in [('auto', None), 
+                ('ffmpeg', [audioread.ffdec.FFmpegAudioFile])]:
+                try:
+                    speed = audio_seconds / _time_load(audio_path, backends)
+                    results.append('{} {:.1f}x'.format(backend, speed))
+                except Exception as e:
+                    results.append('{} n/a ({})'.format(backend, type(e).__name__))
+
+            print('{} ({}): {}'.format(os.path.basename(audio_path), 
+                get_audio_backend(audio_path), ', '.join(results)))
+
+
+def get_random_activations(frames_num, classes_num, seed=1234):
+    """Smooth random regression outputs in [0, 1] with peaks, plateaus of 
+    equal values and a few NaNs, which exercise every branch of the peak 
+    picking."""
+    random_state = np.random.RandomState(seed)
+    x = random_state.uniform(0, 1, (frames_num + 8, classes_num)) ** 8
+    x = sum(x[i : frames_num + i] for i in range(8)) / 2
+    x = np.round(np.clip(x, 0, 1), 2).astype(np.float32)
+    x[random_state.uniform(0, 1, x.shape) < 1e-4] = np.nan
+    return x
+
+
+def benchmark_post_processing(args):
+    """Parity and speed of the vectorized peak picking of 
+    RegressionPostProcessor against the frame by frame loop. Both are run on 
+    random activations and on the onset, offset and pedal offset outputs 
+    saved by inference.py --save_activations if activations_path is given. 
+    Exits with an error unless the outputs are identical.
+
+    Args:
+      activations_path: str | None
+      frames_num: int, frames of the random activations
+      repeats: int
+    """
+    post_processor = RegressionPostProcessor(config.frames_per_second, 
+        classes_num=config.classes_num, onset_threshold=0.3, 
+        offset_threshold=0.3, frame_threshold=0.1, pedal_offset_threshold=0.2)
+
+    # (name, reg_output, threshold, neighbour) as in output_dict_to_midi_events()
+    inputs = [
+        ('random onset', get_random_activations(args.frames_num, 
+            config.classes_num), 0.3, 2), 
+        ('random offset', get_random_activations(args.frames_num, 
+            config.classes_num, seed=5678), 0.3, 4), 
+        ('random pedal offset', get_random_activations(args.frames_num, 1), 0.2, 4)]
+
+    if args.activations_path:
+        output_dict = load_activations(args.activations_path)
+        inputs += [('reg_onset_output', output_dict['reg_onset_output'], 0.3, 2), 
+            ('reg_offset_output', output_dict['reg_offset_output'], 0.3, 4)]
+        if 'reg_pedal_offset_output' in output_dict.keys():
+            inputs.append(('reg_pedal_offset_output', 
+                output_dict['reg_pedal_offset_output'], 0.2, 4))
+
+    for (name, reg_output, threshold, neighbour) in inputs:
+        outputs = {}
+        times = {}
+
+        for (method, func) in [
+            ('loop', post_processor.get_binarized_output_from_regression_loop), 
+            ('vectorized', post_processor.get_binarized_output_from_regression)]:
+
+            times[method] = np.inf
+            for _ in range(args.repeats):
+                post_process_time = time.time()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    outputs[method] = func(reg_output, threshold, neighbour)
+                times[method] = min(times[method], time.time() - post_process_time)
+
+        identical = all(np.array_equal(a, b, equal_nan=True) 
+            for (a, b) in zip(outputs['loop'], outputs['vectorized']))
+
+        print('{} {}: loop {:.3f} s, vectorized {:.4f} s, {:.0f}x, peaks {}, '
+            'identical: {}'.format(name, reg_output.shape, times['loop'], 
+            times['vectorized'], times['loop'] / times['vectorized'], 
+            int(np.sum(outputs['vectorized'][0])), identical))
+
+        if not identical:
+            raise Exception('Vectorized peak picking differs on {}'.format(name))
+
+
+def benchmark_detection(args):
+    """Parity and speed of the compiled note and pedal detection of piano_vad 
+    against the frame by frame Python versions, which run key by key. Inputs
+    are binarized random activations, or the outputs saved by inference.py 
+    --save_activations if activations_path is given. The first call, which 
+    compiles the functions or loads them from the numba cache, is timed 
+    separately. Exits with an error unless the outputs are identical.
+
+    Args:
+      activations_path: str | None
+      frames_num: int, frames of the random activations
+    """
+    post_processor = RegressionPostProcessor(config.frames_per_second, 
+        classes_num=config.classes_num, onset_threshold=0.3, 
+        offset_threshold=0.3, frame_threshold=0.1, pedal_offset_threshold=0.2)
+
+    if args.activations_path:
+        output_dict = load_activations(args.activations_path)
+    else:
+        random_state = np.random.RandomState(1234)
+        shape = (args.frames_num, config.classes_num)
+
+        # Frame outputs are rounded to 0.01 like get_random_activations(), so 
+        # that some frames equal the frame thresholds of 0.1 and 0.5
+        output_dict = {
+            'reg_onset_output': get_random_activations(*shape, seed=1), 
+            'reg_offset_output': get_random_activations(*shape, seed=2), 
+            'frame_output': np.round(random_state.uniform(0, 1, shape) ** 0.3, 
+                2).astype(np.float32), 
+            'velocity_output': random_state.uniform(0, 1, shape).astype(np.float32), 
+            'pedal_frame_output': get_random_activations(args.frames_num, 1, seed=3), 
+            'reg_pedal_offset_output': get_random_activations(args.frames_num, 1, seed=4)}
+
+    # Binarized onsets, offsets and their shifts
+    post_processor.output_dict_to_note_pedal_arrays(output_dict)
+    inputs = [output_dict[key] for key in ['frame_output', 'onset_output', 
+        'onset_shift_output', 'offset_output', 'offset_shift_output', 
+        'velocity_output']]
+    pedal_inputs = [output_dict[key][:, 0] for key in ['pedal_frame_output', 
+        'pedal_offset_output', 'pedal_offset_shift_output']]
+
+    # Frame by frame Python, key by key
+    python_time = time.time()
+    python_tuples = []
+    python_keys = []
+    for k in range(config.classes_num):
+        tuples = piano_vad.note_detection_with_onset_offset_regress(
+            *[x[:, k] for x in inputs], frame_threshold=0.1)
+        python_tuples += tuples
+        python_keys += [k] * len(tuples)
+    python_time = time.time() - python_time
+
+    python_pedal_time = time.time()
+    python_pedal_tuples = piano_vad.pedal_detection_with_onset_offset_regress(
+        *pedal_inputs, frame_threshold=0.5)
+    python_pedal_time = time.time() - python_pedal_time
+
+    # Compiled, all keys in one pass
+    compile_time = time.time()
+    piano_vad.note_detection_with_onset_offset_regress_all_keys(
+        *[x[0 : 10] for x in inputs], frame_threshold=0.1)
+    piano_vad.pedal_detection_with_onset_offset_regress_compiled(
+        *[x[0 : 10] for x in pedal_inputs], frame_threshold=0.5)
+    compile_time = time.time() - compile_time
+
+    compiled_time = time.time()
+    (compiled_tuples, compiled_keys) = \
+        piano_vad.note_detection_with_onset_offset_regress_all_keys(
+        *inputs, frame_threshold=0.1)
+    compiled_time = time.time() - compiled_time
+
+    compiled_pedal_time = time.time()
+    compiled_pedal_tuples = \
+        piano_vad.pedal_detection_with_onset_offset_regress_compiled(
+        *pedal_inputs, frame_threshold=0.5)
+    compiled_pedal_time = time.time() - compiled_pedal_time
+
+    identical = np.array_equal(np.array(python_tuples).reshape(-1, 5), 
+        compiled_tuples, equal_nan=True) and \
+        np.array_equal(np.array(python_keys, dtype=np.int64), compiled_keys)
+    pedal_identical = np.array_equal(
+        np.array(python_pedal_tuples).reshape(-1, 4), 
+        np.array(compiled_pedal_tuples).reshape(-1, 4), equal_nan=True)
+
+    print('Frames: {}, first call (compile or load): {:.3f} s'.format(
+        len(inputs[0]), compile_time))
+    print('Notes: python {:.3f} s, compiled {:.4f} s, {:.0f}x, notes {}, '
+        'identical: {}'.format(python_time, compiled_time, 
+        python_time / compiled_time, len(compiled_tuples), identical))
+    print('Pedals: python {:.4f} s, compiled {:.4f} s, pedals {}, '
+        'identical: {}'.format(python_pedal_time, compiled_pedal_time, 
+        len(compiled_pedal_tuples), pedal_identical))
+
+    if not (identical and pedal_identical):
+        raise Exception('Compiled detection differs from the Python version')
+
+
+def get_sorted_events(events, keys):
+    """Events as an array of rows sorted by their values, to compare event 
+    lists regardless of their order.
+
+    Args:
+      events: NoteEvents | PedalEvents
+      keys: list of str, e.g. ['onset_time', 'offset_time']
+
+    Returns:
+      array: (events_num, len(keys))
+    """
+    array = np.stack([getattr(events, key).astype(np.float64) for key in keys], 
+        axis=-1)
+    return array[np.lexsort(array.T[::-1])]
+
+
+def benchmark_incremental(args):
+    """Parity and speed of IncrementalRegressionPostProcessor, fed blocks of
+    random sizes, against RegressionPostProcessor on the whole recording. 
+    Inputs are random activations, or the outputs saved by inference.py 
+    --save_activations if activations_path is given. Also reports the latency 
+    of notes, the frames between the end of a note and the end of the block 
+    that emits it. Exits with an error unless the events are identical.
+
+    Args:
+      activations_path: str | None
+      frames_num: int, frames of the random activations
+      max_block_frames: int, blocks have 1 to max_block_frames frames
+    """
+    kwargs = {'frames_per_second': config.frames_per_second, 
+        'classes_num': config.classes_num, 'onset_threshold': 0.3, 
+        'offset_threshold': 0.3, 'frame_threshold': 0.1, 
+        'pedal_offset_threshold': 0.2}
+
+    post_processor = RegressionPostProcessor(**kwargs)
+    incremental_post_processor = IncrementalRegressionPostProcessor(**kwargs)
+
+    if args.activations_path:
+        output_dict = load_activations(args.activations_path)
+    else:
+        random_state = np.random.RandomState(1234)
+        shape = (args.frames_num, config.classes_num)
+        output_dict = {
+            'reg_onset_output': get_random_activations(*shape, seed=1), 
+            'reg_offset_output': get_random_activations(*shape, seed=2), 
+            'frame_output': random_state.uniform(0, 1, shape).astype(np.float32) ** 0.3, 
+            'velocity_output': random_state.uniform(0, 1, shape).astype(np.float32), 
+            'reg_pedal_onset_output': get_random_activations(args.frames_num, 1, seed=3), 
+            'pedal_frame_output': get_random_activations(args.frames_num, 1, seed=4), 
+            'reg_pedal_offset_output': get_random_activations(args.frames_num, 1, seed=5)}
+
+    output_dict = {key: output_dict[key] for key in output_dict.keys() if 
+        key in ['reg_onset_output', 'reg_offset_output', 'frame_output', 
+        'velocity_output', 'reg_pedal_onset_output', 'pedal_frame_output', 
+        'reg_pedal_offset_output']}
+    frames_num = len(output_dict['frame_output'])
+
+    # Warm up the compiled detection
+    post_processor.output_dict_to_midi_events(
+        {key: output_dict[key][0 : 100] for key in output_dict.keys()})
+
+    batch_time = time.time()
+    (batch_note_events, batch_pedal_events) = \
+        post_processor.output_dict_to_midi_events(
+        {key: output_dict[key] for key in output_dict.keys()})
+    batch_time = time.time() - batch_time
+
+    random_state = np.random.RandomState(args.seed)
+    note_events_list = []
+    pedal_events_list = []
+    latencies = []
+    bgn = 0
+
+    incremental_time = time.time()
+    while bgn < frames_num:
+        fin = min(bgn + random_state.randint(1, args.max_block_frames + 1), 
+            frames_num)
+        (block_note_events, block_pedal_events) = \
+            incremental_post_processor.process(
+            {key: output_dict[key][bgn : fin] for key in output_dict.keys()})
+
+        note_events_list.append(block_note_events)
+        pedal_events_list.append(block_pedal_events)
+        latencies.append(fin - block_note_events.offset_time * 
+            config.frames_per_second)
+        bgn = fin
+
+    (block_note_events, block_pedal_events) = incremental_post_processor.flush()
+    note_events_list.append(block_note_events)
+    pedal_events_list.append(block_pedal_events)
+    note_events = NoteEvents.concatenate(note_events_list)
+    pedal_events = PedalEvents.concatenate(pedal_events_list)
+    latencies = np.concatenate(latencies)
+    incremental_time = time.time() - incremental_time
+
+    note_keys = ['midi_note', 'onset_time', 'offset_time', 'velocity']
+    pedal_keys = ['onset_time', 'offset_time']
+    identical = np.array_equal(get_sorted_events(note_events, note_keys), 
+        get_sorted_events(batch_note_events, note_keys), equal_nan=True)
+    pedal_identical = np.array_equal(get_sorted_events(pedal_events, pedal_keys), 
+        get_sorted_events(PedalEvents.from_dicts(batch_pedal_events), pedal_keys), 
+        equal_nan=True)
+
+    print('Frames: {}, blocks of 1 to {} frames'.format(frames_num, 
+        args.max_block_frames))
+    print('Batch: {:.3f} s, incremental: {:.3f} s'.format(batch_time, 
+        incremental_time))
+    print('Notes: {}, identical: {}, pedals: {}, identical: {}'.format(
+        len(note_events), identical, len(pedal_events), pedal_identical))
+
+    if len(latencies) > 0:
+        print('Note latency after offset: median {:.1f} frames, max {:.1f} '
+            'frames'.format(np.nanmedian(latencies), np.nanmax(latencies)))
+
+    if not (identical and pedal_identical):
+        raise Exception('Incremental post processing differs from batch')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    parser_torchscript = subparsers.add_parser('torchscript')
+    parser_torchscript.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_torchscript.add_argument('--checkpoint_path', type=str, required=True)
+    parser_torchscript.add_argument('--scripted_path', type=str, default=None)
+    parser_torchscript.add_argument('--segments_num', type=int, default=8)
+    parser_torchscript.add_argument('--segment_seconds', type=float, default=10.)
+    parser_torchscript.add_argument('--batch_size', type=int, default=1)
+    parser_torchscript.add_argument('--repeats', type=int, default=3)
+    parser_torchscript.add_argument('--threads', type=int, default=None)
+
+    parser_onnx = subparsers.add_parser('onnx')
+    parser_onnx.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_onnx.add_argument('--checkpoint_path', type=str, required=True)
+    parser_onnx.add_argument('--audio_path', type=str, default=None)
+    parser_onnx.add_argument('--audio_seconds', type=float, default=30.)
+    parser_onnx.add_argument('--atol', type=float, default=1e-4)
+
+    parser_branches = subparsers.add_parser('branches')
+    parser_branches.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_branches.add_argument('--checkpoint_path', type=str, required=True)
+    parser_branches.add_argument('--segments_num', type=int, default=4)
+    parser_branches.add_argument('--segment_seconds', type=float, default=10.)
+    parser_branches.add_argument('--repeats', type=int, default=3)
+    parser_branches.add_argument('--threads', type=int, default=None)
+
+    parser_trunk = subparsers.add_parser('trunk')
+    parser_trunk.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_trunk.add_argument('--checkpoint_path', type=str, required=True)
+    parser_trunk.add_argument('--audio_path', type=str, default=None)
+    parser_trunk.add_argument('--audio_seconds', type=float, default=60.)
+    parser_trunk.add_argument('--batch_size', type=int, default=4)
+
+    parser_startup = subparsers.add_parser('startup')
+    parser_startup.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_startup.add_argument('--checkpoint_path', type=str, required=True)
+    parser_startup.add_argument('--processes', type=int, default=4)
+
+    parser_load = subparsers.add_parser('load')
+    parser_load.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_load.add_argument('--checkpoint_path', type=str, required=True)
+    parser_load.add_argument('--mmap', action='store_true', default=False)
+
+    parser_imports = subparsers.add_parser('imports')
+    parser_imports.add_argument('--module', type=str, default='inference')
+    parser_imports.add_argument('--repeats', type=int, default=5)
+    parser_imports.add_argument('--max_seconds', type=float, default=3.)
+
+    parser_int8 = subparsers.add_parser('int8')
+    parser_int8.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_int8.add_argument('--checkpoint_path', type=str, required=True)
+    parser_int8.add_argument('--audio_path', type=str, default=None)
+    parser_int8.add_argument('--midi_path', type=str, default=None)
+    parser_int8.add_argument('--audio_seconds', type=float, default=30.)
+    parser_int8.add_argument('--segments_num', type=int, default=4)
+    parser_int8.add_argument('--batch_size', type=int, default=1)
+    parser_int8.add_argument('--repeats', type=int, default=3)
+    parser_int8.add_argument('--max_f1_drop', type=float, default=0.01)
+
+    parser_resample = subparsers.add_parser('resample')
+    parser_resample.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_resample.add_argument('--checkpoint_path', type=str, required=True)
+    parser_resample.add_argument('--audio_path', type=str, default=None)
+    parser_resample.add_argument('--midi_path', type=str, default=None)
+    parser_resample.add_argument('--orig_sr', type=int, default=44100)
+    parser_resample.add_argument('--audio_seconds', type=float, default=30.)
+    parser_resample.add_argument('--res_types', type=str, nargs='+', 
+        default=['kaiser_best', 'kaiser_fast', 'polyphase'])
+    parser_resample.add_argument('--repeats', type=int, default=3)
+
+    parser_decode = subparsers.add_parser('decode')
+    parser_decode.add_argument('--audio_seconds', type=float, default=60.)
+    parser_decode.add_argument('--orig_sr', type=int, default=44100)
+    parser_decode.add_argument('--channels', type=int, default=2)
+    parser_decode.add_argument('--audio_paths', type=str, nargs='*', default=[])
+    parser_decode.add_argument('--sr', type=int, default=None)
+    parser_decode.add_argument('--res_type', type=str, default='polyphase')
+    parser_decode.add_argument('--repeats', type=int, default=3)
+
+    parser_post_processing = subparsers.add_parser('post_processing')
+    parser_post_processing.add_argument('--activations_path', type=str, default=None)
+    parser_post_processing.add_argument('--frames_num', type=int, default=30000)
+    parser_post_processing.add_argument('--repeats', type=int, default=1)
+
+    parser_detection = subparsers.add_parser('detection')
+    parser_detection.add_argument('--activations_path', type=str, default=None)
+    parser_detection.add_argument('--frames_num', type=int, default=60000)
+
+    parser_incremental = subparsers.add_parser('incremental')
+    parser_incremental.add_argument('--activations_path', type=str, default=None)
+    parser_incremental.add_argument('--frames_num', type=int, default=30000)
+    parser_incremental.add_argument('--max_block_frames', type=int, default=500)
+    parser_incremental.add_argument('--seed', type=int, default=1234)
+
+    args = parser.parse_args()
+
+    if args.mode == 'torchscript':
+        benchmark_torchscript(args)
+
+    elif args.mode == 'onnx':
+        benchmark_onnx(args)
+
+    elif args.mode == 'branches':
+        benchmark_branches(args)
+
+    elif args.mode == 'trunk':
+        benchmark_trunk(args)
+
+    elif args.mode == 'startup':
+        benchmark_startup(args)
+
+    elif args.mode == 'load':
+        benchmark_load(args)
+
+    elif args.mode == 'imports':
+        benchmark_imports(args)
+
+    elif args.mode == 'int8':
+        benchmark_int8(args)
+
+    elif args.mode == 'resample':
+        benchmark_resample(args)
+
+    elif args.mode == 'decode':
+        benchmark_decode(args)
+
+    elif args.mode == 'post_processing':
+        benchmark_post_processing(args)
+
+    elif args.mode == 'detection':
+        benchmark_detection(args)
+
+    elif args.mode == 'incremental':
+        benchmark_incremental(args)
+
+    else:
+        raise Exception('Incorrect argument!')
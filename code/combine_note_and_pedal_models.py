@@ -2,6 +2,10 @@ import os
 import argparse
 import torch
 
+import models
+from model_registry import get_quantized_path, quantize_model
+import config
+
 
 def combine_note_and_pedal_models(args):
     """Combine trained note transcription and pedal transcription models to a 
@@ -27,12 +31,54 @@ def combine_note_and_pedal_models(args):
     torch.save(full_checkpoint, output_checkpoint_path)
     print('Model saved to {}'.format(output_checkpoint_path))
 
+    if args.int8:
+        write_quantized_checkpoint(output_checkpoint_path)
+
+
+def write_quantized_checkpoint(checkpoint_path, model_type='Note_pedal', 
+    output_checkpoint_path=None):
+    """Write the int8 dynamically quantized weights of a checkpoint. The fully 
+    connected and GRU weights are stored in int8, which roughly halves the 
+    size of the fp32 checkpoint. PianoTranscription(precision='int8') 
+    loads it instead of quantizing the fp32 checkpoint.
+
+    Args:
+      checkpoint_path: str, fp32 checkpoint
+      model_type: str
+      output_checkpoint_path: str | None, defaults to get_quantized_path()
+    """
+    if output_checkpoint_path is None:
+        output_checkpoint_path = get_quantized_path(checkpoint_path)
+
+    Model = getattr(models, model_type)
+    model = Model(frames_per_second=config.frames_per_second, 
+        classes_num=config.classes_num)
+
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['model'], strict=False)
+    model.eval()
+
+    model = quantize_model(model)
+
+    # Keep the layout of the checkpoint, combined checkpoints store one state 
+    # dict per sub model
+    if all(isinstance(value, dict) for value in checkpoint['model'].values()):
+        state_dict = {name: getattr(model, name).state_dict() 
+            for name in checkpoint['model'].keys()}
+    else:
+        state_dict = model.state_dict()
+
+    torch.save({'model': state_dict, 'precision': 'int8'}, output_checkpoint_path)
+    print('int8 model saved to {}'.format(output_checkpoint_path))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--note_checkpoint_path', type=str, required=True)
     parser.add_argument('--pedal_checkpoint_path', type=str, required=True)
     parser.add_argument('--output_checkpoint_path', type=str, required=True)
+    parser.add_argument('--int8', action='store_true', default=False, 
+        help='Also write the int8 quantized checkpoint for CPU inference.')
 
     args = parser.parse_args()
     
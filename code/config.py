@@ -1,7 +1,29 @@
+import os
+
 sample_rate = 16000
 classes_num = 88    # Number of notes of piano
 begin_note = 21     # MIDI note of A0, the lowest note of a piano.
 segment_seconds = 10.	# Training segment duration
 hop_seconds = 1.
 frames_per_second = 100
-velocity_scale = 128
\ No newline at end of file
+velocity_scale = 128
+mel_bins = 229     # Log mel bins of the model frontend
+
+# Default checkpoint, the same location used by piano_transcription_inference
+checkpoint_path = os.path.join(os.path.expanduser('~'), 
+    'piano_transcription_inference_data', 'note_F1=0.9677_pedal_F1=0.9186.pth')
+
+# Loaded models are shared by the process and released after being idle
+model_idle_seconds = 600.
+model_max_bytes = None
+
+# Transcription results of repeated audio files are served from disk
+result_cache_dir = os.path.join(os.path.expanduser('~'), 
+    'piano_transcription_inference_data', 'cache')
+result_cache_max_bytes = 2 * 1024 ** 3
+
+# Decoded and resampled audio of repeated audio files is memory mapped from disk
+audio_cache_dir = os.path.join(os.path.expanduser('~'), 
+    'piano_transcription_inference_data', 'audio_cache')
+audio_cache_max_bytes = 4 * 1024 ** 3
+audio_cache_dtype = 'float32'
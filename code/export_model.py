@@ -0,0 +1,179 @@
+import os
+import argparse
+import inspect
+import time
+import numpy as np
+
+import torch
+
+from model_registry import (load_model, get_scripted_path, get_onnx_path, 
+    get_safetensors_path, OnnxruntimeModel)
+from pytorch_utils import save_safetensors
+import models
+import config
+
+
+def export_torchscript(args):
+    """Export a checkpoint to a TorchScript model for CPU inference. The model
+    is traced on one segment and frozen, which removes Python dispatch and
+    folds batch normalization into the preceding layers. PianoTranscription
+    loads the exported model instead of the checkpoint when it is newer than
+    the checkpoint.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      output_path: str | None, defaults to get_scripted_path()
+      segment_seconds: float, duration of the example segment
+    """
+
+    # Arguments & parameters
+    model_type = args.model_type
+    checkpoint_path = args.checkpoint_path
+    output_path = args.output_path or get_scripted_path(checkpoint_path, model_type)
+    segment_samples = int(config.sample_rate * args.segment_seconds)
+
+    model = load_model(model_type, checkpoint_path, device='cpu', scripted=False)
+    example = torch.zeros(1, segment_samples)
+
+    export_time = time.time()
+
+    with torch.no_grad():
+        scripted_model = torch.jit.trace(model, example, strict=False)
+
+        if hasattr(torch.jit, 'freeze'):
+            scripted_model = torch.jit.freeze(scripted_model)
+
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    torch.jit.save(scripted_model, output_path)
+    print('Export time: {:.3f} s'.format(time.time() - export_time))
+    print('Model saved to {}'.format(output_path))
+
+
+def export_onnx(args):
+    """Export a checkpoint to ONNX, including the torchlibrosa spectrogram and 
+    log mel frontend, so that the model runs on raw waveforms in onnxruntime. 
+    Batch size and audio length are dynamic. The exported model is checked 
+    against PyTorch on a random segment.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      output_path: str | None, defaults to get_onnx_path()
+      segment_seconds: float, duration of the example segment
+      opset_version: int
+    """
+
+    # Arguments & parameters
+    model_type = args.model_type
+    checkpoint_path = args.checkpoint_path
+    output_path = args.output_path or get_onnx_path(checkpoint_path, model_type)
+    segment_samples = int(config.sample_rate * args.segment_seconds)
+
+    model = load_model(model_type, checkpoint_path, device='cpu', scripted=False)
+    example = torch.zeros(1, segment_samples)
+
+    with torch.no_grad():
+        output_names = list(model(example).keys())
+
+    dynamic_axes = {'waveform': {0: 'batch_size', 1: 'data_length'}}
+    for name in output_names:
+        dynamic_axes[name] = {0: 'batch_size', 1: 'time_steps'}
+
+    # Newer PyTorch defaults to the dynamo exporter, keep the TorchScript based
+    # exporter of the pinned PyTorch version
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    export_time = time.time()
+    torch.onnx.export(model, example, output_path, input_names=['waveform'], 
+        output_names=output_names, dynamic_axes=dynamic_axes, 
+        opset_version=args.opset_version, **kwargs)
+    print('Export time: {:.3f} s'.format(time.time() - export_time))
+    print('Model saved to {}'.format(output_path))
+
+    # Parity check on a random segment
+    random_state = np.random.RandomState(1234)
+    x = torch.Tensor(random_state.uniform(-0.1, 0.1, (1, segment_samples)))
+
+    with torch.no_grad():
+        torch_dict = model(x)
+        onnx_dict = OnnxruntimeModel(output_path)(x)
+
+    for name in output_names:
+        print('{}: max abs diff {:.2e}'.format(name, 
+            (torch_dict[name] - onnx_dict[name]).abs().max().item()))
+
+
+def export_safetensors(args):
+    """Convert a checkpoint to a flat, memory-mappable weights file in the 
+    safetensors layout. PianoTranscription maps it instead of unpickling the 
+    checkpoint, so start up reads no weights until they are used and worker 
+    processes on one host share the page cache copy.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      output_path: str | None, defaults to get_safetensors_path()
+    """
+
+    # Arguments & parameters
+    model_type = args.model_type
+    checkpoint_path = args.checkpoint_path
+    output_path = args.output_path or get_safetensors_path(checkpoint_path)
+
+    Model = getattr(models, model_type)
+    model = Model(frames_per_second=config.frames_per_second, 
+        classes_num=config.classes_num)
+
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(checkpoint['model'], strict=False)
+
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    save_safetensors(model.state_dict(), output_path)
+    print('Weights saved to {}'.format(output_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    parser_torchscript = subparsers.add_parser('torchscript')
+    parser_torchscript.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_torchscript.add_argument('--checkpoint_path', type=str, required=True)
+    parser_torchscript.add_argument('--output_path', type=str, default=None)
+    parser_torchscript.add_argument('--segment_seconds', type=float, default=10.)
+
+    parser_onnx = subparsers.add_parser('onnx')
+    parser_onnx.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_onnx.add_argument('--checkpoint_path', type=str, required=True)
+    parser_onnx.add_argument('--output_path', type=str, default=None)
+    parser_onnx.add_argument('--segment_seconds', type=float, default=10.)
+    parser_onnx.add_argument('--opset_version', type=int, default=11)
+
+    parser_safetensors = subparsers.add_parser('safetensors')
+    parser_safetensors.add_argument('--model_type', type=str, default='Note_pedal')
+    parser_safetensors.add_argument('--checkpoint_path', type=str, required=True)
+    parser_safetensors.add_argument('--output_path', type=str, default=None)
+
+    args = parser.parse_args()
+
+    if args.mode == 'torchscript':
+        export_torchscript(args)
+
+    elif args.mode == 'onnx':
+        export_onnx(args)
+
+    elif args.mode == 'safetensors':
+        export_safetensors(args)
+
+    else:
+        raise Exception('Incorrect argument!')
@@ -3,102 +3,283 @@ import sys
 sys.path.insert(1, os.path.join(sys.path[0], '../utils'))
 import numpy as np
 import argparse
-import h5py
-import math
 import time
-import librosa
-import logging
-import matplotlib.pyplot as plt
 
 import torch
  
 from utilities import (create_folder, get_filename, RegressionPostProcessor, 
-    OnsetsFramesPostProcessor, write_events_to_midi, load_audio)
-from models import Note_pedal
-from pytorch_utils import move_data_to_device, forward
+    IncrementalRegressionPostProcessor, OnsetsFramesPostProcessor, 
+    NoteEvents, PedalEvents, write_events_to_midi, load_audio, stream_audio, 
+    get_active_segments, save_activations, load_activations, prefetch)
+from model_registry import registry as model_registry
+from audio_cache import audio_cache
+from piano_vad import get_onsets_frames_pedal_detection_state
+from pytorch_utils import (move_data_to_device, forward, forward_batches, 
+    get_auto_batch_size, get_model_device)
 import config
 
 
 class PianoTranscription(object):
     def __init__(self, model_type, checkpoint_path=None, 
         segment_samples=16000*10, device=torch.device('cuda'), 
-        post_processor_type='regression'):
+        post_processor_type='regression', batch_size=1, memory_budget=None, 
+        overlap=0.5, skip_inactive=False, backend='torch', precision='fp32', 
+        parallel_branches=False, shared_trunk=False, onset_threshold=0.3, 
+        offset_threshold=0.3, frame_threshold=0.1, pedal_offset_threshold=0.2, 
+        res_type='kaiser_best'):
         """Class for transcribing piano solo recording.
 
         Args:
           model_type: str
-          checkpoint_path: str
-          segment_samples: int
+          checkpoint_path: str, use config.checkpoint_path if None
+          segment_samples: int, multiple of the frame hop size
           device: 'cuda' | 'cpu'
+          batch_size: int | 'auto', segments per forward pass. 'auto' picks the 
+            largest batch that fits memory_budget.
+          memory_budget: int | None, bytes available for activations in 'auto'
+            mode. If None, it is derived from free memory.
+          overlap: float, overlap ratio of consecutive segments in [0, 1). The 
+            segment hop is rounded to a multiple of the frame hop size.
+          skip_inactive: bool, do not forward segments without musical activity
+            (silence, noise, applause), their outputs are set to zero. 
+            Segments with talking are tonal and still forwarded.
+          backend: 'torch' | 'onnxruntime', onnxruntime runs the model exported
+            by export_model.py onnx
+          precision: 'fp32' | 'int8', int8 runs dynamically quantized fully 
+            connected and GRU layers on CPU
+          parallel_branches: bool, opt-in, run the four acoustic branches of 
+            the note model concurrently, meant to lower the latency of a 
+            segment on a multi-core CPU. Only supported by the PyTorch models. 
+            The speed up is not measured yet, see benchmark.py branches.
+          shared_trunk: bool, run the frontend and the convolutional trunk once
+            per frame of the recording instead of once per overlapping 
+            segment; only the recurrent parts run on the segments. Used by 
+            transcribe() with the PyTorch note models, notes only, other 
+            transcriptions forward whole segments.
+          onset_threshold: float, thresholds of the regression post processor
+          offset_threshold: float
+          frame_threshold: float
+          pedal_offset_threshold: float
+          res_type: str, resampler of load_audio(), see utilities.resample(). 
+            'polyphase' is several times faster than 'kaiser_best'.
         """
 
-        if 'cuda' in str(device) and torch.cuda.is_available():
+        if 'cuda' in str(device) and torch.cuda.is_available() and \
+            precision != 'int8':
             self.device = 'cuda'
         else:
             self.device = 'cpu'
 
         self.segment_samples = segment_samples
+        self.overlap = overlap
         self.post_processor_type = post_processor_type
         self.frames_per_second = config.frames_per_second
         self.classes_num = config.classes_num
-        self.onset_threshold = 0.3
-        self.offset_threshod = 0.3
-        self.frame_threshold = 0.1
-        self.pedal_offset_threshold = 0.2
-
-        # Build model
-        Model = eval(model_type)
-        self.model = Model(frames_per_second=self.frames_per_second, 
-            classes_num=self.classes_num)
-
-        # check if checkpoint exists
-        if not os.path.exists(checkpoint_path):
-            raise Exception(f"Checkpoint file not found at {checkpoint_path}")
-
-        # Load model
-        checkpoint = torch.load(checkpoint_path, map_location=self.device)
-        self.model.load_state_dict(checkpoint['model'], strict=False)
-
-        # Parallel
-        if 'cuda' in str(self.device):
-            self.model.to(self.device)
-            print('GPU number: {}'.format(torch.cuda.device_count()))
-            self.model = torch.nn.DataParallel(self.model)
+        self.onset_threshold = onset_threshold
+        self.offset_threshold = offset_threshold
+        self.frame_threshold = frame_threshold
+        self.pedal_offset_threshold = pedal_offset_threshold
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.skip_inactive = skip_inactive
+        self.parallel_branches = parallel_branches
+        self.shared_trunk = shared_trunk
+        self.res_type = res_type
+        self.skipped_output_dicts = {}  # pedal -> output of a skipped segment
+
+        # Segments and their hop must align with spectrogram frames
+        self.hop_samples = config.sample_rate // self.frames_per_second
+
+        # Half of the 2048 sample spectrogram window is 7 frames, and the eight
+        # 3x3 convolutions of the trunk see 8 frames to each side
+        self.trunk_context_frames = 16
+        self.segment_hop_samples = int(round(segment_samples * (1. - overlap) 
+            / self.hop_samples)) * self.hop_samples
+
+        if segment_samples % self.hop_samples:
+            raise ValueError('segment_samples must be a multiple of {}.'.format(
+                self.hop_samples))
+
+        if not 0 < self.segment_hop_samples <= segment_samples:
+            raise ValueError('overlap must be in [0, 1).')
+
+        if checkpoint_path is None:
+            checkpoint_path = config.checkpoint_path
+
+        self.model_type = model_type
+        self.checkpoint_path = checkpoint_path
+        self.precision = precision
+        self.backend = backend
+
+    @property
+    def model(self):
+        """Model shared by the process, loaded on first use, so that cached 
+        results can be served without loading it."""
+        return self.get_model()
+
+    def get_model(self, eager=False):
+        """Model shared by the process. An exported TorchScript model only 
+        has the note-only forward, so pedal transcription and the shared 
+        trunk ask for the eager PyTorch model.
+
+        Args:
+          eager: bool, ignore an exported TorchScript model
+
+        Returns:
+          model: nn.Module
+        """
+        return model_registry.get(self.model_type, self.checkpoint_path, 
+            self.device, precision=self.precision, backend=self.backend, 
+            scripted=not eager)
+
+    def get_config(self):
+        """Settings that determine the transcription result, e.g. to key a 
+        result cache. The checkpoint is identified by path, size and time of 
+        modification.
+
+        Returns:
+          config_dict: dict, JSON serializable
+        """
+        checkpoint_path = os.path.realpath(self.checkpoint_path)
+
+        if os.path.exists(checkpoint_path):
+            checkpoint_stat = [os.path.getsize(checkpoint_path), 
+                os.path.getmtime(checkpoint_path)]
         else:
-            print('Using CPU.')
+            checkpoint_stat = None
+
+        return {
+            'model_type': self.model_type, 
+            'checkpoint_path': checkpoint_path, 
+            'checkpoint_stat': checkpoint_stat, 
+            'precision': self.precision, 
+            'backend': self.backend, 
+            'segment_samples': self.segment_samples, 
+            'segment_hop_samples': self.segment_hop_samples, 
+            'skip_inactive': self.skip_inactive, 
+            'shared_trunk': self.shared_trunk, 
+            'post_processor_type': self.post_processor_type, 
+            'onset_threshold': self.onset_threshold, 
+            'offset_threshold': self.offset_threshold, 
+            'frame_threshold': self.frame_threshold, 
+            'pedal_offset_threshold': self.pedal_offset_threshold, 
+            'res_type': self.res_type}
+
+    def load_audio(self, audio_path, use_cache=True, offset=0., duration=None, 
+        file_hash=None):
+        """Load an audio file as mono audio at the sample rate of the model, 
+        resampled with res_type.
+
+        Args:
+          audio_path: str
+          use_cache: bool, memory map the decoded audio of a file that was 
+            loaded before from audio_cache.audio_cache, and store it otherwise.
+            Partial reads with offset or duration do not use the cache.
+          offset: float, seconds to skip. The decoder seeks, so a part costs 
+            its own duration rather than the offset.
+          duration: float | None, seconds to load, None to load to the end
+          file_hash: str | None, result_cache.hash_file() of audio_path if the
+            caller already computed it, e.g. for the result cache key
+
+        Returns:
+          audio: (audio_samples,)
+        """
+        partial = offset > 0 or duration is not None
+
+        # Only whole files use the cache. Its key hashes the whole file, which 
+        # would make a partial read cost the size of the file.
+        use_cache = use_cache and not partial
+
+        if use_cache:
+            key = audio_cache.get_key(audio_path, config.sample_rate, 
+                self.res_type, file_hash=file_hash)
+            audio = audio_cache.get(key)
 
-    def transcribe(self, audio, midi_path):
+            if audio is not None:
+                print('Decoded audio from cache {}'.format(audio_cache.get_path(key)))
+                return audio
+
+        (audio, _) = load_audio(audio_path, sr=config.sample_rate, mono=True, 
+            offset=offset, duration=duration, res_type=self.res_type)
+
+        if use_cache:
+            audio = audio_cache.put(key, audio)
+
+        return audio
+
+    def transcribe(self, audio, midi_path, pedal=False, activations_path=None):
         """Transcribe an audio recording.
 
         Args:
           audio: (audio_samples,)
           midi_path: str, path to write out the transcribed MIDI.
+          pedal: bool, also transcribe sustain pedal events. Only supported by 
+            the PyTorch Note_pedal model.
+          activations_path: str | None, also save the model outputs to this 
+            .npz file, so that transcribe_activations() can post process them 
+            again with other thresholds without running the model
 
         Returns:
           transcribed_dict, dict: {'output_dict':, ..., 'est_note_events': ..., 
-            'est_pedal_events': ...}
+            'est_pedal_events': ..., 'skip_ratio': ...}
         """
 
-        audio = audio[None, :]  # (1, audio_samples)
+        # Pad audio so that the last segment ends at the end of the buffer. This 
+        # is the only copy of the audio.
+        audio_len = len(audio)
+        segments_num = self.get_segments_num(audio_len)
+        padded_len = (segments_num - 1) * self.segment_hop_samples \
+            + self.segment_samples
 
-        # Pad audio to be evenly divided by segment_samples
-        audio_len = audio.shape[1]
-        pad_len = int(np.ceil(audio_len / self.segment_samples)) \
-            * self.segment_samples - audio_len
-
-        audio = np.concatenate((audio, np.zeros((1, pad_len))), axis=1)
+        padded_audio = np.zeros(padded_len, dtype=np.float32)
+        padded_audio[0 : audio_len] = audio
 
         # Enframe to segments
-        segments = self.enframe(audio, self.segment_samples)
-        """(N, segment_samples)"""
+        segments = self.enframe(padded_audio, self.segment_samples, 
+            self.segment_hop_samples)
+        """(N, segment_samples), a view of padded_audio"""
+
+        # Segments without musical activity are not forwarded
+        active = self.get_active_segments(segments)
+        indexes = np.flatnonzero(active)
+
+        # Forward and deframe each mini-batch into the preallocated outputs. 
+        # Frames of skipped segments stay zero.
+        output_dict = {}
+        pointer = 0
+
+        batch_size = self.get_batch_size(len(indexes))
+
+        if self.shared_trunk and self.has_shared_trunk(pedal):
+            batches = self.forward_shared_trunk(padded_audio, indexes, 
+                batch_size)
+        else:
+            batches = forward_batches(self.get_forward_model(pedal), segments, 
+                batch_size=batch_size, indexes=indexes, 
+                **self.get_forward_kwargs(pedal))
+
+        for batch_output_dict in batches:
+            """{'reg_onset_output': (batch_size, segment_frames, classes_num), ...}"""
+
+            for key in batch_output_dict.keys():
+                x = batch_output_dict[key]
+
+                if key not in output_dict.keys():
+                    frames_num = self.get_frames_num(segments_num, x.shape[1])
+                    output_dict[key] = np.zeros((frames_num,) + x.shape[2 :], 
+                        dtype=x.dtype)
+
+                for n in range(len(x)):
+                    self.deframe_segment(output_dict[key], x[n], 
+                        indexes[pointer + n], segments_num)
 
-        # Forward
-        output_dict = forward(self.model, segments, batch_size=1)
-        """{'reg_onset_output': (N, segment_frames, classes_num), ...}"""
+            pointer += len(x)
 
-        # Deframe to original length
-        for key in output_dict.keys():
-            output_dict[key] = self.deframe(output_dict[key])[0 : audio_len]
+        if not output_dict:
+            # All segments are skipped
+            for (key, x) in self.get_skipped_output(pedal).items():
+                output_dict[key] = np.zeros((self.get_frames_num(segments_num, 
+                    x.shape[0]),) + x.shape[1 :], dtype=x.dtype)
         """output_dict: {
           'reg_onset_output': (segment_frames, classes_num), 
           'reg_offset_output': (segment_frames, classes_num), 
@@ -108,20 +289,44 @@ class PianoTranscription(object):
           'reg_pedal_offset_output': (segment_frames, 1), 
           'pedal_frame_output': (segment_frames, 1)}"""
 
-        # Post processor
-        if self.post_processor_type == 'regression':
-            """Proposed high-resolution regression post processing algorithm."""
-            post_processor = RegressionPostProcessor(self.frames_per_second, 
-                classes_num=self.classes_num, onset_threshold=self.onset_threshold, 
-                offset_threshold=self.offset_threshod, 
-                frame_threshold=self.frame_threshold, 
-                pedal_offset_threshold=self.pedal_offset_threshold)
+        # Save before post processing adds its binarized outputs
+        if activations_path:
+            save_activations(output_dict, activations_path)
+            print('Write out to {}'.format(activations_path))
 
-        elif self.post_processor_type == 'onsets_frames':
-            """Google's onsets and frames post processing algorithm. Only used 
-            for comparison."""
-            post_processor = OnsetsFramesPostProcessor(self.frames_per_second, 
-                self.classes_num)
+        transcribed_dict = self.post_process(output_dict, midi_path)
+        transcribed_dict['skip_ratio'] = 1. - len(indexes) / segments_num
+
+        return transcribed_dict
+
+    def transcribe_activations(self, activations_path, midi_path):
+        """Post process model outputs saved by transcribe() with the 
+        thresholds of this transcriptor. The model is not loaded.
+
+        Args:
+          activations_path: str
+          midi_path: str | None
+
+        Returns:
+          transcribed_dict: dict, same as transcribe() without 'skip_ratio'
+        """
+        return self.post_process(load_activations(activations_path), midi_path)
+
+    def post_process(self, output_dict, midi_path):
+        """Post process model outputs to MIDI events and write them out.
+
+        Args:
+          output_dict: dict, {'reg_onset_output': (frames_num, classes_num), 
+            ...}, deframed model outputs
+          midi_path: str | None
+
+        Returns:
+          transcribed_dict: dict, {'output_dict':, 'est_note_events': 
+            NoteEvents, 'est_pedal_events': PedalEvents | None}
+        """
+
+        # Post processor
+        post_processor = self.get_post_processor()
 
         # Post process output_dict to MIDI events
         (est_note_events, est_pedal_events) = \
@@ -140,25 +345,497 @@ class PianoTranscription(object):
 
         return transcribed_dict
 
-    def enframe(self, x, segment_samples):
-        """Enframe long sequence to short segments.
+    def transcribe_stream(self, audio_blocks, chunk_frames=1000, pedal=False, 
+        prefetch_blocks=2):
+        """Transcribe a stream of audio blocks with bounded memory.
+
+        Audio is buffered only until the next segment is complete and segment 
+        outputs are stitched as they arrive. The regression post processor 
+        runs incrementally on the stitched frames, which emits each note as 
+        soon as it ends and gives the same events as transcribe(). Other post
+        processors run on a sliding window of frames, where a note is final 
+        once its onset is further behind the newest frame than the longest 
+        note the detector can produce. Their pedals are detected 
+        incrementally, as detection only looks back one frame. Either way, 
+        peak memory does not depend on the duration of the recording.
 
         Args:
-          x: (1, audio_samples)
-          segment_samples: int
+          audio_blocks: iterable of (block_samples,), mono audio at 
+            config.sample_rate, e.g. from utilities.stream_audio()
+          chunk_frames: int, frames finalized per step of the sliding window
+          pedal: bool, also transcribe sustain pedal events
+          prefetch_blocks: int, audio blocks decoded ahead in a background 
+            thread while the model runs, 0 to decode in the calling thread
 
-        Returns:
-          batch: (N, segment_samples)
+        Yields:
+          (est_note_events, est_pedal_events): NoteEvents and PedalEvents, 
+            finalized events in the same format as transcribe(), ordered by 
+            onset time within a step
         """
-        assert x.shape[1] % segment_samples == 0
+        if prefetch_blocks > 0:
+            audio_blocks = prefetch(audio_blocks, max_items=prefetch_blocks)
+
+        if self.post_processor_type == 'regression':
+            post_processor = self.get_post_processor(incremental=True)
+
+            for frames_dict in self.stream_frames(audio_blocks, pedal):
+                (note_events, pedal_events) = post_processor.process(frames_dict)
+                pedal_events = PedalEvents.from_dicts(pedal_events)
+                if len(note_events) or len(pedal_events):
+                    yield note_events.sort(), pedal_events.sort()
+
+            (note_events, pedal_events) = post_processor.flush()
+            yield note_events.sort(), PedalEvents.from_dicts(pedal_events).sort()
+            return
+
+        post_processor = self.get_post_processor()
+
+        # Longest note of note_detection_with_onset_offset_regress() plus the
+        # peak picking neighbourhood of offsets
+        lookahead_frames = 600 + 10
+        context_frames = 10
+
+        window_dict = None
+        window_bgn = 0  # Global index of the first frame in window_dict
+        emit_bgn = 0    # Global index of the first frame not yet finalized
+
+        # Pedals may be held longer than the window, they are detected with a
+        # state carried across blocks instead
+        pedal_state = get_onsets_frames_pedal_detection_state()
+        pedal_events_list = []
+
+        def _finalize(emit_fin):
+            window = {key: window_dict[key] for key in window_dict.keys() 
+                if 'pedal' not in key}
+            (note_events, _) = post_processor.output_dict_to_midi_events(window)
+
+            bgn_time = emit_bgn / self.frames_per_second
+            fin_time = emit_fin / self.frames_per_second
+            shift_time = window_bgn / self.frames_per_second
+
+            def _finalized(events):
+                events = events.shift(shift_time)
+                return events[(bgn_time <= events.onset_time) & 
+                    (events.onset_time < fin_time)].sort()
+
+            pedal_events = PedalEvents.concatenate(pedal_events_list).sort()
+            del pedal_events_list[:]
+
+            return _finalized(note_events), pedal_events
+
+        for frames_dict in self.stream_frames(audio_blocks, pedal):
+            if 'reg_pedal_onset_output' in frames_dict.keys():
+                pedal_events_list.append(post_processor.detected_pedals_to_events(
+                    post_processor.output_dict_to_detected_pedals(frames_dict, 
+                    state=pedal_state)))
+
+            if window_dict is None:
+                window_dict = frames_dict
+            else:
+                for key in window_dict.keys():
+                    window_dict[key] = np.concatenate(
+                        (window_dict[key], frames_dict[key]), axis=0)
+
+            window_fin = window_bgn + len(window_dict['frame_output'])
+
+            while window_fin - emit_bgn >= chunk_frames + lookahead_frames:
+                emit_fin = emit_bgn + chunk_frames
+                yield _finalize(emit_fin)
+                emit_bgn = emit_fin
+
+                # Drop frames that can no longer affect unfinalized notes
+                trim = emit_bgn - context_frames - window_bgn
+                for key in window_dict.keys():
+                    window_dict[key] = window_dict[key][trim :]
+                window_bgn += trim
+
+        if window_dict is not None:
+            yield _finalize(np.inf)
+
+    def stream_frames(self, audio_blocks, pedal=False):
+        """Forward a stream of audio blocks and stitch the segment outputs.
+
+        Segments overlap as in enframe(). The output of a segment is held back 
+        until the next one arrives, because deframe() keeps more frames of the 
+        last segment.
+
+        Args:
+          audio_blocks: iterable of (block_samples,)
+          pedal: bool
+
+        Yields:
+          frames_dict: dict, {'reg_onset_output': (frames, classes_num), ...}, 
+            consecutive blocks of the deframed output_dict
+        """
+        batch_size = self.get_batch_size(None)
         batch = []
+        segments_num = 0
+        previous_dict = None
 
-        pointer = 0
-        while pointer + segment_samples <= x.shape[1]:
-            batch.append(x[:, pointer : pointer + segment_samples])
-            pointer += segment_samples // 2
+        def _slice(segment_dict, n, last):
+            # Only whether the n-th segment is the last one matters
+            assumed_num = n + 1 if last else n + 2
+            frames_dict = {}
+            for key in segment_dict.keys():
+                x = segment_dict[key]
+                (bgn, fin) = self.get_kept_frames(x.shape[0], n, assumed_num)
+                frames_dict[key] = x[bgn : fin]
+            return frames_dict
+
+        def _forward(batch):
+            batch = np.stack(batch, axis=0)
+            active = self.get_active_segments(batch)
+            indexes = np.flatnonzero(active)
+
+            output_dict = forward(self.get_forward_model(pedal), 
+                batch[indexes], batch_size=len(batch), 
+                **self.get_forward_kwargs(pedal)) if len(indexes) else {}
+
+            m = 0
+            for n in range(len(batch)):
+                if active[n]:
+                    yield {key: output_dict[key][m] for key in output_dict.keys()}
+                    m += 1
+                else:
+                    yield self.get_skipped_output(pedal)
+
+        for segment in self.stream_segments(audio_blocks):
+            batch.append(segment)
+            if len(batch) < batch_size:
+                continue
+
+            for segment_dict in _forward(batch):
+                if previous_dict is not None:
+                    yield _slice(previous_dict, segments_num - 1, last=False)
+                previous_dict = segment_dict
+                segments_num += 1
+            batch = []
+
+        if batch:
+            for segment_dict in _forward(batch):
+                if previous_dict is not None:
+                    yield _slice(previous_dict, segments_num - 1, last=False)
+                previous_dict = segment_dict
+                segments_num += 1
+
+        if segments_num > 0:
+            yield _slice(previous_dict, segments_num - 1, last=True)
+
+    def stream_segments(self, audio_blocks):
+        """Enframe a stream of audio blocks to overlapping segments. The end of 
+        the stream is zero padded in the same way as in transcribe().
+
+        Args:
+          audio_blocks: iterable of (block_samples,)
+
+        Yields:
+          segment: (segment_samples,)
+        """
+        hop_samples = self.segment_hop_samples
+        buffer = np.zeros(0, dtype=np.float32)
+        audio_len = 0
+        segment_bgn = 0
+
+        for block in audio_blocks:
+            buffer = np.concatenate((buffer, block.astype(np.float32)))
+            audio_len += len(block)
+
+            while len(buffer) >= self.segment_samples:
+                yield buffer[0 : self.segment_samples]
+                buffer = buffer[hop_samples :]
+                segment_bgn += hop_samples
+
+        padded_len = (self.get_segments_num(audio_len) - 1) * hop_samples \
+            + self.segment_samples
 
-        batch = np.concatenate(batch, axis=0)
+        while segment_bgn + self.segment_samples <= padded_len:
+            segment = np.zeros(self.segment_samples, dtype=np.float32)
+            segment[0 : len(buffer)] = buffer[0 : self.segment_samples]
+            yield segment
+            buffer = buffer[hop_samples :]
+            segment_bgn += hop_samples
+
+    def has_shared_trunk(self, pedal=False):
+        """Whether transcribe() can run the shared trunk. It needs the 
+        PyTorch note model, an exported model only has the segment forward, 
+        and does not transcribe pedals.
+
+        Args:
+          pedal: bool
+
+        Returns:
+          bool
+        """
+        model = self.get_model(eager=True)
+        model = getattr(model, 'module', model)   # DataParallel
+
+        if pedal or not hasattr(model, 'forward_trunk'):
+            print('The shared trunk requires the PyTorch note model and does '
+                'not transcribe pedals, forwarding whole segments.')
+            return False
+
+        return True
+
+    def forward_shared_trunk(self, audio, indexes, batch_size):
+        """Forward segments of audio like forward_batches(), but run the 
+        frontend and the convolutional trunk once per frame. Trunk features 
+        of the frames shared by consecutive segments are cached, and only the 
+        recurrent parts run on each segment window.
+
+        The trunk runs on spans of new frames with enough context that its 
+        output equals one pass over the whole recording. Outputs therefore 
+        differ slightly from forward_batches() near segment edges, where a 
+        segment sees padding instead of the neighbouring audio.
+
+        Args:
+          audio: (padded_len,), padded audio as enframed by transcribe()
+          indexes: (M,), ascending indexes of the segments to forward
+          batch_size: int
+
+        Yields:
+          batch_output_dict: dict, {'reg_onset_output': (batch_size, 
+            segment_frames, classes_num), ...}
+        """
+        model = self.get_model(eager=True)
+        model = getattr(model, 'module', model)   # DataParallel
+
+        hop_frames = self.segment_hop_samples // self.hop_samples
+        segment_frames = self.segment_samples // self.hop_samples + 1
+        cache = None    # (frames, 4, 768), trunk features
+        cache_bgn = 0   # Global index of the first cached frame
+
+        for pointer in range(0, len(indexes), batch_size):
+            batch_indexes = indexes[pointer : pointer + batch_size]
+            need_bgn = batch_indexes[0] * hop_frames
+            need_fin = batch_indexes[-1] * hop_frames + segment_frames
+
+            # Keep cached frames that are still needed, skipped segments may 
+            # leave a gap
+            if cache is not None and need_bgn < cache_bgn + len(cache):
+                cache = cache[need_bgn - cache_bgn :]
+            else:
+                cache = None
+            cache_bgn = need_bgn
+            cache_fin = cache_bgn + (len(cache) if cache is not None else 0)
+
+            if need_fin > cache_fin:
+                x = self.forward_trunk(model, audio, cache_fin, need_fin)
+                cache = x if cache is None else torch.cat((cache, x), dim=0)
+
+            windows = torch.stack([cache[n * hop_frames - cache_bgn : 
+                n * hop_frames - cache_bgn + segment_frames] 
+                for n in batch_indexes], dim=0)
+            """(batch_size, segment_frames, 4, 768)"""
+
+            with torch.no_grad():
+                model.eval()
+                batch_output_dict = model.forward_windows(windows)
+
+            yield {key: batch_output_dict[key].data.cpu().numpy() 
+                for key in batch_output_dict.keys()}
+
+    def forward_trunk(self, model, audio, bgn, fin):
+        """Trunk features of frames [bgn, fin) of audio, equal to those of one 
+        pass over the whole audio. The span is extended by trunk_context_frames
+        on both sides, which covers the spectrogram window and the receptive 
+        field of the convolutions.
+
+        Args:
+          model: nn.Module with forward_trunk()
+          audio: (padded_len,)
+          bgn: int
+          fin: int
+
+        Returns:
+          features: (fin - bgn, 4, 768), tensor on the model device
+        """
+        span_bgn = max(bgn - self.trunk_context_frames, 0)
+        sample_fin = min((fin - 1 + self.trunk_context_frames) * self.hop_samples, 
+            len(audio) - 1)
+
+        x = move_data_to_device(
+            audio[None, span_bgn * self.hop_samples : sample_fin + 1], 
+            get_model_device(model))
+
+        with torch.no_grad():
+            model.eval()
+            features = model.forward_trunk(x)[0]
+
+        return features[bgn - span_bgn : fin - span_bgn]
+
+    def get_active_segments(self, segments):
+        """Mark segments to be forwarded.
+
+        Args:
+          segments: (N, segment_samples)
+
+        Returns:
+          active: (N,), bool
+        """
+        if self.skip_inactive:
+            return get_active_segments(segments, config.sample_rate)
+        else:
+            return np.ones(len(segments), dtype=bool)
+
+    def get_forward_model(self, pedal):
+        """Model that serves get_forward_kwargs(). Keyword arguments need 
+        the eager PyTorch model, see get_model()."""
+        return self.get_model(eager=pedal or self.parallel_branches)
+
+    def get_forward_kwargs(self, pedal):
+        """Keyword arguments of the model call. Default calls pass none, so 
+        that every model and backend can serve them."""
+        kwargs = {}
+        if not pedal and not self.parallel_branches:
+            return kwargs
+
+        import models
+
+        model = self.get_forward_model(pedal)
+        model = getattr(model, 'module', model)   # DataParallel
+
+        if pedal:
+            if not isinstance(model, models.Note_pedal):
+                raise ValueError('Pedal transcription requires the PyTorch '
+                    'Note_pedal model, got {}.'.format(type(model).__name__))
+            kwargs['pedal'] = True
+
+        if self.parallel_branches:
+            if not isinstance(model, (models.Note_pedal, 
+                models.Regress_onset_offset_frame_velocity_CRNN)):
+                raise ValueError('Parallel branches require the PyTorch note '
+                    'model, got {}.'.format(type(model).__name__))
+            kwargs['parallel'] = True
+
+        return kwargs
+
+    def get_skipped_output(self, pedal=False):
+        """All-zero output of one skipped segment. Keys and shapes are taken 
+        from a forward of a few frames of silence.
+
+        Args:
+          pedal: bool
+
+        Returns:
+          output_dict: {'reg_onset_output': (segment_frames, classes_num), ...}
+        """
+        if pedal not in self.skipped_output_dicts:
+            x = np.zeros((1, self.hop_samples * 16), dtype=np.float32)
+            output_dict = forward(self.get_forward_model(pedal), x, 
+                batch_size=1, **self.get_forward_kwargs(pedal))
+            segment_frames = self.segment_samples // self.hop_samples + 1
+
+            self.skipped_output_dicts[pedal] = {key: np.zeros(
+                (segment_frames,) + output_dict[key].shape[2 :], 
+                dtype=output_dict[key].dtype) for key in output_dict.keys()}
+
+        return self.skipped_output_dicts[pedal]
+
+    def get_post_processor(self, incremental=False):
+        """Build the post processor selected by post_processor_type.
+
+        Args:
+          incremental: bool, build the block by block version of the 
+            regression post processor
+        """
+        if self.post_processor_type == 'regression':
+            """Proposed high-resolution regression post processing algorithm."""
+            PostProcessor = IncrementalRegressionPostProcessor if incremental \
+                else RegressionPostProcessor
+            post_processor = PostProcessor(self.frames_per_second, 
+                classes_num=self.classes_num, onset_threshold=self.onset_threshold, 
+                offset_threshold=self.offset_threshold, 
+                frame_threshold=self.frame_threshold, 
+                pedal_offset_threshold=self.pedal_offset_threshold)
+
+        elif self.post_processor_type == 'onsets_frames':
+            """Google's onsets and frames post processing algorithm. Only used 
+            for comparison."""
+            post_processor = OnsetsFramesPostProcessor(self.frames_per_second, 
+                self.classes_num)
+
+        return post_processor
+
+    def get_batch_size(self, segments_num):
+        """Resolve the configured batch size for a number of segments.
+
+        Args:
+          segments_num: int | None, None if unknown, e.g. when streaming
+
+        Returns:
+          batch_size: int
+        """
+        if self.batch_size == 'auto':
+            if segments_num is None:
+                # Unknown length, bound the audio held for one batch
+                segments_num = 32
+            return get_auto_batch_size(self.segment_samples, segments_num, 
+                self.device, self.memory_budget)
+        else:
+            return int(self.batch_size)
+
+    def get_segments_num(self, audio_len):
+        """Number of segments needed to cover audio_len samples."""
+        return max(int(np.ceil((audio_len - self.segment_samples) 
+            / self.segment_hop_samples)), 0) + 1
+
+    def get_frames_num(self, segments_num, segment_frames):
+        """Number of deframed frames of segments_num segments.
+
+        Args:
+          segments_num: int
+          segment_frames: int, frames of one segment output, including the 
+            extra frame caused by 'center=True'
+        """
+        if segments_num == 1:
+            return segment_frames
+        else:
+            hop_frames = self.segment_hop_samples // self.hop_samples
+            return (segments_num - 1) * hop_frames + segment_frames - 1
+
+    def get_kept_frames(self, segment_frames, n, segments_num):
+        """Frames [bgn, fin) of the n-th segment output kept by deframe(). 
+        Overlapping frames are split half-half between consecutive segments, 
+        the first and the last segments keep their outer edges.
+
+        Args:
+          segment_frames: int, including the extra frame caused by 'center=True'
+          n: int
+          segments_num: int
+
+        Returns:
+          (bgn, fin): (int, int)
+        """
+        if segments_num == 1:
+            return 0, segment_frames
+
+        segment_frames -= 1
+        """Remove an extra frame in the end of each segment caused by the
+        'center=True' argument when calculating spectrogram."""
+        hop_frames = self.segment_hop_samples // self.hop_samples
+        margin = (segment_frames - hop_frames) // 2
+
+        bgn = 0 if n == 0 else margin
+        fin = segment_frames if n == segments_num - 1 else margin + hop_frames
+        return bgn, fin
+
+    def enframe(self, x, segment_samples, hop_samples):
+        """Enframe long sequence to overlapping segments without copying.
+
+        Args:
+          x: (audio_samples,), contiguous
+          segment_samples: int
+          hop_samples: int
+
+        Returns:
+          batch: (N, segment_samples), a read-only strided view of x
+        """
+        assert (len(x) - segment_samples) % hop_samples == 0
+        segments_num = (len(x) - segment_samples) // hop_samples + 1
+
+        batch = np.lib.stride_tricks.as_strided(x, 
+            shape=(segments_num, segment_samples), 
+            strides=(hop_samples * x.strides[0], x.strides[0]), writeable=False)
         return batch
 
     def deframe(self, x):
@@ -170,23 +847,38 @@ class PianoTranscription(object):
         Returns:
           y: (audio_frames, classes_num)
         """
-        if x.shape[0] == 1:
-            return x[0]
+        (segments_num, segment_frames) = x.shape[0 : 2]
+        y = np.empty((self.get_frames_num(segments_num, segment_frames),) 
+            + x.shape[2 :], dtype=x.dtype)
 
-        else:
-            x = x[:, 0 : -1, :]
-            """Remove an extra frame in the end of each segment caused by the
-            'center=True' argument when calculating spectrogram."""
-            (N, segment_samples, classes_num) = x.shape
-            assert segment_samples % 4 == 0
+        for n in range(segments_num):
+            self.deframe_segment(y, x[n], n, segments_num)
+
+        return y
+
+    def deframe_segment(self, y, x, n, segments_num):
+        """Write the kept frames of the n-th segment output into y.
+
+        Args:
+          y: (audio_frames, classes_num), deframed output
+          x: (segment_frames, classes_num)
+          n: int
+          segments_num: int
+        """
+        (bgn, fin) = self.get_kept_frames(x.shape[0], n, segments_num)
+        hop_frames = self.segment_hop_samples // self.hop_samples
+        y[n * hop_frames + bgn : n * hop_frames + fin] = x[bgn : fin]
+
+
+def parse_batch_size(batch_size):
+    """Parse a batch size argument, either a positive integer or 'auto'."""
+    if batch_size == 'auto':
+        return batch_size
 
-            y = []
-            y.append(x[0, 0 : int(segment_samples * 0.75)])
-            for i in range(1, N - 1):
-                y.append(x[i, int(segment_samples * 0.25) : int(segment_samples * 0.75)])
-            y.append(x[-1, int(segment_samples * 0.25) :])
-            y = np.concatenate(y, axis=0)
-            return y
+    batch_size = int(batch_size)
+    if batch_size < 1:
+        raise ValueError('batch_size must be a positive integer or auto.')
+    return batch_size
 
 
 def inference(args):
@@ -200,6 +892,27 @@ def inference(args):
         with Googl's onsets and frames system.
       audio_path: str
       cuda: bool
+      batch_size: int | 'auto'
+      stream: bool, decode and transcribe block by block with bounded memory
+      segment_seconds: float
+      overlap: float
+      skip_inactive: bool
+      backend: 'torch' | 'onnxruntime'
+      precision: 'fp32' | 'int8'
+      pedal: bool, also transcribe sustain pedal events
+      parallel_branches: bool
+      shared_trunk: bool
+      res_type: str, resampler of the loaded audio
+      no_audio_cache: bool, decode the audio even if it is in the audio cache
+      offset: float, seconds of audio to skip
+      duration: float | None, seconds of audio to transcribe
+      save_activations: bool, also save the model outputs next to the MIDI file
+      from_activations: bool, post process the model outputs saved by an 
+        earlier run instead of running the model
+      onset_threshold: float
+      offset_threshold: float
+      frame_threshold: float
+      pedal_offset_threshold: float
     """
 
     # Arugments & parameters
@@ -208,31 +921,76 @@ def inference(args):
     post_processor_type = args.post_processor_type
     device = 'cuda' if args.cuda and torch.cuda.is_available() else 'cpu'
     audio_path = args.audio_path
+    batch_size = parse_batch_size(args.batch_size)
     
     sample_rate = config.sample_rate
-    segment_samples = sample_rate * 10  
-    """Split audio to multiple 10-second segments for inference"""
+    segment_samples = int(sample_rate * args.segment_seconds)
+    """Split audio to multiple overlapping segments for inference"""
 
     # Paths
     midi_path = 'results/{}.mid'.format(get_filename(audio_path))
+    activations_path = 'results/{}.npz'.format(get_filename(audio_path))
     create_folder(os.path.dirname(midi_path))
  
-    # Load audio
-    (audio, _) = load_audio(audio_path, sr=sample_rate, mono=True)
-
     # Transcriptor
     transcriptor = PianoTranscription(model_type, device=device, 
         checkpoint_path=checkpoint_path, segment_samples=segment_samples, 
-        post_processor_type=post_processor_type)
+        post_processor_type=post_processor_type, batch_size=batch_size, 
+        overlap=args.overlap, skip_inactive=args.skip_inactive, 
+        backend=args.backend, precision=args.precision, 
+        parallel_branches=args.parallel_branches, shared_trunk=args.shared_trunk, 
+        onset_threshold=args.onset_threshold, offset_threshold=args.offset_threshold, 
+        frame_threshold=args.frame_threshold, 
+        pedal_offset_threshold=args.pedal_offset_threshold, 
+        res_type=args.res_type)
+
+    if args.from_activations:
+        # Only post process, the model is not loaded
+        post_process_time = time.time()
+        transcriptor.transcribe_activations(activations_path, midi_path)
+        print('Post process time: {:.3f} s'.format(time.time() - post_process_time))
+        return
+
+    if args.stream:
+        if args.offset > 0 or args.duration is not None:
+            raise ValueError('--offset and --duration are not supported with --stream.')
+
+        # Decode, transcribe and post process block by block
+        transcribe_time = time.time()
+        note_events_list = []
+        pedal_events_list = []
+        audio_blocks = stream_audio(audio_path, sr=sample_rate, mono=True)
+
+        for (note_events, pedal_events) in transcriptor.transcribe_stream(
+            audio_blocks, pedal=args.pedal):
+            note_events_list.append(note_events)
+            pedal_events_list.append(pedal_events)
+
+        write_events_to_midi(start_time=0, 
+            note_events=NoteEvents.concatenate(note_events_list), 
+            pedal_events=PedalEvents.concatenate(pedal_events_list), 
+            midi_path=midi_path)
+        print('Write out to {}'.format(midi_path))
+        print('Transcribe time: {:.3f} s'.format(time.time() - transcribe_time))
+        return
+
+    # Load audio
+    audio = transcriptor.load_audio(audio_path, use_cache=not args.no_audio_cache, 
+        offset=args.offset, duration=args.duration)
 
     # Transcribe and write out to MIDI file
     transcribe_time = time.time()
-    transcribed_dict = transcriptor.transcribe(audio, midi_path)
+    transcribed_dict = transcriptor.transcribe(audio, midi_path, pedal=args.pedal, 
+        activations_path=activations_path if args.save_activations else None)
     print('Transcribe time: {:.3f} s'.format(time.time() - transcribe_time))
+    print('Skipped segments: {:.1%}'.format(transcribed_dict['skip_ratio']))
 
     # Visualize for debug
     plot = False
     if plot:
+        import matplotlib.pyplot as plt
+        import librosa
+
         output_dict = transcribed_dict['output_dict']
         fig, axs = plt.subplots(5, 1, figsize=(15, 8), sharex=True)
         mel = librosa.feature.melspectrogram(audio, sr=16000, n_fft=2048, hop_length=160, n_mels=229, fmin=30, fmax=8000)
@@ -262,6 +1020,46 @@ if __name__ == '__main__':
     parser.add_argument('--post_processor_type', type=str, default='regression', choices=['onsets_frames', 'regression'])
     parser.add_argument('--audio_path', type=str, required=True)
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--batch_size', type=str, default='1', 
+        help="Segments per forward pass, or 'auto' to fit available memory.")
+    parser.add_argument('--stream', action='store_true', default=False, 
+        help='Transcribe block by block with bounded memory.')
+    parser.add_argument('--segment_seconds', type=float, default=10.)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--skip_inactive', action='store_true', default=False, 
+        help='Do not forward segments without musical activity.')
+    parser.add_argument('--backend', type=str, default='torch', 
+        choices=['torch', 'onnxruntime'])
+    parser.add_argument('--precision', type=str, default='fp32', 
+        choices=['fp32', 'int8'])
+    parser.add_argument('--pedal', action='store_true', default=False, 
+        help='Also transcribe sustain pedal events.')
+    parser.add_argument('--parallel_branches', action='store_true', default=False, 
+        help='Run the acoustic branches of the note model concurrently '
+        '(opt-in, speed up not measured yet).')
+    parser.add_argument('--shared_trunk', action='store_true', default=False, 
+        help='Run the convolutional trunk once over the recording instead of '
+        'once per overlapping segment.')
+    parser.add_argument('--res_type', type=str, default='kaiser_best', 
+        help="Resampler, e.g. 'kaiser_best', 'kaiser_fast' or 'polyphase'. "
+        "--stream always uses 'polyphase'.")
+    parser.add_argument('--no_audio_cache', action='store_true', default=False, 
+        help='Decode the audio even if it is in the decoded audio cache.')
+    parser.add_argument('--offset', type=float, default=0., 
+        help='Seconds of audio to skip, MIDI times start at the offset. '
+        'Not supported with --stream.')
+    parser.add_argument('--duration', type=float, default=None, 
+        help='Seconds of audio to transcribe, to the end if not given.')
+    parser.add_argument('--save_activations', action='store_true', default=False, 
+        help='Also save the model outputs to results/, to post process them '
+        'again with --from_activations.')
+    parser.add_argument('--from_activations', action='store_true', default=False, 
+        help='Post process the saved model outputs of audio_path with the '
+        'given thresholds instead of running the model.')
+    parser.add_argument('--onset_threshold', type=float, default=0.3)
+    parser.add_argument('--offset_threshold', type=float, default=0.3)
+    parser.add_argument('--frame_threshold', type=float, default=0.1)
+    parser.add_argument('--pedal_offset_threshold', type=float, default=0.2)
 
     args = parser.parse_args()
     inference(args)
\ No newline at end of file
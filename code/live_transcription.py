@@ -0,0 +1,401 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import torch
+
+from inference import PianoTranscription
+from utilities import (create_folder, load_audio, write_events_to_midi, 
+    NoteEvents, PedalEvents)
+from pytorch_utils import forward
+import config
+
+
+def get_first_occurrences(keys):
+    """Mask of the first occurrence of each key.
+
+    Args:
+      keys: (N,)
+
+    Returns:
+      mask: (N,), bool
+    """
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[np.unique(keys, return_index=True)[1]] = True
+    return mask
+
+
+class LiveTranscription(object):
+    def __init__(self, transcriptor, window_seconds=3., hop_seconds=0.5,
+        lookahead_seconds=1.):
+        """Low latency transcription of audio that arrives in chunks, e.g. from
+        a sound card or a pipe.
+
+        The model is re-run on the last window_seconds of audio every
+        hop_seconds. Frames closer than lookahead_seconds to the newest sample
+        lack future context for the bidirectional GRUs, so they are only
+        committed once the stream has moved past them. A note is emitted as
+        soon as its offset is committed, so a note is reported about
+        lookahead_seconds + hop_seconds after it ends.
+
+        Args:
+          transcriptor: PianoTranscription
+          window_seconds: float, audio forwarded per run
+          hop_seconds: float, new audio between runs
+          lookahead_seconds: float, future context required before a frame is
+            committed. Larger values trade latency for accuracy.
+        """
+        self.transcriptor = transcriptor
+        self.sample_rate = config.sample_rate
+        self.frames_per_second = transcriptor.frames_per_second
+        self.hop_samples = self.sample_rate // self.frames_per_second
+
+        self.window_samples = int(round(window_seconds * self.sample_rate))
+        self.hop_window_samples = int(round(hop_seconds * self.sample_rate))
+        self.lookahead_frames = int(round(lookahead_seconds * self.frames_per_second))
+        self.lookahead_seconds = lookahead_seconds
+        self.hop_seconds = hop_seconds
+
+        if self.window_samples % self.hop_samples or \
+            self.hop_window_samples % self.hop_samples:
+            raise ValueError('window_seconds and hop_seconds must be multiples '
+                'of {} s.'.format(1. / self.frames_per_second))
+
+        if window_seconds <= hop_seconds + lookahead_seconds:
+            raise ValueError('window_seconds must be longer than hop_seconds + '
+                'lookahead_seconds.')
+
+        # Longest note of note_detection_with_onset_offset_regress() plus the
+        # peak picking neighbourhood of offsets
+        self.max_note_frames = 600 + 10
+        self.post_processor = transcriptor.get_post_processor()
+
+        # Audio of the last window plus samples not yet forwarded. Left padded
+        # with silence so that every run sees a full window.
+        self.audio = np.zeros(self.window_samples, dtype=np.float32)
+        self.pending_samples = 0
+        self.samples_num = 0
+
+        # Committed frames, frames_bgn and committed_fin are global frame indexes
+        self.frames_dict = None
+        self.frames_bgn = 0
+        self.committed_fin = 0
+        self.emitted_notes = np.zeros(0, dtype=np.int64)   # See post_process()
+        self.emitted_pedals = np.zeros(0, dtype=np.int64)
+
+        # Statistics
+        self.arrivals = []  # (samples_num, wall time) after each push
+        self.run_seconds = []
+        self.note_latencies = []    # Latencies of the notes of each post_process()
+
+    def push(self, chunk):
+        """Push a chunk of audio.
+
+        Args:
+          chunk: (chunk_samples,), float audio in [-1, 1] or int16 PCM at
+            config.sample_rate
+
+        Returns:
+          (est_note_events, est_pedal_events): NoteEvents and PedalEvents 
+            finalized by this chunk
+        """
+        if chunk.dtype == np.int16:
+            chunk = chunk / 32768.
+
+        self.audio = np.concatenate((self.audio, chunk.astype(np.float32)))
+        self.pending_samples += len(chunk)
+        self.samples_num += len(chunk)
+        self.arrivals.append((self.samples_num, time.time()))
+
+        note_events_list = []
+        pedal_events_list = []
+
+        while self.pending_samples >= self.hop_window_samples:
+            self.pending_samples -= self.hop_window_samples
+            window_fin = len(self.audio) - self.pending_samples
+            window = self.audio[window_fin - self.window_samples : window_fin]
+            fin_sample = self.samples_num - self.pending_samples
+
+            self.run(window, fin_sample, self.lookahead_frames)
+            (note_events, pedal_events) = self.post_process(final=False)
+            note_events_list.append(note_events)
+            pedal_events_list.append(pedal_events)
+
+        # Keep only the audio needed by the next window
+        self.audio = self.audio[-(self.window_samples + self.pending_samples) :]
+
+        return NoteEvents.concatenate(note_events_list), \
+            PedalEvents.concatenate(pedal_events_list)
+
+    def flush(self):
+        """End the stream. Commit all remaining frames and emit all remaining
+        events.
+
+        Returns:
+          (est_note_events, est_pedal_events)
+        """
+        pad_len = -self.samples_num % self.hop_samples
+        self.audio = np.concatenate((self.audio, np.zeros(pad_len, dtype=np.float32)))
+        window = self.audio[-self.window_samples :]
+        fin_sample = self.samples_num + pad_len
+
+        self.run(window, fin_sample, 0)
+        self.pending_samples = 0
+        return self.post_process(final=True)
+
+    def run(self, window, fin_sample, lookahead_frames):
+        """Forward a window of audio and commit its frames that are at least
+        lookahead_frames away from the end of the window.
+
+        Args:
+          window: (window_samples,)
+          fin_sample: int, global index of the sample after the window
+          lookahead_frames: int
+        """
+        run_time = time.time()
+        output_dict = forward(self.transcriptor.model, window[None, :],
+            batch_size=1)
+        self.run_seconds.append(time.time() - run_time)
+
+        window_bgn_frame = (fin_sample - self.window_samples) // self.hop_samples
+        commit_fin = fin_sample // self.hop_samples - lookahead_frames
+        local_bgn = self.committed_fin - window_bgn_frame
+        local_fin = commit_fin - window_bgn_frame
+
+        if local_fin <= local_bgn:
+            return
+
+        new_dict = {key: output_dict[key][0, local_bgn : local_fin]
+            for key in output_dict.keys()}
+
+        if self.frames_dict is None:
+            self.frames_dict = new_dict
+        else:
+            for key in self.frames_dict.keys():
+                self.frames_dict[key] = np.concatenate(
+                    (self.frames_dict[key], new_dict[key]), axis=0)
+
+        self.committed_fin = commit_fin
+
+    def post_process(self, final):
+        """Post process committed frames and emit events that can no longer
+        change. A note is final once its offset is committed with enough
+        neighbourhood for peak picking, or once it is longer than the longest
+        note the detector produces.
+
+        Args:
+          final: bool, emit all events regardless of whether they are closed
+
+        Returns:
+          (est_note_events, est_pedal_events): NoteEvents and PedalEvents, 
+            ordered by onset time
+        """
+        if self.frames_dict is None:
+            return NoteEvents(), PedalEvents()
+
+        window_dict = {key: self.frames_dict[key] for key in self.frames_dict.keys()}
+        (note_events, pedal_events) = \
+            self.post_processor.output_dict_to_midi_events(window_dict)
+
+        shift_time = self.frames_bgn / self.frames_per_second
+        closed_time = (self.committed_fin - 7) / self.frames_per_second
+        expired_time = (self.committed_fin - self.max_note_frames) / self.frames_per_second
+        now = time.time()
+
+        # Events are identified across runs by their onset in milliseconds, 
+        # and notes also by their key. Of events with the same identity only 
+        # the first one is emitted.
+        note_events = note_events.shift(shift_time)
+        note_keys = self.get_onset_ms(note_events) * 128 + note_events.midi_note
+        emit = ~np.isin(note_keys, self.emitted_notes) & (final | 
+            (note_events.offset_time < closed_time) | 
+            (note_events.onset_time < expired_time))
+        emit[emit] = get_first_occurrences(note_keys[emit])
+
+        est_note_events = note_events[emit].sort()
+        self.emitted_notes = np.concatenate((self.emitted_notes, note_keys[emit]))
+        self.note_latencies.append(now - self.get_arrival_times(
+            note_events.onset_time[emit]))
+
+        pedal_events = PedalEvents.from_dicts(pedal_events).shift(shift_time)
+        pedal_keys = self.get_onset_ms(pedal_events)
+        emit = ~np.isin(pedal_keys, self.emitted_pedals) & (final | 
+            (pedal_events.offset_time < closed_time))
+        emit[emit] = get_first_occurrences(pedal_keys[emit])
+
+        est_pedal_events = pedal_events[emit].sort()
+        self.emitted_pedals = np.concatenate((self.emitted_pedals, pedal_keys[emit]))
+
+        # Drop frames that can no longer affect unemitted notes
+        trim = self.committed_fin - self.max_note_frames - 10 - self.frames_bgn
+        if trim > 0:
+            for key in self.frames_dict.keys():
+                self.frames_dict[key] = self.frames_dict[key][trim :]
+            self.frames_bgn += trim
+
+            forget_time = self.frames_bgn / self.frames_per_second * 1000
+            self.emitted_notes = self.emitted_notes[
+                self.emitted_notes // 128 >= forget_time]
+            self.emitted_pedals = self.emitted_pedals[
+                self.emitted_pedals >= forget_time]
+
+        return est_note_events, est_pedal_events
+
+    def get_onset_ms(self, events):
+        """Onset times of events in integer milliseconds."""
+        return np.round(events.onset_time * 1000).astype(np.int64)
+
+    def get_arrival_times(self, onset_times):
+        """Wall time at which the audio of each onset time was pushed.
+
+        Args:
+          onset_times: (events_num,)
+
+        Returns:
+          arrival_times: (events_num,)
+        """
+        (samples_nums, times) = (np.array(column) for column in 
+            zip(*self.arrivals))
+        indexes = np.searchsorted(samples_nums, onset_times * self.sample_rate)
+        indexes = np.minimum(indexes, len(self.arrivals) - 1)
+        return times[indexes]
+
+    def report(self):
+        """Latency and throughput statistics of the stream so far.
+
+        Returns:
+          statistics: dict, e.g. {
+            'audio_seconds': 60.0,
+            'compute_seconds': 30.5,
+            'real_time_factor': 0.51,
+            'runs_num': 120,
+            'run_seconds_mean': 0.25,
+            'algorithmic_latency': 1.5,
+            'notes_num': 412,
+            'note_latency_mean': 1.92,
+            ...}
+        """
+        audio_seconds = self.samples_num / self.sample_rate
+        compute_seconds = float(np.sum(self.run_seconds))
+        latencies = np.concatenate([np.zeros(0)] + self.note_latencies)
+
+        statistics = {
+            'audio_seconds': audio_seconds,
+            'compute_seconds': compute_seconds,
+            'real_time_factor': compute_seconds / max(audio_seconds, 1e-8),
+            'runs_num': len(self.run_seconds),
+            'run_seconds_mean': float(np.mean(self.run_seconds)) if self.run_seconds else 0.,
+            'algorithmic_latency': self.lookahead_seconds + self.hop_seconds,
+            'notes_num': len(latencies)}
+
+        if len(latencies) > 0:
+            statistics['note_latency_mean'] = float(np.mean(latencies))
+            statistics['note_latency_p50'] = float(np.percentile(latencies, 50))
+            statistics['note_latency_p95'] = float(np.percentile(latencies, 95))
+            statistics['note_latency_max'] = float(np.max(latencies))
+
+        return statistics
+
+
+def read_pcm_chunks(file, chunk_samples):
+    """Read raw mono int16 PCM from a binary file object, e.g. stdin."""
+    while True:
+        data = file.read(chunk_samples * 2)
+        if not data:
+            break
+        data = data[0 : len(data) // 2 * 2]
+        yield np.frombuffer(data, dtype=np.int16)
+
+
+def read_audio_chunks(audio_path, chunk_samples, realtime):
+    """Read an audio file in chunks, optionally at the pace of playback."""
+    (audio, _) = load_audio(audio_path, sr=config.sample_rate, mono=True)
+    chunk_seconds = chunk_samples / config.sample_rate
+    start_time = time.time()
+
+    for n, pointer in enumerate(range(0, len(audio), chunk_samples)):
+        if realtime:
+            delay = start_time + n * chunk_seconds - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        yield audio[pointer : pointer + chunk_samples]
+
+
+def live(args):
+    """Transcribe a live stream and report latency and throughput.
+
+    Args:
+      model_type: str
+      checkpoint_path: str
+      audio_path: str | None, read raw mono int16 PCM at config.sample_rate
+        from stdin if None, e.g.
+        ffmpeg -i in.mp3 -f s16le -ac 1 -ar 16000 - | python live_transcription.py ...
+      realtime: bool, feed audio_path at the pace of playback
+      window_seconds: float
+      hop_seconds: float
+      lookahead_seconds: float
+      chunk_seconds: float
+      midi_path: str | None
+      cuda: bool
+    """
+    device = 'cuda' if args.cuda and torch.cuda.is_available() else 'cpu'
+    chunk_samples = int(args.chunk_seconds * config.sample_rate)
+
+    transcriptor = PianoTranscription(args.model_type, device=device,
+        checkpoint_path=args.checkpoint_path)
+
+    live_transcriptor = LiveTranscription(transcriptor,
+        window_seconds=args.window_seconds, hop_seconds=args.hop_seconds,
+        lookahead_seconds=args.lookahead_seconds)
+
+    if args.audio_path:
+        chunks = read_audio_chunks(args.audio_path, chunk_samples, args.realtime)
+    else:
+        chunks = read_pcm_chunks(sys.stdin.buffer, chunk_samples)
+
+    note_events_list = []
+    pedal_events_list = []
+
+    def _output(note_events, pedal_events):
+        for values in zip(note_events.onset_time, note_events.offset_time, 
+            note_events.midi_note.tolist(), note_events.velocity.tolist()):
+            print('{:.3f}\t{:.3f}\t{}\t{}'.format(*values))
+        note_events_list.append(note_events)
+        pedal_events_list.append(pedal_events)
+
+    for chunk in chunks:
+        _output(*live_transcriptor.push(chunk))
+
+    _output(*live_transcriptor.flush())
+
+    if args.midi_path:
+        create_folder(os.path.dirname(os.path.realpath(args.midi_path)))
+        write_events_to_midi(start_time=0, 
+            note_events=NoteEvents.concatenate(note_events_list),
+            pedal_events=PedalEvents.concatenate(pedal_events_list), 
+            midi_path=args.midi_path)
+        print('Write out to {}'.format(args.midi_path))
+
+    statistics = live_transcriptor.report()
+    for key in statistics.keys():
+        print('{}: {:.3f}'.format(key, statistics[key]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--model_type', type=str, default='Note_pedal')
+    parser.add_argument('--checkpoint_path', type=str, default=None)
+    parser.add_argument('--audio_path', type=str, default=None)
+    parser.add_argument('--realtime', action='store_true', default=False)
+    parser.add_argument('--window_seconds', type=float, default=3.)
+    parser.add_argument('--hop_seconds', type=float, default=0.5)
+    parser.add_argument('--lookahead_seconds', type=float, default=1.)
+    parser.add_argument('--chunk_seconds', type=float, default=0.1)
+    parser.add_argument('--midi_path', type=str, default=None)
+    parser.add_argument('--cuda', action='store_true', default=False)
+
+    args = parser.parse_args()
+    live(args)
@@ -0,0 +1,343 @@
+import os
+import time
+import inspect
+import threading
+
+import torch
+
+from pytorch_utils import load_safetensors, assign_state_dict
+import config
+
+
+def get_scripted_path(checkpoint_path, model_type):
+    """Path of the TorchScript model exported from a checkpoint."""
+    return '{}_{}_scripted.pt'.format(os.path.splitext(checkpoint_path)[0], 
+        model_type)
+
+
+def get_onnx_path(checkpoint_path, model_type):
+    """Path of the ONNX model exported from a checkpoint."""
+    return '{}_{}.onnx'.format(os.path.splitext(checkpoint_path)[0], model_type)
+
+
+def get_safetensors_path(checkpoint_path):
+    """Path of the memory-mappable weights converted from a checkpoint."""
+    return '{}.safetensors'.format(os.path.splitext(checkpoint_path)[0])
+
+
+def is_up_to_date(path, checkpoint_path):
+    """Whether an artifact derived from a checkpoint exists and is not older 
+    than the checkpoint. Artifacts may also be shipped without the checkpoint."""
+    return os.path.exists(path) and (not os.path.exists(checkpoint_path) or 
+        os.path.getmtime(path) >= os.path.getmtime(checkpoint_path))
+
+
+def is_scripted(model_type, checkpoint_path, device, precision='fp32', 
+    backend='torch'):
+    """Whether load_model() loads the exported TorchScript model for a 
+    configuration rather than the PyTorch model."""
+    return backend == 'torch' and precision == 'fp32' and \
+        'cuda' not in str(device) and \
+        is_up_to_date(get_scripted_path(checkpoint_path, model_type), 
+            checkpoint_path)
+
+
+def get_quantized_path(checkpoint_path):
+    """Path of the int8 checkpoint written by combine_note_and_pedal_models.py."""
+    return '{}_int8.pth'.format(os.path.splitext(checkpoint_path)[0])
+
+
+def quantize_model(model):
+    """Dynamic int8 quantization of the fully connected and GRU layers, which 
+    hold most of the parameters of the CRNN models. Weights are stored in int8 
+    and activations are quantized on the fly, convolutions stay in fp32.
+
+    Args:
+      model: nn.Module, fp32 model on CPU
+
+    Returns:
+      model: nn.Module
+    """
+    return torch.quantization.quantize_dynamic(model, 
+        {torch.nn.Linear, torch.nn.GRU}, dtype=torch.qint8)
+
+
+class OnnxruntimeModel(torch.nn.Module):
+    def __init__(self, onnx_path, threads=None):
+        """Run an exported ONNX model with onnxruntime behind the interface of
+        the PyTorch models, so that forward() and PianoTranscription work 
+        unchanged.
+
+        Args:
+          onnx_path: str
+          threads: int | None, intra-op threads, None for onnxruntime default
+        """
+        super(OnnxruntimeModel, self).__init__()
+
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(onnx_path, options, 
+            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def forward(self, input):
+        """
+        Args:
+          input: (batch_size, data_length)
+
+        Outputs:
+          output_dict: dict, {'reg_onset_output': (batch_size, time_steps, 
+            classes_num), ...}
+        """
+        outputs = self.session.run(self.output_names, 
+            {self.input_name: input.detach().cpu().numpy()})
+
+        output_dict = {}
+        for (name, output) in zip(self.output_names, outputs):
+            output_dict[name] = torch.from_numpy(output)
+
+        return output_dict
+
+
+def load_model(model_type, checkpoint_path, device, precision='fp32', 
+    backend='torch', scripted=True, mmap=True):
+    """Build a transcription model and load its checkpoint. On CPU, a 
+    TorchScript model exported by export_model.py is loaded instead when it is
+    newer than the checkpoint. Otherwise weights converted by export_model.py 
+    safetensors are memory mapped instead of unpickling the checkpoint.
+
+    Args:
+      model_type: str, name of a model class in models.py, e.g. 'Note_pedal'
+      checkpoint_path: str
+      device: 'cuda' | 'cpu'
+      precision: 'fp32' | 'int8'. int8 applies dynamic quantization on CPU and
+        loads the quantized checkpoint instead when it is newer than the 
+        checkpoint.
+      backend: 'torch' | 'onnxruntime'. onnxruntime runs the model exported by
+        export_model.py onnx on CPU.
+      scripted: bool, use an exported TorchScript model if there is one
+      mmap: bool, use memory-mapped weights if there are
+
+    Returns:
+      model: nn.Module, wrapped in DataParallel on GPU
+    """
+    if precision not in ['fp32', 'int8']:
+        raise ValueError('Unsupported precision: {}'.format(precision))
+
+    if precision == 'int8' and ('cuda' in str(device) or backend != 'torch'):
+        raise ValueError('int8 precision is only supported by the torch backend '
+            'on CPU.')
+
+    if backend == 'onnxruntime':
+        onnx_path = get_onnx_path(checkpoint_path, model_type)
+
+        if not os.path.exists(onnx_path):
+            raise Exception(f"ONNX model not found at {onnx_path}, export it "
+                "with export_model.py onnx")
+
+        print('Using onnxruntime, ONNX model {}.'.format(onnx_path))
+        return OnnxruntimeModel(onnx_path)
+
+    elif backend != 'torch':
+        raise ValueError('Unsupported backend: {}'.format(backend))
+
+    if scripted and is_scripted(model_type, checkpoint_path, device, precision, 
+        backend):
+        scripted_path = get_scripted_path(checkpoint_path, model_type)
+        model = torch.jit.load(scripted_path, map_location='cpu')
+        print('Using CPU, TorchScript model {}.'.format(scripted_path))
+        return model
+
+    # Build model. Exported models above do not need models.py and its 
+    # torchlibrosa frontend.
+    import models
+
+    Model = getattr(models, model_type)
+    model = Model(frames_per_second=config.frames_per_second,
+        classes_num=config.classes_num)
+
+    quantized_path = get_quantized_path(checkpoint_path)
+
+    # A quantized checkpoint older than the checkpoint is stale, the fresh 
+    # checkpoint is quantized below instead
+    if precision == 'int8' and is_up_to_date(quantized_path, checkpoint_path):
+        model = quantize_model(model)
+
+        # Packed int8 weights are pickled as script objects, which newer 
+        # PyTorch only unpickles with weights_only=False
+        kwargs = {}
+        if 'weights_only' in inspect.signature(torch.load).parameters:
+            kwargs['weights_only'] = False
+
+        checkpoint = torch.load(quantized_path, map_location='cpu', **kwargs)
+        model.load_state_dict(checkpoint['model'], strict=False)
+        model.eval()
+        print('Using CPU, int8 checkpoint {}.'.format(quantized_path))
+        return model
+
+    safetensors_path = get_safetensors_path(checkpoint_path)
+
+    if mmap and is_up_to_date(safetensors_path, checkpoint_path):
+        # Parameters are views of the page cache, shared between processes
+        assign_state_dict(model, load_safetensors(safetensors_path))
+        model.eval()
+        print('Using memory-mapped weights {}.'.format(safetensors_path))
+
+    else:
+        # check if checkpoint exists
+        if not os.path.exists(checkpoint_path):
+            raise Exception(f"Checkpoint file not found at {checkpoint_path}")
+
+        # Load model
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model'], strict=False)
+        model.eval()
+
+    if precision == 'int8':
+        print('Using CPU, int8 dynamic quantization.')
+        return quantize_model(model)
+
+    # Parallel
+    if 'cuda' in str(device):
+        model.to(device)
+        print('GPU number: {}'.format(torch.cuda.device_count()))
+        model = torch.nn.DataParallel(model)
+    else:
+        print('Using CPU.')
+
+    return model
+
+
+def get_model_bytes(model):
+    """Memory taken by the parameters and buffers of a model."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelRegistry(object):
+    def __init__(self, idle_seconds=600., max_bytes=None):
+        """Process-wide pool of loaded models. Models are loaded lazily on
+        first use, shared by every caller that asks for the same
+        (model_type, checkpoint_path, device, precision, backend, scripted), 
+        and released when they have been idle for idle_seconds or when the pool 
+        exceeds max_bytes, least recently used first.
+
+        A released model stays alive as long as a caller holds a reference to
+        it; the registry only stops sharing it.
+
+        Args:
+          idle_seconds: float | None, None to never release idle models
+          max_bytes: int | None, memory cap of the parameters of all models
+        """
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.entries = {}   # key -> {'model':, 'bytes':, 'last_used':}
+        self.lock = threading.RLock()
+        self.key_locks = {}
+        self.sweeper = None
+
+    def get(self, model_type, checkpoint_path, device='cpu', precision='fp32', 
+        backend='torch', scripted=True):
+        """Return the shared model for a configuration, loading it if needed.
+
+        Args:
+          model_type: str
+          checkpoint_path: str
+          device: 'cuda' | 'cpu'
+          precision: str
+          backend: 'torch' | 'onnxruntime'
+          scripted: bool, allow an exported TorchScript model, see 
+            load_model(). False for the eager PyTorch model, which is needed 
+            by forward arguments and methods that the export does not have.
+
+        Returns:
+          model: nn.Module
+        """
+        # Without an exported model both requests share the PyTorch model
+        scripted = scripted and is_scripted(model_type, checkpoint_path, 
+            device, precision, backend)
+
+        key = (model_type, os.path.realpath(checkpoint_path), str(device),
+            precision, backend, scripted)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests of the same model wait for a single load
+        with key_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    entry['last_used'] = time.time()
+                    return entry['model']
+
+            model = load_model(model_type, checkpoint_path, device, precision, 
+                backend, scripted=scripted)
+
+            with self.lock:
+                self.entries[key] = {
+                    'model': model,
+                    'bytes': get_model_bytes(model),
+                    'last_used': time.time()}
+                self.evict(keep=key)
+                self.start_sweeper()
+
+            return model
+
+    def evict(self, keep=None):
+        """Release idle models and, if the memory cap is exceeded, least
+        recently used models.
+
+        Args:
+          keep: tuple | None, key that must not be released
+        """
+        with self.lock:
+            now = time.time()
+
+            if self.idle_seconds is not None:
+                for key in list(self.entries.keys()):
+                    if key != keep and \
+                        now - self.entries[key]['last_used'] > self.idle_seconds:
+                        del self.entries[key]
+
+            if self.max_bytes is not None:
+                keys = sorted(self.entries.keys(),
+                    key=lambda key: self.entries[key]['last_used'])
+
+                for key in keys:
+                    if self.get_bytes() <= self.max_bytes:
+                        break
+                    if key != keep:
+                        del self.entries[key]
+
+    def get_bytes(self):
+        """Memory taken by the parameters of all shared models."""
+        with self.lock:
+            return sum(entry['bytes'] for entry in self.entries.values())
+
+    def clear(self):
+        """Release all models."""
+        with self.lock:
+            self.entries = {}
+
+    def start_sweeper(self):
+        """Start a daemon thread that releases idle models periodically."""
+        if self.idle_seconds is None or self.sweeper is not None:
+            return
+
+        def _sweep():
+            while True:
+                time.sleep(max(min(self.idle_seconds / 2, 60.), 1.))
+                self.evict()
+
+        self.sweeper = threading.Thread(target=_sweep, daemon=True)
+        self.sweeper.start()
+
+
+registry = ModelRegistry(idle_seconds=config.model_idle_seconds,
+    max_bytes=config.model_max_bytes)
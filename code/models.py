@@ -2,8 +2,9 @@ import os
 import sys
 import math
 import time
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -56,6 +57,40 @@ def init_gru(rnn):
         torch.nn.init.constant_(getattr(rnn, 'bias_hh_l{}'.format(i)), 0)
 
 
+_branch_executor = None
+_branch_executor_lock = threading.Lock()
+
+
+def run_branches(branches, x):
+    """Run independent branches on the same input concurrently. PyTorch 
+    releases the GIL inside operators, so the branches overlap on a 
+    multi-core CPU. Gradient mode is thread local and is carried over to the 
+    worker threads.
+
+    Args:
+      branches: list of nn.Module
+      x: tensor, input of every branch
+
+    Returns:
+      outputs: list, output of each branch
+    """
+    global _branch_executor
+
+    with _branch_executor_lock:
+        if _branch_executor is None:
+            _branch_executor = ThreadPoolExecutor(max_workers=4, 
+                thread_name_prefix='branch')
+
+    grad_enabled = torch.is_grad_enabled()
+
+    def _run(branch):
+        with torch.set_grad_enabled(grad_enabled):
+            return branch(x)
+
+    futures = [_branch_executor.submit(_run, branch) for branch in branches]
+    return [future.result() for future in futures]
+
+
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, momentum):
         
@@ -134,7 +169,18 @@ class AcousticModelCRnn8Dropout(nn.Module):
         Outputs:
           output: (batch_size, time_steps, classes_num)
         """
+        return self.forward_sequence(self.forward_frames(input))
+
+    def forward_frames(self, input):
+        """Convolutional trunk and fc5. Each output frame only depends on a few 
+        neighbouring input frames.
 
+        Args:
+          input: (batch_size, channels_num, time_steps, freq_bins)
+
+        Outputs:
+          output: (batch_size, time_steps, 768)
+        """
         x = self.conv_block1(input, pool_size=(1, 2), pool_type='avg')
         x = F.dropout(x, p=0.2, training=self.training)
         x = self.conv_block2(x, pool_size=(1, 2), pool_type='avg')
@@ -147,8 +193,18 @@ class AcousticModelCRnn8Dropout(nn.Module):
         x = x.transpose(1, 2).flatten(2)
         x = F.relu(self.bn5(self.fc5(x).transpose(1, 2)).transpose(1, 2))
         x = F.dropout(x, p=0.5, training=self.training, inplace=True)
-        
-        (x, _) = self.gru(x)
+        return x
+
+    def forward_sequence(self, input):
+        """Recurrent part, depends on the whole sequence.
+
+        Args:
+          input: (batch_size, time_steps, 768), output of forward_frames()
+
+        Outputs:
+          output: (batch_size, time_steps, classes_num)
+        """
+        (x, _) = self.gru(input)
         x = F.dropout(x, p=0.5, training=self.training, inplace=False)
         output = torch.sigmoid(self.fc(x))
         return output
@@ -209,10 +265,11 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
         init_layer(self.reg_onset_fc)
         init_layer(self.frame_fc)
  
-    def forward(self, input):
+    def forward(self, input, parallel=False):
         """
         Args:
           input: (batch_size, data_length)
+          parallel: bool, run the four acoustic branches concurrently
 
         Outputs:
           output_dict: dict, {
@@ -222,19 +279,91 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
             'velocity_output': (batch_size, time_steps, classes_num)
           }
         """
+        return self.forward_logmel(self.extract_logmel(input), parallel)
+
+    def extract_logmel(self, input):
+        """
+        Args:
+          input: (batch_size, data_length)
 
+        Outputs:
+          output: (batch_size, 1, time_steps, mel_bins)
+        """
         x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
         x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        return x
 
+    def forward_logmel(self, x, parallel=False):
+        """
+        Args:
+          x: (batch_size, 1, time_steps, mel_bins), output of extract_logmel()
+          parallel: bool
+
+        Outputs:
+          output_dict: dict, same as forward()
+        """
         x = x.transpose(1, 3)
         x = self.bn0(x)
         x = x.transpose(1, 3)
 
-        frame_output = self.frame_model(x)  # (batch_size, time_steps, classes_num)
-        reg_onset_output = self.reg_onset_model(x)  # (batch_size, time_steps, classes_num)
-        reg_offset_output = self.reg_offset_model(x)    # (batch_size, time_steps, classes_num)
-        velocity_output = self.velocity_model(x)    # (batch_size, time_steps, classes_num)
- 
+        # The branches are independent until the conditioning GRUs
+        if parallel:
+            branch_outputs = run_branches(self.get_branches(), x)
+        else:
+            branch_outputs = [branch(x) for branch in self.get_branches()]
+
+        return self.forward_heads(*branch_outputs)
+
+    def forward_trunk(self, input):
+        """Frontend and convolutional trunks of the four branches. Frames only 
+        depend on their neighbourhood, so the trunk can run once over a whole 
+        recording and be cut into overlapping windows for forward_windows().
+
+        Args:
+          input: (batch_size, data_length)
+
+        Outputs:
+          output: (batch_size, time_steps, 4, 768)
+        """
+        x = self.extract_logmel(input)
+        x = x.transpose(1, 3)
+        x = self.bn0(x)
+        x = x.transpose(1, 3)
+
+        return torch.stack([branch.forward_frames(x) 
+            for branch in self.get_branches()], dim=2)
+
+    def forward_windows(self, input):
+        """Recurrent parts on windows of forward_trunk() outputs.
+
+        Args:
+          input: (batch_size, time_steps, 4, 768)
+
+        Outputs:
+          output_dict: dict, same as forward()
+        """
+        branch_outputs = [branch.forward_sequence(input[:, :, k]) 
+            for (k, branch) in enumerate(self.get_branches())]
+
+        return self.forward_heads(*branch_outputs)
+
+    def get_branches(self):
+        return [self.frame_model, self.reg_onset_model, self.reg_offset_model, 
+            self.velocity_model]
+
+    def forward_heads(self, frame_output, reg_onset_output, reg_offset_output, 
+        velocity_output):
+        """Conditioning GRUs on the outputs of the four acoustic branches.
+
+        Args:
+          frame_output: (batch_size, time_steps, classes_num)
+          reg_onset_output: (batch_size, time_steps, classes_num)
+          reg_offset_output: (batch_size, time_steps, classes_num)
+          velocity_output: (batch_size, time_steps, classes_num)
+
+        Outputs:
+          output_dict: dict, same as forward()
+        """
         # Use velocities to condition onset regression
         x = torch.cat((reg_onset_output, (reg_onset_output ** 0.5) * velocity_output.detach()), dim=2)
         (x, _) = self.reg_onset_gru(x)
@@ -307,16 +436,33 @@ class Regress_pedal_CRNN(nn.Module):
 
         Outputs:
           output_dict: dict, {
-            'reg_onset_output': (batch_size, time_steps, classes_num),
-            'reg_offset_output': (batch_size, time_steps, classes_num),
-            'frame_output': (batch_size, time_steps, classes_num),
-            'velocity_output': (batch_size, time_steps, classes_num)
+            'reg_pedal_onset_output': (batch_size, time_steps, 1),
+            'reg_pedal_offset_output': (batch_size, time_steps, 1),
+            'pedal_frame_output': (batch_size, time_steps, 1)
           }
         """
+        return self.forward_logmel(self.extract_logmel(input))
 
+    def extract_logmel(self, input):
+        """
+        Args:
+          input: (batch_size, data_length)
+
+        Outputs:
+          output: (batch_size, 1, time_steps, mel_bins)
+        """
         x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
         x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        return x
+
+    def forward_logmel(self, x):
+        """
+        Args:
+          x: (batch_size, 1, time_steps, mel_bins), output of extract_logmel()
 
+        Outputs:
+          output_dict: dict, same as forward()
+        """
         x = x.transpose(1, 3)
         x = self.bn0(x)
         x = x.transpose(1, 3)
@@ -347,11 +493,35 @@ class Note_pedal(nn.Module):
         self.note_model.load_state_dict(m['note_model'], strict=strict)
         self.pedal_model.load_state_dict(m['pedal_model'], strict=strict)
 
-    def forward(self, input):
-        note_output_dict = self.note_model(input)
-        #pedal_output_dict = self.pedal_model(input)
+    def forward(self, input, pedal=False, parallel=False):
+        """
+        Args:
+          input: (batch_size, data_length)
+          pedal: bool, also run the pedal model. Both models have the same 
+            frozen spectrogram and log mel frontend, so the log mel is computed
+            once and fed to both.
+          parallel: bool, run the acoustic branches of the note model 
+            concurrently
+
+        Outputs:
+          output_dict: dict, outputs of the note model, and of the pedal model 
+            if pedal is True
+        """
+        x = self.note_model.extract_logmel(input)
+        """(batch_size, 1, time_steps, mel_bins)"""
 
         full_output_dict = {}
-        full_output_dict.update(note_output_dict)
-        #full_output_dict.update(pedal_output_dict)
-        return full_output_dict
\ No newline at end of file
+        full_output_dict.update(self.note_model.forward_logmel(x, parallel))
+
+        if pedal:
+            full_output_dict.update(self.pedal_model.forward_logmel(x))
+
+        return full_output_dict
+
+    def forward_trunk(self, input):
+        """See Regress_onset_offset_frame_velocity_CRNN.forward_trunk()."""
+        return self.note_model.forward_trunk(input)
+
+    def forward_windows(self, input):
+        """See Regress_onset_offset_frame_velocity_CRNN.forward_windows()."""
+        return self.note_model.forward_windows(input)
\ No newline at end of file
@@ -132,6 +132,263 @@ def pedal_detection_with_onset_offset_regress(frame_output, offset_output,
     return output_tuples
 
 
+def compile_function(func):
+    """Compile a detection function with numba if it is installed, otherwise 
+    return it unchanged. numba is imported on first use, because importing it
+    is slow, and compiled functions are cached on disk.
+
+    Args:
+      func: function
+
+    Returns:
+      func: function
+    """
+    try:
+        import numba
+    except ImportError:
+        return func
+
+    return numba.njit(cache=True)(func)
+
+
+def _note_detection_all_keys(frame_output, onset_output, onset_shift_output, 
+    offset_output, offset_shift_output, velocity_output, frame_threshold, 
+    positions, values, frame_bgn, last):
+    """Same state machine as note_detection_with_onset_offset_regress(), run 
+    for all keys in one pass over a block of frames. The state of each key is
+    carried across blocks in positions, (3, classes_num), the bgn, 
+    frame_disappear and offset_occur frames, and values, (4, classes_num), 
+    the onset shift and velocity at bgn and the offset shifts at 
+    frame_disappear and offset_occur. Frames are numbered from the start of 
+    the recording, and a position of 0 stands for None, as the truth tests of
+    the frame by frame version treat frame 0 as None."""
+    (frames_num, classes_num) = onset_output.shape
+    bgn = positions[0]
+    frame_disappear = positions[1]
+    offset_occur = positions[2]
+
+    keys = []
+    bgns = []
+    fins = []
+    onset_shifts = []
+    offset_shifts = []
+    velocities = []
+
+    for j in range(frames_num):
+        i = frame_bgn + j
+
+        for k in range(classes_num):
+            if onset_output[j, k] == 1:
+                """Onset detected"""
+                if bgn[k]:
+                    """Consecutive onsets"""
+                    keys.append(k)
+                    bgns.append(bgn[k])
+                    fins.append(max(i - 1, 0))
+                    onset_shifts.append(values[0, k])
+                    offset_shifts.append(0.)
+                    velocities.append(values[1, k])
+                    frame_disappear[k] = 0
+                    offset_occur[k] = 0
+                bgn[k] = i
+                values[0, k] = onset_shift_output[j, k]
+                values[1, k] = velocity_output[j, k]
+
+            if bgn[k] and i > bgn[k]:
+                """If onset found, then search offset"""
+                if frame_output[j, k] <= frame_threshold and not frame_disappear[k]:
+                    """Frame disappear detected"""
+                    frame_disappear[k] = i
+                    values[2, k] = offset_shift_output[j, k]
+
+                if offset_output[j, k] == 1 and not offset_occur[k]:
+                    """Offset detected"""
+                    offset_occur[k] = i
+                    values[3, k] = offset_shift_output[j, k]
+
+                fin = -1
+
+                if frame_disappear[k]:
+                    if offset_occur[k] and offset_occur[k] - bgn[k] > \
+                        frame_disappear[k] - offset_occur[k]:
+                        (fin, offset_shift) = (offset_occur[k], values[3, k])
+                    else:
+                        (fin, offset_shift) = (frame_disappear[k], values[2, k])
+
+                elif i - bgn[k] >= 600 or (last and j == frames_num - 1):
+                    """Offset not detected"""
+                    (fin, offset_shift) = (i, np.float64(offset_shift_output[j, k]))
+
+                if fin >= 0:
+                    keys.append(k)
+                    bgns.append(bgn[k])
+                    fins.append(fin)
+                    onset_shifts.append(values[0, k])
+                    offset_shifts.append(offset_shift)
+                    velocities.append(values[1, k])
+                    bgn[k] = 0
+                    frame_disappear[k] = 0
+                    offset_occur[k] = 0
+
+    return (np.array(keys, dtype=np.int64), np.array(bgns, dtype=np.int64), 
+        np.array(fins, dtype=np.int64), np.array(onset_shifts, dtype=np.float64), 
+        np.array(offset_shifts, dtype=np.float64), 
+        np.array(velocities, dtype=np.float64))
+
+
+def _pedal_detection(frame_output, offset_output, offset_shift_output, 
+    frame_threshold, positions, values, frame_bgn):
+    """Same state machine as pedal_detection_with_onset_offset_regress() over 
+    a block of frames. The state is carried across blocks in positions, (3,), 
+    the bgn, frame_disappear and offset_occur frames, and values, (3,), the 
+    previous frame output and the offset shifts at frame_disappear and 
+    offset_occur. Positions of 0 stand for None."""
+    bgns = []
+    fins = []
+    offset_shifts = []
+
+    for j in range(frame_output.shape[0]):
+        i = frame_bgn + j
+        previous = values[0]
+        values[0] = frame_output[j]
+
+        if i == 0:
+            continue
+
+        if frame_output[j] >= frame_threshold and frame_output[j] > previous:
+            """Pedal onset detected"""
+            if not positions[0]:
+                positions[0] = i
+
+        if positions[0] and i > positions[0]:
+            """If onset found, then search offset"""
+            if frame_output[j] <= frame_threshold and not positions[1]:
+                """Frame disappear detected"""
+                positions[1] = i
+                values[1] = offset_shift_output[j]
+
+            if offset_output[j] == 1 and not positions[2]:
+                """Offset detected"""
+                positions[2] = i
+                values[2] = offset_shift_output[j]
+
+            fin = -1
+
+            if positions[2]:
+                (fin, offset_shift) = (positions[2], values[2])
+
+            elif positions[1] and i - positions[1] >= 10:
+                """offset not detected but frame disappear"""
+                (fin, offset_shift) = (positions[1], values[1])
+
+            if fin >= 0:
+                bgns.append(positions[0])
+                fins.append(fin)
+                offset_shifts.append(offset_shift)
+                positions[0] = 0
+                positions[1] = 0
+                positions[2] = 0
+
+    return (np.array(bgns, dtype=np.int64), np.array(fins, dtype=np.int64), 
+        np.array(offset_shifts, dtype=np.float64))
+
+
+compiled_functions = {}
+
+
+def get_compiled_function(func):
+    if func not in compiled_functions:
+        compiled_functions[func] = compile_function(func)
+    return compiled_functions[func]
+
+
+def get_note_detection_state(classes_num):
+    """Detection state of note_detection_with_onset_offset_regress_all_keys() 
+    before the first frame of a recording."""
+    return {'positions': np.zeros((3, classes_num), dtype=np.int64), 
+        'values': np.zeros((4, classes_num), dtype=np.float64), 
+        'frame_bgn': 0}
+
+
+def get_pedal_detection_state():
+    """Detection state of pedal_detection_with_onset_offset_regress_compiled()
+    before the first frame of a recording."""
+    return {'positions': np.zeros(3, dtype=np.int64), 
+        'values': np.zeros(3, dtype=np.float64), 
+        'frame_bgn': 0}
+
+
+def note_detection_with_onset_offset_regress_all_keys(frame_output, 
+    onset_output, onset_shift_output, offset_output, offset_shift_output, 
+    velocity_output, frame_threshold, state=None, last=True):
+    """Compiled note_detection_with_onset_offset_regress() of all keys in one 
+    pass over the frames. Returns the same tuples as calling it key by key. 
+    With a state, a recording can be processed block by block: notes are 
+    returned by the block in which they close.
+
+    Args:
+      frame_output: (frames_num, classes_num)
+      onset_output: (frames_num, classes_num)
+      onset_shift_output: (frames_num, classes_num)
+      offset_output: (frames_num, classes_num)
+      offset_shift_output: (frames_num, classes_num)
+      velocity_output: (frames_num, classes_num)
+      frame_threshold: float
+      state: dict | None, from get_note_detection_state(), updated in place. 
+        None to process a whole recording.
+      last: bool, the block ends the recording, which closes notes still on 
+        at its last frame
+
+    Returns:
+      output_tuples: (notes, 5), the columns are bgn, fin, onset_shift, 
+        offset_shift and normalized_velocity, ordered by key and then by bgn. 
+        Frames are numbered from the start of the recording.
+      keys: (notes,), key index of each note
+    """
+    if state is None:
+        state = get_note_detection_state(onset_output.shape[-1])
+
+    func = get_compiled_function(_note_detection_all_keys)
+
+    # The threshold has the dtype of frame_output, as the frame by frame 
+    # version compares numpy scalars with a Python float in that dtype
+    (keys, bgns, fins, onset_shifts, offset_shifts, velocities) = func(
+        *[np.ascontiguousarray(x) for x in [frame_output, onset_output, 
+        onset_shift_output, offset_output, offset_shift_output, 
+        velocity_output]], frame_output.dtype.type(frame_threshold), 
+        state['positions'], state['values'], state['frame_bgn'], last)
+
+    state['frame_bgn'] += len(onset_output)
+
+    order = np.lexsort((bgns, keys))
+    output_tuples = np.stack((bgns, fins, onset_shifts, offset_shifts, 
+        velocities), axis=-1)[order]
+
+    return output_tuples, keys[order]
+
+
+def pedal_detection_with_onset_offset_regress_compiled(frame_output, 
+    offset_output, offset_shift_output, frame_threshold, state=None):
+    """Compiled pedal_detection_with_onset_offset_regress(), same arguments 
+    and tuples. With a state from get_pedal_detection_state(), a recording can
+    be processed block by block."""
+    if state is None:
+        state = get_pedal_detection_state()
+
+    func = get_compiled_function(_pedal_detection)
+
+    (bgns, fins, offset_shifts) = func(np.ascontiguousarray(frame_output), 
+        np.ascontiguousarray(offset_output), 
+        np.ascontiguousarray(offset_shift_output), 
+        frame_output.dtype.type(frame_threshold), 
+        state['positions'], state['values'], state['frame_bgn'])
+
+    state['frame_bgn'] += len(frame_output)
+
+    return [[bgn, fin, 0., offset_shift] for (bgn, fin, offset_shift) in 
+        zip(bgns.tolist(), fins.tolist(), offset_shifts.tolist())]
+
+
 ###### Google's onsets and frames post processing. Only used for comparison ######
 def onsets_frames_note_detection(frame_output, onset_output, offset_output, 
     velocity_output, threshold):
@@ -170,7 +427,15 @@ def onsets_frames_note_detection(frame_output, onset_output, offset_output,
     return output_tuples
 
 
-def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold):
+def get_onsets_frames_pedal_detection_state():
+    """Detection state of onsets_frames_pedal_detection() before the first 
+    frame of a recording."""
+    return {'bgn': None, 'frame_disappear': None, 'offset_occur': None, 
+        'previous': None, 'frame_bgn': 0}
+
+
+def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold, 
+    state=None):
     """Process pedal prediction matrices to pedal events information.
     
     Args:
@@ -178,21 +443,37 @@ def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold):
       offset_output: (frames_num,)
       offset_shift_output: (frames_num,)
       frame_threshold: float
+      state: dict | None, from get_onsets_frames_pedal_detection_state(), 
+        updated in place, to process a recording block by block. Detection 
+        only looks back one frame, so pedals are returned by the block in 
+        which they end and are the same as for the whole recording. None to 
+        process a whole recording.
 
     Returns: 
-      output_tuples: list of [bgn, fin], 
-      e.g., [
+      output_tuples: list of [bgn, fin], frames are numbered from the start of
+      the recording, e.g., [
         [1821, 1909], 
         [1909, 1947], 
         ...]
     """
+    if state is None:
+        state = get_onsets_frames_pedal_detection_state()
+
     output_tuples = []
-    bgn = None
-    frame_disappear = None
-    offset_occur = None
+    bgn = state['bgn']
+    frame_disappear = state['frame_disappear']
+    offset_occur = state['offset_occur']
+    previous = state['previous']
 
-    for i in range(1, frame_output.shape[0]):
-        if frame_output[i] >= frame_threshold and frame_output[i] > frame_output[i - 1]:
+    for j in range(frame_output.shape[0]):
+        i = state['frame_bgn'] + j
+        (previous, current) = (frame_output[j - 1] if j > 0 else previous, 
+            frame_output[j])
+
+        if i == 0:
+            continue
+
+        if current >= frame_threshold and current > previous:
             if bgn:
                 pass
             else:
@@ -200,11 +481,11 @@ def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold):
 
         if bgn and i > bgn:
             """If onset found, then search offset"""
-            if frame_output[i] <= frame_threshold and not frame_disappear:
+            if current <= frame_threshold and not frame_disappear:
                 """Frame disappear detected"""
                 frame_disappear = i
 
-            if offset_output[i] == 1 and not offset_occur:
+            if offset_output[j] == 1 and not offset_occur:
                 """Offset detected"""
                 offset_occur = i
 
@@ -219,7 +500,14 @@ def onsets_frames_pedal_detection(frame_output, offset_output, frame_threshold):
                 output_tuples.append([bgn, fin])
                 bgn, frame_disappear, offset_occur = None, None, None
 
+    if frame_output.shape[0] > 0:
+        previous = frame_output[-1]
+
+    state.update({'bgn': bgn, 'frame_disappear': frame_disappear, 
+        'offset_occur': offset_occur, 'previous': previous, 
+        'frame_bgn': state['frame_bgn'] + frame_output.shape[0]})
+
     # Sort pairs by onsets
     output_tuples.sort(key=lambda pair: pair[0])
 
-    return output_tuples
\ No newline at end of file
+    return output_tuples
@@ -2,17 +2,19 @@ import os
 import sys
 sys.path.insert(1, os.path.join(sys.path[0], '../utils'))
 import numpy as np
+import json
+import struct
 import time
-import librosa
 import torch
 import torch.nn as nn
 
 from utilities import pad_truncate_sequence
+import config
 
 
 def move_data_to_device(x, device):
     if 'float' in str(x.dtype):
-        x = torch.Tensor(x)
+        x = torch.Tensor(np.ascontiguousarray(x))
     elif 'int' in str(x.dtype):
         x = torch.LongTensor(x)
     else:
@@ -21,6 +23,14 @@ def move_data_to_device(x, device):
     return x.to(device)
 
 
+def get_model_device(model):
+    """Device of a model. Frozen TorchScript models have no parameters and 
+    run on CPU."""
+    for parameter in model.parameters():
+        return parameter.device
+    return torch.device('cpu')
+
+
 def append_to_dict(dict, key, value):
     
     if key in dict.keys():
@@ -76,41 +86,213 @@ def forward_dataloader(model, dataloader, batch_size, return_target=True):
     return output_dict
 
 
-def forward(model, x, batch_size):
-    """Forward data to model in mini-batch. 
-    
+def forward_batches(model, x, batch_size, indexes=None, **kwargs):
+    """Forward data to model in mini-batch, yielding the output of each 
+    mini-batch so that callers can consume it without keeping all outputs.
+
     Args: 
       model: object
       x: (N, segment_samples)
       batch_size: int
+      indexes: (M,) | None, forward only x[indexes]
+      kwargs: passed to the model, e.g. pedal=True for Note_pedal
 
-    Returns:
-      output_dict: dict, e.g. {
-        'frame_output': (segments_num, frames_num, classes_num),
-        'onset_output': (segments_num, frames_num, classes_num),
+    Yields:
+      batch_output_dict: dict, e.g. {
+        'frame_output': (batch_size, frames_num, classes_num),
+        'onset_output': (batch_size, frames_num, classes_num),
         ...}
     """
-    
-    output_dict = {}
-    device = next(model.parameters()).device
+    device = get_model_device(model)
+
+    if indexes is None:
+        indexes = np.arange(len(x))
     
     pointer = 0
     while True:
-        if pointer >= len(x):
+        if pointer >= len(indexes):
             break
 
-        batch_waveform = move_data_to_device(x[pointer : pointer + batch_size], device)
+        batch_waveform = move_data_to_device(
+            x[indexes[pointer : pointer + batch_size]], device)
         pointer += batch_size
 
         with torch.no_grad():
             model.eval()
-            batch_output_dict = model(batch_waveform)
+            batch_output_dict = model(batch_waveform, **kwargs)
+
+        yield {key: batch_output_dict[key].data.cpu().numpy() 
+            for key in batch_output_dict.keys()}
 
+
+def forward(model, x, batch_size, **kwargs):
+    """Forward data to model in mini-batch. 
+    
+    Args: 
+      model: object
+      x: (N, segment_samples)
+      batch_size: int
+      kwargs: passed to the model
+
+    Returns:
+      output_dict: dict, e.g. {
+        'frame_output': (segments_num, frames_num, classes_num),
+        'onset_output': (segments_num, frames_num, classes_num),
+        ...}
+    """
+    
+    output_dict = {}
+
+    for batch_output_dict in forward_batches(model, x, batch_size, **kwargs):
         for key in batch_output_dict.keys():
-            # if '_list' not in key:
-            append_to_dict(output_dict, key, batch_output_dict[key].data.cpu().numpy())
+            append_to_dict(output_dict, key, batch_output_dict[key])
 
     for key in output_dict.keys():
         output_dict[key] = np.concatenate(output_dict[key], axis=0)
 
-    return output_dict
\ No newline at end of file
+    return output_dict
+
+
+def get_auto_batch_size(segment_samples, segments_num, device, 
+    memory_budget=None):
+    """Pick the largest mini-batch whose activations fit a memory budget.
+
+    The peak activation of a CRNN segment is dominated by the first ConvBlock 
+    of an acoustic branch: 48 channels x frames x mel bins in float32, of which
+    about four buffers are alive at once (conv, batchnorm, pooled output and 
+    the log mel input).
+
+    Args:
+      segment_samples: int
+      segments_num: int, number of segments to be forwarded
+      device: 'cuda' | 'cpu'
+      memory_budget: int | None, bytes. If None, use 80% of free GPU memory or 
+        50% of available RAM.
+
+    Returns:
+      batch_size: int
+    """
+    hop_samples = config.sample_rate // config.frames_per_second
+    segment_frames = segment_samples // hop_samples + 1
+    bytes_per_segment = 4 * segment_frames * config.mel_bins * 48 * 4
+
+    if memory_budget is None:
+        if 'cuda' in str(device) and torch.cuda.is_available():
+            # mem_get_info() is not in older PyTorch, e.g. 1.7, where free 
+            # memory is estimated from the memory not reserved by this process
+            if hasattr(torch.cuda, 'mem_get_info'):
+                (free_bytes, _) = torch.cuda.mem_get_info(device)
+            else:
+                properties = torch.cuda.get_device_properties(device)
+                free_bytes = properties.total_memory - \
+                    torch.cuda.memory_reserved(device)
+            memory_budget = int(free_bytes * 0.8)
+        else:
+            try:
+                memory_budget = int(os.sysconf('SC_AVPHYS_PAGES') * 
+                    os.sysconf('SC_PAGE_SIZE') * 0.5)
+            except (ValueError, OSError, AttributeError):
+                memory_budget = 2 * 1024 ** 3
+
+    batch_size = int(memory_budget // bytes_per_segment)
+    batch_size = max(1, min(batch_size, segments_num))
+
+    return batch_size
+
+
+
+# Element types of the safetensors format
+SAFETENSORS_DTYPES = {
+    'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 
+    'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8, 
+    'U8': np.uint8, 'BOOL': np.bool_}
+
+
+def save_safetensors(state_dict, path):
+    """Write tensors to a flat file in the safetensors layout: an 8 byte 
+    little endian header size, a JSON header with the dtype, shape and byte 
+    range of each tensor, and the raw tensor data. Tensors are ordered by 
+    decreasing element size, so that every tensor is aligned when the file is 
+    memory mapped.
+
+    Args:
+      state_dict: dict, {name: tensor}
+      path: str
+    """
+    names = {np.dtype(dtype).name: code 
+        for (code, dtype) in SAFETENSORS_DTYPES.items()}
+    arrays = {key: np.ascontiguousarray(value.detach().cpu().numpy()) 
+        for (key, value) in state_dict.items()}
+    keys = sorted(arrays.keys(), key=lambda key: -arrays[key].itemsize)
+
+    header = {}
+    offset = 0
+    for key in keys:
+        header[key] = {
+            'dtype': names[arrays[key].dtype.name], 
+            'shape': list(arrays[key].shape), 
+            'data_offsets': [offset, offset + arrays[key].nbytes]}
+        offset += arrays[key].nbytes
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for key in keys:
+            f.write(arrays[key].tobytes())
+
+
+def load_safetensors(path):
+    """Memory map a file written by save_safetensors(). Tensors are copy on 
+    write views of the page cache, so processes that map the same file share 
+    one copy of the weights and nothing is read before it is used.
+
+    Args:
+      path: str
+
+    Returns:
+      state_dict: dict, {name: tensor}
+    """
+    with open(path, 'rb') as f:
+        (header_size,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size)
+    state_dict = {}
+
+    for (key, info) in header.items():
+        if key == '__metadata__':
+            continue
+        (bgn, fin) = info['data_offsets']
+        array = data[bgn : fin].view(SAFETENSORS_DTYPES[info['dtype']])
+        state_dict[key] = torch.from_numpy(array.reshape(info['shape']))
+
+    return state_dict
+
+
+def assign_state_dict(model, state_dict):
+    """Make the tensors of state_dict the parameters and buffers of model, 
+    without copying them as load_state_dict() does.
+
+    Args:
+      model: nn.Module
+      state_dict: dict, {name: tensor}, e.g. from load_safetensors()
+    """
+    for (name, module) in model.named_modules():
+        prefix = name + '.' if name else ''
+
+        # setattr() goes through RNNBase.__setattr__, which also updates the 
+        # flat weights that GRUs run with
+        for key in list(module._parameters.keys()):
+            if module._parameters[key] is not None and prefix + key in state_dict:
+                setattr(module, key, nn.Parameter(state_dict[prefix + key], 
+                    requires_grad=module._parameters[key].requires_grad))
+
+        if isinstance(module, nn.RNNBase) and hasattr(module, '_init_flat_weights'):
+            module._init_flat_weights()
+
+        for key in list(module._buffers.keys()):
+            if module._buffers[key] is not None and prefix + key in state_dict:
+                module._buffers[key] = state_dict[prefix + key]
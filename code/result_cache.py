@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+
+import config
+
+
+def hash_file(path, chunk_bytes=1024 * 1024):
+    """SHA-256 of the content of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_cache_key(audio_path, transcription_config, file_hash=None):
+    """Key of a transcription: the content hash of the audio file and every 
+    setting that affects the result.
+
+    Args:
+      audio_path: str
+      transcription_config: dict, e.g. PianoTranscription.get_config() plus 
+        per-call options
+      file_hash: str | None, hash_file() of audio_path if already computed, 
+        e.g. for the audio cache key
+
+    Returns:
+      key: str
+    """
+    if file_hash is None:
+        file_hash = hash_file(audio_path)
+
+    config_json = json.dumps(transcription_config, sort_keys=True)
+    return hashlib.sha256('{}:{}'.format(file_hash, 
+        config_json).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_bytes=None):
+        """Persistent on-disk cache of transcription results. Each entry is a
+        directory named by its key holding the MIDI file, the note and pedal 
+        events and, if available, the PDF score. The least recently used 
+        entries are evicted when the cache exceeds max_bytes. Hits, misses and
+        the work saved by hits are counted in stats.json.
+
+        Args:
+          cache_dir: str
+          max_bytes: int | None, None for no cap
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        """Look up a transcription and mark it as recently used.
+
+        Args:
+          key: str, from get_cache_key()
+
+        Returns:
+          entry: dict | None, {'midi_path': str, 'pdf_path': str | None, 
+            'est_note_events': list, 'est_pedal_events': list | None}
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        entry_path = os.path.join(entry_dir, 'entry.json')
+
+        with self.lock:
+            if not os.path.isfile(entry_path):
+                self.update_stats(hits=0, misses=1)
+                return None
+
+            with open(entry_path, 'r') as f:
+                entry_dict = json.load(f)
+
+            with open(os.path.join(entry_dir, 'events.json'), 'r') as f:
+                events_dict = json.load(f)
+
+            os.utime(entry_dir)     # Recency for LRU eviction
+            self.update_stats(hits=1, misses=0, 
+                bytes_saved=entry_dict['audio_bytes'], 
+                seconds_saved=entry_dict['compute_seconds'])
+
+        pdf_path = os.path.join(entry_dir, 'transcription.pdf')
+
+        return {
+            'midi_path': os.path.join(entry_dir, 'transcription.mid'), 
+            'pdf_path': pdf_path if os.path.isfile(pdf_path) else None, 
+            'est_note_events': events_dict['est_note_events'], 
+            'est_pedal_events': events_dict['est_pedal_events']}
+
+    def put(self, key, midi_path, est_note_events, est_pedal_events, 
+        pdf_path=None, audio_bytes=0, compute_seconds=0.):
+        """Store a transcription. The entry is written to a temporary 
+        directory and renamed, so readers never see a partial entry.
+
+        Args:
+          key: str
+          midi_path: str
+          est_note_events: NoteEvents | list of dict
+          est_pedal_events: PedalEvents | list of dict | None
+          pdf_path: str | None
+          audio_bytes: int, size of the audio file, counted as saved on hits
+          compute_seconds: float, time to produce the result, counted as 
+            saved on hits
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, '.tmp-{}-{}-{}'.format(key, 
+            os.getpid(), threading.get_ident()))
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        shutil.copyfile(midi_path, os.path.join(tmp_dir, 'transcription.mid'))
+
+        if pdf_path and os.path.isfile(pdf_path) and os.path.getsize(pdf_path):
+            shutil.copyfile(pdf_path, os.path.join(tmp_dir, 'transcription.pdf'))
+
+        # Columnar events are stored as lists of dicts and numpy scalars in 
+        # events are converted to Python numbers
+        with open(os.path.join(tmp_dir, 'events.json'), 'w') as f:
+            json.dump({'est_note_events': est_note_events, 
+                'est_pedal_events': est_pedal_events}, f, 
+                default=lambda x: x.to_dicts() if hasattr(x, 'to_dicts') else x.item())
+
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+            json.dump({'audio_bytes': audio_bytes, 
+                'compute_seconds': compute_seconds, 
+                'created': time.time()}, f)
+
+        with self.lock:
+            if os.path.exists(entry_dir):
+                shutil.rmtree(tmp_dir)
+            else:
+                os.rename(tmp_dir, entry_dir)
+            self.evict(keep=key)
+
+    def get_entries(self):
+        """Entries as a list of (key, bytes, last used time), least recently 
+        used first."""
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            entry_bytes = sum(os.path.getsize(os.path.join(entry_dir, name)) 
+                for name in os.listdir(entry_dir))
+            entries.append((key, entry_bytes, os.path.getmtime(entry_dir)))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes.
+
+        Args:
+          keep: str | None, key that must not be removed
+        """
+        if self.max_bytes is None:
+            return
+
+        with self.lock:
+            entries = self.get_entries()
+            total_bytes = sum(entry[1] for entry in entries)
+
+            for (key, entry_bytes, _) in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if key != keep:
+                    shutil.rmtree(os.path.join(self.cache_dir, key), 
+                        ignore_errors=True)
+                    total_bytes -= entry_bytes
+                    self.update_stats(hits=0, misses=0, evictions=1)
+
+    def update_stats(self, hits, misses, bytes_saved=0, seconds_saved=0., 
+        evictions=0):
+        with self.lock:
+            stats = self.read_stats()
+            stats['hits'] += hits
+            stats['misses'] += misses
+            stats['bytes_saved'] += bytes_saved
+            stats['seconds_saved'] += seconds_saved
+            stats['evictions'] += evictions
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            stats_path = os.path.join(self.cache_dir, 'stats.json')
+            with open(stats_path + '.tmp', 'w') as f:
+                json.dump(stats, f)
+            os.replace(stats_path + '.tmp', stats_path)
+
+    def read_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'seconds_saved': 0., 
+            'evictions': 0}
+        stats_path = os.path.join(self.cache_dir, 'stats.json')
+
+        if os.path.isfile(stats_path):
+            with open(stats_path, 'r') as f:
+                stats.update(json.load(f))
+
+        return stats
+
+    def get_stats(self):
+        """Hit rate and savings since the cache was created.
+
+        Returns:
+          stats: dict, {'hits':, 'misses':, 'hit_rate':, 'bytes_saved':, 
+            'seconds_saved':, 'evictions':, 'entries':, 'bytes':}
+        """
+        with self.lock:
+            stats = self.read_stats()
+            entries = self.get_entries()
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(entry[1] for entry in entries)
+        return stats
+
+    def clear(self):
+        """Remove all entries and statistics."""
+        with self.lock:
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+
+
+result_cache = ResultCache(config.result_cache_dir, 
+    max_bytes=config.result_cache_max_bytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    subparsers.add_parser('stats')
+    subparsers.add_parser('clear')
+
+    args = parser.parse_args()
+
+    if args.mode == 'stats':
+        stats = result_cache.get_stats()
+        print('Cache: {}, {} entries, {:.1f} MB'.format(result_cache.cache_dir, 
+            stats['entries'], stats['bytes'] / 1e6))
+        print('Hits: {}, misses: {}, hit rate: {:.1%}'.format(stats['hits'], 
+            stats['misses'], stats['hit_rate']))
+        print('Saved: {:.1f} MB of audio, {:.1f} s of transcription, {} evictions'.format(
+            stats['bytes_saved'] / 1e6, stats['seconds_saved'], stats['evictions']))
+
+    elif args.mode == 'clear':
+        result_cache.clear()
+        print('Cleared {}'.format(result_cache.cache_dir))
+
+    else:
+        raise Exception('Incorrect argument!')
@@ -1,18 +1,29 @@
 from PySide6.QtCore import QObject, Signal
 import librosa
-from piano_transcription_inference import PianoTranscription, sample_rate, load_audio
+from inference import PianoTranscription
+from result_cache import result_cache, get_cache_key, hash_file
 from generate_pdf import convert_midi_to_pdf
 import tempfile
+import shutil
+import time
 import os
 
 class TranscriptionWorker(QObject):
     finished = Signal()
     transcription_result = Signal(str, str)
 
-    def __init__(self, audio_path, device='cpu', display_callback=None):
+    def __init__(self, audio_path, device='cpu', display_callback=None, 
+        model_type='Note_pedal', checkpoint_path=None, batch_size='auto', 
+        skip_inactive=True, use_cache=True, res_type='kaiser_best'):
         super().__init__()
         self.audio_path = audio_path
         self.device = device
+        self.model_type = model_type
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.skip_inactive = skip_inactive
+        self.use_cache = use_cache
+        self.res_type = res_type
         self.display_callback = display_callback
         self.temp_midi_path = None
         self.temp_pdf_path = None
@@ -20,19 +31,40 @@ class TranscriptionWorker(QObject):
 
     def run(self):
         try:
+            # Initialize the transcriptor, the model is loaded on first use
+            transcriptor = PianoTranscription(self.model_type, 
+                checkpoint_path=self.checkpoint_path, device=self.device, 
+                batch_size=self.batch_size, skip_inactive=self.skip_inactive, 
+                res_type=self.res_type)
+            print("Transcriptor initialized")
+
+            # Serve repeated audio files from the result cache. The file is 
+            # hashed once for the result and the audio cache keys.
+            file_hash = None
+            if self.use_cache:
+                file_hash = hash_file(self.audio_path)
+                cache_key = get_cache_key(self.audio_path, 
+                    transcriptor.get_config(), file_hash=file_hash)
+                entry = result_cache.get(cache_key)
+
+                if entry is not None:
+                    self.serve_cached(entry)
+                    return
+
+            start_time = time.time()
+
             # Load audio
-            (audio, _) = load_audio(self.audio_path, sr=sample_rate, mono=True)
+            audio = transcriptor.load_audio(self.audio_path, 
+                use_cache=self.use_cache, file_hash=file_hash)
             print(f"Audio loaded from {self.audio_path}")
 
-            # Initialize the transcriptor
-            transcriptor = PianoTranscription(device=self.device)
-            print("Transcriptor initialized")
-
             # Use a temporary file to save the MIDI
             with tempfile.NamedTemporaryFile(delete=False, suffix=".mid") as tmp_midi:
                 self.temp_midi_path = tmp_midi.name
-                transcriptor.transcribe(audio=audio, midi_path=self.temp_midi_path)
+                transcribed_dict = transcriptor.transcribe(audio=audio, 
+                    midi_path=self.temp_midi_path)
                 print(f"MIDI file generated at {self.temp_midi_path}")
+                print(f"Skipped segments: {transcribed_dict['skip_ratio']:.1%}")
             
             # Use another temporary file for the PDF output
             with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
@@ -41,6 +73,14 @@ class TranscriptionWorker(QObject):
             # Convert MIDI to PDF
             convert_midi_to_pdf(open(self.temp_midi_path, 'rb').read(), self.temp_pdf_path)
             print(f"PDF generated at {self.temp_pdf_path}")
+
+            if self.use_cache:
+                result_cache.put(cache_key, self.temp_midi_path, 
+                    transcribed_dict['est_note_events'], 
+                    transcribed_dict['est_pedal_events'], 
+                    pdf_path=self.temp_pdf_path, 
+                    audio_bytes=os.path.getsize(self.audio_path), 
+                    compute_seconds=time.time() - start_time)
             
             # Callback to display the PDF
             if self.display_callback:
@@ -53,4 +93,28 @@ class TranscriptionWorker(QObject):
             print(f"An error occurred: {str(e)}")
 
         finally:
-            self.finished.emit()
\ No newline at end of file
+            self.finished.emit()
+
+    def serve_cached(self, entry):
+        """Emit a cached transcription. Files are copied to temporary files, 
+        which the window may delete, so that the cache entry stays intact."""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".mid") as tmp_midi:
+            self.temp_midi_path = tmp_midi.name
+        shutil.copyfile(entry['midi_path'], self.temp_midi_path)
+
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
+            self.temp_pdf_path = tmp_pdf.name
+
+        if entry['pdf_path']:
+            shutil.copyfile(entry['pdf_path'], self.temp_pdf_path)
+        else:
+            convert_midi_to_pdf(open(self.temp_midi_path, 'rb').read(), self.temp_pdf_path)
+
+        stats = result_cache.get_stats()
+        print(f"Served from cache, hit rate {stats['hit_rate']:.1%}, "
+            f"{stats['bytes_saved'] / 1e6:.1f} MB of audio not transcribed")
+
+        if self.display_callback:
+            self.display_callback(self.temp_pdf_path)
+
+        self.transcription_result.emit(self.temp_midi_path, self.temp_pdf_path)
\ No newline at end of file
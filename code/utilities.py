@@ -1,19 +1,23 @@
 import os
 import logging
-import h5py
-import soundfile
-import librosa
 import audioread
 import numpy as np
-import pandas as pd
 import csv
 import datetime
 import collections
 import pickle
-from mido import MidiFile
-
-from piano_vad import (note_detection_with_onset_offset_regress, 
-    pedal_detection_with_onset_offset_regress, onsets_frames_note_detection, onsets_frames_pedal_detection)
+import math
+import struct
+import functools
+import contextlib
+import subprocess
+
+# librosa, mido and matplotlib are imported by the functions that use them, so 
+# that importing the inference path stays fast
+from piano_vad import (note_detection_with_onset_offset_regress_all_keys, 
+    pedal_detection_with_onset_offset_regress_compiled, 
+    get_note_detection_state, get_pedal_detection_state, 
+    onsets_frames_note_detection, onsets_frames_pedal_detection)
 import config
 
 
@@ -141,6 +145,7 @@ def read_midi(midi_path):
             ...],
         'midi_event_time': [0., 0, 0.98307292, ...]}
     """
+    from mido import MidiFile
 
     midi_file = MidiFile(midi_path)
     ticks_per_beat = midi_file.ticks_per_beat
@@ -185,6 +190,7 @@ def read_maps_midi(midi_path):
             ...],
         'midi_event_time': [0., 0.53200309, 0.53200309, ...]}
     """
+    from mido import MidiFile
 
     midi_file = MidiFile(midi_path)
     ticks_per_beat = midi_file.ticks_per_beat
@@ -558,15 +564,213 @@ class TargetProcessor(object):
         return output
 
 
+def get_active_segments(segments, sample_rate, energy_threshold=-60., 
+    flatness_threshold=0.4, min_active_seconds=0.1, window_size=2048):
+    """Cheap pre-pass marking segments that may contain music. A frame is 
+    active if it is louder than energy_threshold and tonal, i.e. its spectral 
+    flatness is below flatness_threshold. Silence, room noise and broadband 
+    sounds such as applause are inactive. Talking is not skipped: voiced 
+    speech is tonal, so segments with speech are marked active and go 
+    through the model.
+
+    Args:
+      segments: (N, segment_samples)
+      sample_rate: int
+      energy_threshold: float, dBFS
+      flatness_threshold: float, 0 for a pure tone, about 0.55 for white noise
+      min_active_seconds: float, active duration needed to mark a segment active
+      window_size: int
+
+    Returns:
+      active: (N,), bool
+    """
+    hop_size = window_size // 2
+    window = np.hanning(window_size).astype(np.float32)
+    min_bin = int(np.ceil(30. * window_size / sample_rate))
+    min_active_frames = max(int(min_active_seconds * sample_rate / hop_size), 1)
+    active = np.zeros(len(segments), dtype=bool)
+
+    for n in range(len(segments)):
+        frames = np.lib.stride_tricks.sliding_window_view(
+            segments[n], window_size)[:: hop_size]
+        """(frames_num, window_size)"""
+
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=-1))
+        loud = 20. * np.log10(rms + 1e-10) > energy_threshold
+
+        if np.sum(loud) < min_active_frames:
+            continue
+
+        spectra = np.abs(np.fft.rfft(frames[loud] * window, axis=-1)[:, min_bin :]) ** 2 + 1e-10
+        flatness = np.exp(np.mean(np.log(spectra), axis=-1)) / np.mean(spectra, axis=-1)
+        active[n] = np.sum(flatness < flatness_threshold) >= min_active_frames
+
+    return active
+
+
+def save_activations(output_dict, activations_path, dtype=np.float32):
+    """Save deframed model outputs to a compressed .npz file, so that they can 
+    be post processed again without running the model. Outputs are stored in 
+    float32 by default, so that post processing them gives the same events as 
+    transcribe(). float16 halves the file but rounds neighbouring frames of 
+    regression peaks to equal values, which changes the detected onsets.
+
+    Args:
+      output_dict: dict, {'reg_onset_output': (frames_num, classes_num), ...}
+      activations_path: str
+      dtype: numpy dtype to store outputs in
+    """
+    np.savez_compressed(activations_path, **{key: output_dict[key].astype(dtype) 
+        for key in output_dict.keys()})
+
+
+def load_activations(activations_path):
+    """Load model outputs saved by save_activations().
+
+    Args:
+      activations_path: str
+
+    Returns:
+      output_dict: dict, {'reg_onset_output': (frames_num, classes_num), ...}, 
+        float32
+    """
+    with np.load(activations_path) as data:
+        return {key: data[key].astype(np.float32) for key in data.files}
+
+
+class Events(object):
+    fields = []
+    dtypes = {}
+
+    def __init__(self, **columns):
+        """Columnar events, one array per field, which avoids a Python dict per
+        event. Iterating gives the events as dicts in the format of the 
+        original post processors, so code written for lists of dicts keeps 
+        working.
+
+        Args:
+          columns: (events_num,) per field, missing fields are empty
+        """
+        for field in self.fields:
+            column = columns.pop(field, None)
+            if column is None:
+                column = np.zeros(0, dtype=self.dtypes[field])
+            setattr(self, field, np.asarray(column))
+
+        if columns:
+            raise ValueError('Unknown fields: {}'.format(list(columns.keys())))
+
+        if len(set(len(getattr(self, field)) for field in self.fields)) > 1:
+            raise ValueError('Fields have different lengths.')
+
+    @classmethod
+    def from_dicts(cls, events):
+        """Convert a list of event dicts, returned as is if already columnar.
+
+        Args:
+          events: list of dict | Events | None
+
+        Returns:
+          events: Events
+        """
+        if isinstance(events, cls):
+            return events
+
+        events = list(events or [])
+
+        if len(events) == 0:
+            return cls()
+
+        return cls(**{field: np.array([event[field] for event in events]) 
+            for field in cls.fields})
+
+    @classmethod
+    def concatenate(cls, events_list):
+        """Concatenate a list of Events."""
+        events_list = [cls.from_dicts(events) for events in events_list]
+
+        if len(events_list) == 0:
+            return cls()
+
+        return cls(**{field: np.concatenate([getattr(events, field) for events 
+            in events_list]) for field in cls.fields})
+
+    def __len__(self):
+        return len(getattr(self, self.fields[0]))
+
+    def __getitem__(self, index):
+        """An event dict for an integer index, Events for a slice, mask or 
+        index array."""
+        if isinstance(index, (int, np.integer)):
+            return self.to_dicts(index, index + 1 or None)[0]
+
+        return self.__class__(**{field: getattr(self, field)[index] for field 
+            in self.fields})
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __repr__(self):
+        return '{}({} events)'.format(self.__class__.__name__, len(self))
+
+    def to_dicts(self, bgn=0, fin=None):
+        """Events as a list of dicts, the format of the original post 
+        processors: times are numpy scalars and integer fields are ints.
+
+        Args:
+          bgn: int
+          fin: int | None
+
+        Returns:
+          events: list of dict
+        """
+        columns = []
+        for field in self.fields:
+            column = getattr(self, field)[bgn : fin]
+            if np.issubdtype(column.dtype, np.integer):
+                column = column.tolist()
+            columns.append(column)
+
+        return [dict(zip(self.fields, values)) for values in zip(*columns)]
+
+    def shift(self, seconds):
+        """Events with onset and offset times shifted by seconds."""
+        events = self[:]
+        events.onset_time = self.onset_time + seconds
+        events.offset_time = self.offset_time + seconds
+        return events
+
+    def sort(self):
+        """Events ordered by onset time, events with equal onset times keep 
+        their order."""
+        return self[np.argsort(self.onset_time, kind='stable')]
+
+
+class NoteEvents(Events):
+    """Note events, e.g. NoteEvents(onset_time=[39.74, 11.98], 
+    offset_time=[39.87, 12.11], midi_note=[27, 33], velocity=[83, 88])."""
+    fields = ['onset_time', 'offset_time', 'midi_note', 'velocity']
+    dtypes = {'onset_time': np.float32, 'offset_time': np.float32, 
+        'midi_note': np.int64, 'velocity': np.int64}
+
+
+class PedalEvents(Events):
+    """Sustain pedal events, e.g. PedalEvents(onset_time=[0.17, 1.17], 
+    offset_time=[0.96, 2.65])."""
+    fields = ['onset_time', 'offset_time']
+    dtypes = {'onset_time': np.float32, 'offset_time': np.float32}
+
+
 def write_events_to_midi(start_time, note_events, pedal_events, midi_path):
     """Write out note events to MIDI file.
 
     Args:
       start_time: float
-      note_events: list of dict, e.g. [
+      note_events: NoteEvents | list of dict, e.g. [
         {'midi_note': 51, 'onset_time': 696.63544, 'offset_time': 696.9948, 'velocity': 44}, 
         {'midi_note': 58, 'onset_time': 696.99585, 'offset_time': 697.18646, 'velocity': 50}
         ...]
+      pedal_events: PedalEvents | list of dict | None
       midi_path: str
     """
     from mido import Message, MidiFile, MidiTrack, MetaMessage
@@ -590,40 +794,38 @@ def write_events_to_midi(start_time, note_events, pedal_events, midi_path):
     # Track 1
     track1 = MidiTrack()
     
-    # Message rolls of MIDI
-    message_roll = []
-
-    for note_event in note_events:
-        # Onset
-        message_roll.append({
-            'time': note_event['onset_time'], 
-            'midi_note': note_event['midi_note'], 
-            'velocity': note_event['velocity']})
-
-        # Offset
-        message_roll.append({
-            'time': note_event['offset_time'], 
-            'midi_note': note_event['midi_note'], 
-            'velocity': 0})
-
-    if pedal_events:
-        for pedal_event in pedal_events:
-            message_roll.append({'time': pedal_event['onset_time'], 'control_change': 64, 'value': 127})
-            message_roll.append({'time': pedal_event['offset_time'], 'control_change': 64, 'value': 0})
+    # Message rolls of MIDI as columns: an onset and an offset message per 
+    # note, then a press and a release per pedal
+    note_events = NoteEvents.from_dicts(note_events)
+    pedal_events = PedalEvents.from_dicts(pedal_events)
+
+    times = np.concatenate((
+        np.stack((note_events.onset_time, note_events.offset_time), axis=-1).flatten(), 
+        np.stack((pedal_events.onset_time, pedal_events.offset_time), axis=-1).flatten()))
+    is_notes = np.arange(len(times)) < 2 * len(note_events)
+    values = np.concatenate((
+        np.stack((note_events.velocity, np.zeros_like(note_events.velocity)), axis=-1).flatten(), 
+        np.tile([127, 0], len(pedal_events)))).astype(np.int64)
+    midi_notes = np.concatenate((np.repeat(note_events.midi_note, 2), 
+        np.zeros(2 * len(pedal_events), dtype=np.int64))).astype(np.int64)
+
+    if not np.all(np.isfinite(times)):
+        raise ValueError('Event times must be finite.')
 
     # Sort MIDI messages by time
-    message_roll.sort(key=lambda note_event: note_event['time'])
-
-    previous_ticks = 0
-    for message in message_roll:
-        this_ticks = int((message['time'] - start_time) * ticks_per_second)
-        if this_ticks >= 0:
-            diff_ticks = this_ticks - previous_ticks
-            previous_ticks = this_ticks
-            if 'midi_note' in message.keys():
-                track1.append(Message('note_on', note=message['midi_note'], velocity=message['velocity'], time=diff_ticks))
-            elif 'control_change' in message.keys():
-                track1.append(Message('control_change', channel=0, control=message['control_change'], value=message['value'], time=diff_ticks))
+    order = np.argsort(times, kind='stable')
+
+    ticks = ((times[order] - start_time) * ticks_per_second).astype(np.int64)
+    keep = ticks >= 0
+    order = order[keep]
+    diff_ticks = np.diff(ticks[keep], prepend=0)
+
+    for (is_note, midi_note, value, diff_tick) in zip(is_notes[order].tolist(), 
+        midi_notes[order].tolist(), values[order].tolist(), diff_ticks.tolist()):
+        if is_note:
+            track1.append(Message('note_on', note=midi_note, velocity=value, time=diff_tick))
+        else:
+            track1.append(Message('control_change', channel=0, control=64, value=value, time=diff_tick))
     track1.append(MetaMessage('end_of_track', time=1))
     midi_file.tracks.append(track1)
 
@@ -653,6 +855,7 @@ def plot_waveform_midi_targets(data_dict, start_time, note_events):
         {'midi_note': 58, 'onset_time': 696.99585, 'offset_time': 697.18646, 'velocity': 50}
     """
     import matplotlib.pyplot as plt
+    import librosa
 
     create_folder('debug')
     audio_path = 'debug/debug.wav'
@@ -734,11 +937,11 @@ class RegressionPostProcessor(object):
             'pedal_frame_output': (segment_frames, 1)}
 
         Outputs:
-          est_note_events: list of dict, e.g. [
+          est_note_events: NoteEvents, iterates as a list of dict, e.g. [
             {'onset_time': 39.74, 'offset_time': 39.87, 'midi_note': 27, 'velocity': 83}, 
             {'onset_time': 11.98, 'offset_time': 12.11, 'midi_note': 33, 'velocity': 88}]
 
-          est_pedal_events: list of dict, e.g. [
+          est_pedal_events: PedalEvents | None, iterates as a list of dict, e.g. [
             {'onset_time': 0.17, 'offset_time': 0.96}, 
             {'osnet_time': 1.17, 'offset_time': 2.65}]
         """
@@ -838,7 +1041,56 @@ class RegressionPostProcessor(object):
 
     def get_binarized_output_from_regression(self, reg_output, threshold, neighbour):
         """Calculate binarized output and shifts of onsets or offsets from the
-        regression results.
+        regression results. Peaks are found by comparing shifted copies of 
+        reg_output, which gives the same output as the frame by frame 
+        get_binarized_output_from_regression_loop().
+
+        Args:
+          reg_output: (frames_num, classes_num)
+          threshold: float
+          neighbour: int, >= 1
+
+        Returns:
+          binary_output: (frames_num, classes_num)
+          shift_output: (frames_num, classes_num)
+        """
+        binary_output = np.zeros_like(reg_output)
+        shift_output = np.zeros_like(reg_output)
+        (frames_num, classes_num) = reg_output.shape
+
+        if frames_num <= 2 * neighbour:
+            return binary_output, shift_output
+
+        x = reg_output
+        fin = frames_num - neighbour
+        peak = x[neighbour : fin] > threshold
+
+        # Monotonic neighbours as in is_monotonic_neighbour(), where NaN 
+        # comparisons do not break monotonicity
+        for i in range(neighbour):
+            peak &= ~(x[neighbour - i : fin - i] < x[neighbour - i - 1 : fin - i - 1])
+            peak &= ~(x[neighbour + i : fin + i] < x[neighbour + i + 1 : fin + i + 1])
+
+        (n, k) = np.nonzero(peak)
+        n += neighbour
+        binary_output[n, k] = 1
+
+        """See Section III-D in [1] for deduction.
+        [1] Q. Kong, et al., High-resolution Piano Transcription 
+        with Pedals by Regressing Onsets and Offsets Times, 2020."""
+        (x_prev, x_cur, x_next) = (x[n - 1, k], x[n, k], x[n + 1, k])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift_output[n, k] = np.where(x_prev > x_next, 
+                (x_next - x_prev) / (x_cur - x_next) / 2, 
+                (x_next - x_prev) / (x_cur - x_prev) / 2)
+
+        return binary_output, shift_output
+
+    def get_binarized_output_from_regression_loop(self, reg_output, threshold, 
+        neighbour):
+        """Frame by frame reference of get_binarized_output_from_regression(),
+        used to check that both give the same output.
 
         Args:
           reg_output: (frames_num, classes_num)
@@ -890,7 +1142,7 @@ class RegressionPostProcessor(object):
 
         return monotonic
 
-    def output_dict_to_detected_notes(self, output_dict):
+    def output_dict_to_detected_notes(self, output_dict, state=None, last=True):
         """Postprocess output_dict to piano notes.
 
         Args:
@@ -902,6 +1154,9 @@ class RegressionPostProcessor(object):
             'frame_output': (frames_num, classes_num),
             'onset_output': (frames_num, classes_num),
             ...}
+          state: dict | None, detection state carried between blocks of a 
+            recording, see piano_vad.get_note_detection_state()
+          last: bool, output_dict ends the recording
 
         Returns:
           est_on_off_note_vels: (notes, 4), the four columns are onsets, offsets, 
@@ -910,29 +1165,23 @@ class RegressionPostProcessor(object):
              [11.9824, 12.5000, 33., 0.6892],
              ...]
         """
-        est_tuples = []
-        est_midi_notes = []
-        classes_num = output_dict['frame_output'].shape[-1]
- 
-        for piano_note in range(classes_num):
-            """Detect piano notes"""
-            est_tuples_per_note = note_detection_with_onset_offset_regress(
-                frame_output=output_dict['frame_output'][:, piano_note], 
-                onset_output=output_dict['onset_output'][:, piano_note], 
-                onset_shift_output=output_dict['onset_shift_output'][:, piano_note], 
-                offset_output=output_dict['offset_output'][:, piano_note], 
-                offset_shift_output=output_dict['offset_shift_output'][:, piano_note], 
-                velocity_output=output_dict['velocity_output'][:, piano_note], 
-                frame_threshold=self.frame_threshold)
-            
-            est_tuples += est_tuples_per_note
-            est_midi_notes += [piano_note + self.begin_note] * len(est_tuples_per_note)
+        # Detect piano notes of all keys in one pass
+        (est_tuples, piano_notes) = note_detection_with_onset_offset_regress_all_keys(
+            frame_output=output_dict['frame_output'], 
+            onset_output=output_dict['onset_output'], 
+            onset_shift_output=output_dict['onset_shift_output'], 
+            offset_output=output_dict['offset_output'], 
+            offset_shift_output=output_dict['offset_shift_output'], 
+            velocity_output=output_dict['velocity_output'], 
+            frame_threshold=self.frame_threshold, state=state, last=last)
+
+        if len(est_tuples) == 0:
+            return np.zeros((0, 4), dtype=np.float32)
 
-        est_tuples = np.array(est_tuples)   # (notes, 5)
         """(notes, 5), the five columns are onset, offset, onset_shift, 
         offset_shift and normalized_velocity"""
 
-        est_midi_notes = np.array(est_midi_notes) # (notes,)
+        est_midi_notes = piano_notes + self.begin_note # (notes,)
 
         onset_times = (est_tuples[:, 0] + est_tuples[:, 2]) / self.frames_per_second
         offset_times = (est_tuples[:, 1] + est_tuples[:, 3]) / self.frames_per_second
@@ -945,7 +1194,7 @@ class RegressionPostProcessor(object):
 
         return est_on_off_note_vels
 
-    def output_dict_to_detected_pedals(self, output_dict):
+    def output_dict_to_detected_pedals(self, output_dict, state=None):
         """Postprocess output_dict to piano pedals.
 
         Args:
@@ -954,6 +1203,8 @@ class RegressionPostProcessor(object):
             'pedal_offset_output': (frames_num,),
             'pedal_offset_shift_output': (frames_num,),
             ...}
+          state: dict | None, detection state carried between blocks of a 
+            recording, see piano_vad.get_pedal_detection_state()
 
         Returns:
           est_on_off: (notes, 2), the two columns are pedal onsets and pedal
@@ -962,13 +1213,11 @@ class RegressionPostProcessor(object):
                [1.1400, 2.6458],
                ...]
         """
-        frames_num = output_dict['pedal_frame_output'].shape[0]
-        
-        est_tuples = pedal_detection_with_onset_offset_regress(
+        est_tuples = pedal_detection_with_onset_offset_regress_compiled(
             frame_output=output_dict['pedal_frame_output'][:, 0], 
             offset_output=output_dict['pedal_offset_output'][:, 0], 
             offset_shift_output=output_dict['pedal_offset_shift_output'][:, 0], 
-            frame_threshold=0.5)
+            frame_threshold=0.5, state=state)
 
         est_tuples = np.array(est_tuples)
         """(notes, 2), the two columns are pedal onsets and pedal offsets"""
@@ -994,18 +1243,18 @@ class RegressionPostProcessor(object):
              ...]
         
         Returns:
-          midi_events, list, e.g.,
+          midi_events: NoteEvents, which iterates as a list of dict, e.g.,
             [{'onset_time': 39.7376, 'offset_time': 39.75, 'midi_note': 27, 'velocity': 84},
              {'onset_time': 11.9824, 'offset_time': 12.50, 'midi_note': 33, 'velocity': 88},
              ...]
         """
-        midi_events = []
-        for i in range(est_on_off_note_vels.shape[0]):
-            midi_events.append({
-                'onset_time': est_on_off_note_vels[i][0], 
-                'offset_time': est_on_off_note_vels[i][1], 
-                'midi_note': int(est_on_off_note_vels[i][2]), 
-                'velocity': int(est_on_off_note_vels[i][3] * self.velocity_scale)})
+        est_on_off_note_vels = np.asarray(est_on_off_note_vels).reshape(-1, 4)
+
+        midi_events = NoteEvents(
+            onset_time=est_on_off_note_vels[:, 0], 
+            offset_time=est_on_off_note_vels[:, 1], 
+            midi_note=est_on_off_note_vels[:, 2].astype(np.int64), 
+            velocity=(est_on_off_note_vels[:, 3] * self.velocity_scale).astype(np.int64))
 
         return midi_events
 
@@ -1020,20 +1269,168 @@ class RegressionPostProcessor(object):
              ...]
 
         Returns:
-          pedal_events: list of dict, e.g.,
+          pedal_events: PedalEvents, which iterates as a list of dict, e.g.,
             [{'onset_time': 0.1800, 'offset_time': 0.9669}, 
              {'onset_time': 1.1400, 'offset_time': 2.6458},
              ...]
         """
-        pedal_events = []
-        for i in range(len(pedal_on_offs)):
-            pedal_events.append({
-                'onset_time': pedal_on_offs[i, 0], 
-                'offset_time': pedal_on_offs[i, 1]})
+        pedal_on_offs = np.asarray(pedal_on_offs).reshape(-1, 2)
+
+        pedal_events = PedalEvents(onset_time=pedal_on_offs[:, 0], 
+            offset_time=pedal_on_offs[:, 1])
         
         return pedal_events
 
 
+class IncrementalRegressionPostProcessor(RegressionPostProcessor):
+    def __init__(self, frames_per_second, classes_num, onset_threshold, 
+        offset_threshold, frame_threshold, pedal_offset_threshold):
+        """Post process model outputs block by block as they are produced, 
+        e.g. by PianoTranscription.stream_frames(). The detection state of 
+        every key and the frames needed by peak picking are carried between 
+        blocks, so a note is emitted by the block in which it ends and the 
+        events of a recording are the same as those of 
+        RegressionPostProcessor.output_dict_to_midi_events() on the whole 
+        recording. Memory does not depend on the duration of the recording.
+
+        Args: same as RegressionPostProcessor
+        """
+        super(IncrementalRegressionPostProcessor, self).__init__(
+            frames_per_second, classes_num, onset_threshold, offset_threshold, 
+            frame_threshold, pedal_offset_threshold)
+
+        # Peak picking of frame n looks at frames n - 4 to n + 4
+        self.context_frames = 4
+        self.reset()
+
+    def reset(self):
+        """Start a new recording."""
+        self.window_dict = None
+        self.window_bgn = 0     # Global index of the first frame in window_dict
+        self.detect_bgn = 0     # Global index of the first frame not yet detected
+        self.note_state = get_note_detection_state(self.classes_num)
+        self.pedal_state = get_pedal_detection_state()
+
+    def process(self, frames_dict):
+        """Append a block of model outputs and return the events that ended 
+        in frames with enough context to be final.
+
+        Args:
+          frames_dict: dict, {
+            'reg_onset_output': (block_frames, classes_num), 
+            'reg_offset_output': (block_frames, classes_num), 
+            'frame_output': (block_frames, classes_num), 
+            'velocity_output': (block_frames, classes_num), 
+            'reg_pedal_offset_output': (block_frames, 1), 
+            'pedal_frame_output': (block_frames, 1), 
+            ...}
+
+        Returns:
+          est_note_events: NoteEvents, same as output_dict_to_midi_events()
+          est_pedal_events: PedalEvents | None, None without pedal outputs
+        """
+        if self.window_dict is None:
+            self.window_dict = {key: frames_dict[key] for key in 
+                frames_dict.keys()}
+        else:
+            for key in self.window_dict.keys():
+                self.window_dict[key] = np.concatenate(
+                    (self.window_dict[key], frames_dict[key]), axis=0)
+
+        window_fin = self.window_bgn + len(self.window_dict['frame_output'])
+
+        return self.detect(window_fin - self.context_frames, last=False)
+
+    def flush(self):
+        """Detect the remaining frames at the end of the recording and reset.
+
+        Returns:
+          est_note_events: NoteEvents
+          est_pedal_events: PedalEvents | None
+        """
+        if self.window_dict is None:
+            return NoteEvents(), None
+
+        window_fin = self.window_bgn + len(self.window_dict['frame_output'])
+        events = self.detect(window_fin, last=True)
+        self.reset()
+
+        return events
+
+    def detect(self, detect_fin, last):
+        """Detect events in frames [self.detect_bgn, detect_fin) of the window 
+        and drop frames that are no longer needed as context.
+
+        Args:
+          detect_fin: int, global frame index
+          last: bool, detect_fin ends the recording
+
+        Returns:
+          est_note_events: NoteEvents
+          est_pedal_events: PedalEvents | None
+        """
+        has_pedal = 'reg_pedal_onset_output' in self.window_dict.keys()
+
+        if detect_fin <= self.detect_bgn:
+            return NoteEvents(), (PedalEvents() if has_pedal else None)
+
+        # Binarize the window, frames up to detect_fin see all their neighbours
+        (onset_output, onset_shift_output) = \
+            self.get_binarized_output_from_regression(
+                reg_output=self.window_dict['reg_onset_output'], 
+                threshold=self.onset_threshold, neighbour=2)
+
+        (offset_output, offset_shift_output) = \
+            self.get_binarized_output_from_regression(
+                reg_output=self.window_dict['reg_offset_output'], 
+                threshold=self.offset_threshold, neighbour=4)
+
+        bgn = self.detect_bgn - self.window_bgn
+        fin = detect_fin - self.window_bgn
+
+        block_dict = {
+            'frame_output': self.window_dict['frame_output'][bgn : fin], 
+            'velocity_output': self.window_dict['velocity_output'][bgn : fin], 
+            'onset_output': onset_output[bgn : fin], 
+            'onset_shift_output': onset_shift_output[bgn : fin], 
+            'offset_output': offset_output[bgn : fin], 
+            'offset_shift_output': offset_shift_output[bgn : fin]}
+
+        est_on_off_note_vels = self.output_dict_to_detected_notes(block_dict, 
+            state=self.note_state, last=last)
+        est_note_events = self.detected_notes_to_events(est_on_off_note_vels)
+
+        if has_pedal:
+            (pedal_offset_output, pedal_offset_shift_output) = \
+                self.get_binarized_output_from_regression(
+                    reg_output=self.window_dict['reg_pedal_offset_output'], 
+                    threshold=self.pedal_offset_threshold, neighbour=4)
+
+            block_dict['pedal_frame_output'] = \
+                self.window_dict['pedal_frame_output'][bgn : fin]
+            block_dict['pedal_offset_output'] = pedal_offset_output[bgn : fin]
+            block_dict['pedal_offset_shift_output'] = \
+                pedal_offset_shift_output[bgn : fin]
+
+            est_pedal_on_offs = self.output_dict_to_detected_pedals(block_dict, 
+                state=self.pedal_state)
+            est_pedal_events = self.detected_pedals_to_events(est_pedal_on_offs)
+
+        else:
+            est_pedal_events = None
+
+        # Keep the left context of the next frame to detect
+        trim = fin - self.context_frames
+        if trim > 0:
+            for key in self.window_dict.keys():
+                self.window_dict[key] = self.window_dict[key][trim :]
+            self.window_bgn += trim
+
+        self.detect_bgn = detect_fin
+
+        return est_note_events, est_pedal_events
+
+
 class OnsetsFramesPostProcessor(object):
     def __init__(self, frames_per_second, classes_num):
         """Postprocess the Googl's onsets and frames system output. Only used
@@ -1066,11 +1463,11 @@ class OnsetsFramesPostProcessor(object):
             'pedal_frame_output': (segment_frames, 1)}
 
         Outputs:
-          est_note_events: list of dict, e.g. [
+          est_note_events: NoteEvents, iterates as a list of dict, e.g. [
             {'onset_time': 39.74, 'offset_time': 39.87, 'midi_note': 27, 'velocity': 83}, 
             {'onset_time': 11.98, 'offset_time': 12.11, 'midi_note': 33, 'velocity': 88}]
 
-          est_pedal_events: list of dict, e.g. [
+          est_pedal_events: PedalEvents | None, iterates as a list of dict, e.g. [
             {'onset_time': 0.17, 'offset_time': 0.96}, 
             {'osnet_time': 1.17, 'offset_time': 2.65}]
         """
@@ -1246,7 +1643,7 @@ class OnsetsFramesPostProcessor(object):
 
             return est_on_off_note_vels
 
-    def output_dict_to_detected_pedals(self, output_dict):
+    def output_dict_to_detected_pedals(self, output_dict, state=None):
         """Postprocess output_dict to piano pedals.
 
         Args:
@@ -1255,6 +1652,8 @@ class OnsetsFramesPostProcessor(object):
             'pedal_offset_output': (frames_num,),
             'pedal_offset_shift_output': (frames_num,),
             ...}
+          state: dict | None, detection state carried between blocks of a 
+            recording, see piano_vad.get_onsets_frames_pedal_detection_state()
 
         Returns:
           est_on_off: (notes, 2), the two columns are pedal onsets and pedal
@@ -1269,7 +1668,7 @@ class OnsetsFramesPostProcessor(object):
         est_tuples = onsets_frames_pedal_detection(
             frame_output=output_dict['pedal_frame_output'][:, 0], 
             offset_output=output_dict['reg_pedal_offset_output'][:, 0], 
-            frame_threshold=0.5)
+            frame_threshold=0.5, state=state)
 
         est_tuples = np.array(est_tuples)
         """(notes, 2), the two columns are pedal onsets and pedal offsets"""
@@ -1295,18 +1694,18 @@ class OnsetsFramesPostProcessor(object):
              ...]
         
         Returns:
-          midi_events, list, e.g.,
+          midi_events: NoteEvents, which iterates as a list of dict, e.g.,
             [{'onset_time': 39.7376, 'offset_time': 39.75, 'midi_note': 27, 'velocity': 84},
              {'onset_time': 11.9824, 'offset_time': 12.50, 'midi_note': 33, 'velocity': 88},
              ...]
         """
-        midi_events = []
-        for i in range(len(est_on_off_note_vels)):
-            midi_events.append({
-                'onset_time': est_on_off_note_vels[i][0], 
-                'offset_time': est_on_off_note_vels[i][1], 
-                'midi_note': int(est_on_off_note_vels[i][2]), 
-                'velocity': int(est_on_off_note_vels[i][3] * self.velocity_scale)})
+        est_on_off_note_vels = np.asarray(est_on_off_note_vels).reshape(-1, 4)
+
+        midi_events = NoteEvents(
+            onset_time=est_on_off_note_vels[:, 0], 
+            offset_time=est_on_off_note_vels[:, 1], 
+            midi_note=est_on_off_note_vels[:, 2].astype(np.int64), 
+            velocity=(est_on_off_note_vels[:, 3] * self.velocity_scale).astype(np.int64))
 
         return midi_events
 
@@ -1321,16 +1720,15 @@ class OnsetsFramesPostProcessor(object):
              ...]
 
         Returns:
-          pedal_events: list of dict, e.g.,
+          pedal_events: PedalEvents, which iterates as a list of dict, e.g.,
             [{'onset_time': 0.1800, 'offset_time': 0.9669}, 
              {'onset_time': 1.1400, 'offset_time': 2.6458},
              ...]
         """
-        pedal_events = []
-        for i in range(len(pedal_on_offs)):
-            pedal_events.append({
-                'onset_time': pedal_on_offs[i, 0], 
-                'offset_time': pedal_on_offs[i, 1]})
+        pedal_on_offs = np.asarray(pedal_on_offs).reshape(-1, 2)
+
+        pedal_events = PedalEvents(onset_time=pedal_on_offs[:, 0], 
+            offset_time=pedal_on_offs[:, 1])
         
         return pedal_events
 
@@ -1370,18 +1768,214 @@ class StatisticsContainer(object):
         self.statistics_dict = resume_statistics_dict
 
 
+def resample(y, orig_sr, target_sr, res_type='kaiser_best'):
+    """Resample audio along the last axis.
+
+    Args:
+      y: (..., samples)
+      orig_sr: int
+      target_sr: int
+      res_type: str, 'polyphase' runs scipy.signal.resample_poly() with the 
+        reduced ratio of the sample rates, e.g. 160/441 for 44.1 kHz to 16 kHz,
+        which is the same filter as StreamResampler. Other types, e.g. 
+        'kaiser_best' or 'kaiser_fast', are passed to librosa.resample().
+
+    Returns:
+      y: (..., resampled_samples)
+    """
+    if orig_sr == target_sr:
+        return y
+
+    if res_type == 'polyphase':
+        from scipy.signal import resample_poly
+
+        g = math.gcd(int(orig_sr), int(target_sr))
+        return resample_poly(y, int(target_sr) // g, int(orig_sr) // g, axis=-1)
+
+    import librosa
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr, 
+        res_type=res_type)
+
+
+# Uncompressed and lossless formats that libsndfile decodes in process
+SOUNDFILE_FORMATS = ['WAV', 'WAVEX', 'RF64', 'W64', 'AIFF', 'CAF', 'FLAC']
+
+
+def get_audio_backend(path):
+    """Decoder of an audio file: 'soundfile' for the formats in 
+    SOUNDFILE_FORMATS, 'ffmpeg' for compressed formats such as MP3 and AAC."""
+    import soundfile
+
+    try:
+        info = soundfile.info(path)
+    except RuntimeError:
+        return 'ffmpeg'
+
+    return 'soundfile' if info.format in SOUNDFILE_FORMATS else 'ffmpeg'
+
+
+def mmap_wav(path, info):
+    """Memory map the samples of a little-endian 16 bit or float WAV file 
+    without decoding it.
+
+    Args:
+      path: str
+      info: soundfile.info() of path
+
+    Returns:
+      x: (frames, channels), int16 | float32, read-only, or None if the file 
+        cannot be mapped
+    """
+    if info.format not in ['WAV', 'WAVEX'] or info.endian not in ['FILE', 'LITTLE']:
+        return None
+
+    dtype = {'PCM_16': np.dtype('<i2'), 'FLOAT': np.dtype('<f4')}.get(info.subtype)
+    if dtype is None:
+        return None
+
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if header[0 : 4] != b'RIFF' or header[8 : 12] != b'WAVE':
+            return None
+
+        # Walk the chunks to the data chunk
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            (chunk_id, chunk_bytes) = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            f.seek(chunk_bytes + chunk_bytes % 2, 1)
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=data_offset, 
+        shape=(info.frames, info.channels))
+
+
+def load_audio_soundfile(path, sr=22050, mono=True, offset=0.0, duration=None, 
+    dtype=np.float32, res_type='kaiser_best'):
+    """Load audio with soundfile, in process. 16 bit and float WAV files are 
+    memory mapped instead of decoded, and a float WAV at the target sample 
+    rate is returned without a copy. Samples are scaled as in load_audio().
+
+    Args: same as load_audio()
+
+    Returns:
+      y: (samples,) if mono, else (channels_num, samples)
+      sr: int
+    """
+    import soundfile
+
+    info = soundfile.info(path)
+    sr_native = info.samplerate
+    start = int(np.round(sr_native * offset))
+    fin = None if duration is None else start + int(np.round(sr_native * duration))
+
+    x = mmap_wav(path, info)
+
+    if x is not None:
+        x = x[start : fin]
+        """(frames, channels)"""
+
+        if x.dtype == np.int16:
+            x = x * np.float32(1. / 32768)
+
+    else:
+        frames = -1 if fin is None else fin - start
+        (x, _) = soundfile.read(path, frames=frames, start=start, 
+            dtype='float32', always_2d=True)
+
+    if info.channels == 1:
+        y = x[:, 0]
+    elif mono:
+        y = np.mean(x, axis=-1, dtype=np.float32)
+    else:
+        y = x.T
+
+    if sr is not None:
+        y = resample(y, sr_native, sr, res_type=res_type)
+    else:
+        sr = sr_native
+
+    # Final cleanup for dtype and contiguity
+    y = np.ascontiguousarray(y, dtype=dtype)
+
+    return (y, sr)
+
+
+class FFmpegSeekAudioFile(audioread.ffdec.FFmpegAudioFile):
+    def __init__(self, filename, offset=0., duration=None, 
+        block_size=audioread.ffdec.DEFAULT_BUFFER_SIZE):
+        """audioread's ffmpeg backend with input seeking. ffmpeg seeks in the 
+        container to offset and stops after duration, so only the requested 
+        part of the file is decoded. The Windows crash dialog handling of the 
+        parent class is left out.
+
+        Args:
+          filename: str
+          offset: float, seconds
+          duration: float | None, seconds, None to decode to the end
+          block_size: int
+        """
+        seek_args = ['-ss', '{:.6f}'.format(offset)]
+        if duration is not None:
+            seek_args += ['-t', '{:.6f}'.format(duration)]
+
+        try:
+            self.proc = audioread.ffdec.popen_multiple(
+                audioread.ffdec.COMMANDS, 
+                seek_args + ['-i', filename, '-f', 's16le', '-'], 
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                stdin=subprocess.DEVNULL, 
+                creationflags=audioread.ffdec.PROC_FLAGS)
+        except OSError:
+            raise audioread.ffdec.NotInstalledError()
+
+        self.stdout_reader = audioread.ffdec.QueueReaderThread(
+            self.proc.stdout, block_size)
+        self.stdout_reader.start()
+        self._get_info()
+        self.stderr_reader = audioread.ffdec.QueueReaderThread(self.proc.stderr)
+        self.stderr_reader.start()
+
+
 def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
-    dtype=np.float32, res_type='kaiser_best', 
-    backends=[audioread.ffdec.FFmpegAudioFile]):
-    """Load audio. Copied from librosa.core.load() except that ffmpeg backend is 
-    always used in this function."""
+    dtype=np.float32, res_type='kaiser_best', backends=None):
+    """Load audio. Copied from librosa.core.load() except that files in 
+    SOUNDFILE_FORMATS are read in process by load_audio_soundfile(), all other
+    files are decoded by ffmpeg, and res_type may also be 'polyphase', see 
+    resample().
+
+    Args:
+      backends: list of audioread backends | None. None picks the backend with
+        get_audio_backend(), a list forces decoding with audioread. The 
+        ffmpeg backend seeks to offset instead of decoding from the start.
+    """
+    import librosa
+
+    if backends is None:
+        if get_audio_backend(path) == 'soundfile':
+            return load_audio_soundfile(path, sr=sr, mono=mono, offset=offset, 
+                duration=duration, dtype=dtype, res_type=res_type)
+
+        backends = [audioread.ffdec.FFmpegAudioFile]
+
+    if offset > 0 or duration is not None:
+        backends = [functools.partial(FFmpegSeekAudioFile, offset=offset, 
+            duration=duration) if backend is audioread.ffdec.FFmpegAudioFile 
+            else backend for backend in backends]
 
     y = []
     with audioread.audio_open(os.path.realpath(path), backends=backends) as input_file:
         sr_native = input_file.samplerate
         n_channels = input_file.channels
 
-        s_start = int(np.round(sr_native * offset)) * n_channels
+        if isinstance(input_file, FFmpegSeekAudioFile):
+            # Decoding starts at offset
+            s_start = 0
+        else:
+            s_start = int(np.round(sr_native * offset)) * n_channels
 
         if duration is None:
             s_end = np.inf
@@ -1392,7 +1986,7 @@ def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
         n = 0
 
         for frame in input_file:
-            frame = librosa.core.audio.util.buf_to_float(frame, dtype=dtype)
+            frame = librosa.util.buf_to_float(frame, dtype=dtype)
             n_prev = n
             n = n + len(frame)
 
@@ -1422,10 +2016,10 @@ def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
         if n_channels > 1:
             y = y.reshape((-1, n_channels)).T
             if mono:
-                y = librosa.core.audio.to_mono(y)
+                y = librosa.to_mono(y)
 
         if sr is not None:
-            y = librosa.core.audio.resample(y, sr_native, sr, res_type=res_type)
+            y = resample(y, sr_native, sr, res_type=res_type)
 
         else:
             sr = sr_native
@@ -1433,4 +2027,263 @@ def load_audio(path, sr=22050, mono=True, offset=0.0, duration=None,
     # Final cleanup for dtype and contiguity
     y = np.ascontiguousarray(y, dtype=dtype)
 
-    return (y, sr)
\ No newline at end of file
+    return (y, sr)
+
+
+class StreamResampler(object):
+    def __init__(self, orig_sr, target_sr, window=('kaiser', 5.0), 
+        dtype=np.float32):
+        """Polyphase resampler of a signal that arrives block by block. The 
+        filter state is carried across blocks, so the concatenated output is 
+        the same as scipy.signal.resample_poly() of the whole signal, which is 
+        librosa's 'polyphase' res_type. Only about one filter length of input 
+        is kept between blocks.
+
+        Args:
+          orig_sr: int
+          target_sr: int
+          window: window of the low pass filter design, as in resample_poly()
+          dtype: numpy dtype of the filter and output
+        """
+        from scipy.signal import firwin
+
+        g = math.gcd(int(orig_sr), int(target_sr))
+        self.up = int(target_sr) // g
+        self.down = int(orig_sr) // g
+        self.dtype = dtype
+
+        self.buffer = None  # Input from sample self.buffer_bgn on
+        self.buffer_bgn = 0
+        self.input_len = 0
+        self.output_len = 0
+
+        if self.up == self.down:
+            return
+
+        # Same low pass filter and delay as resample_poly()
+        max_rate = max(self.up, self.down)
+        half_len = 10 * max_rate
+        h = firwin(2 * half_len + 1, 1. / max_rate, window=window).astype(dtype)
+        h *= self.up
+        n_pre_pad = self.down - half_len % self.down
+        self.h = np.concatenate((np.zeros(n_pre_pad, dtype=dtype), h))
+        self.n_pre_remove = (half_len + n_pre_pad) // self.down
+
+    def process(self, x):
+        """Resample the next block.
+
+        Args:
+          x: (..., block_samples)
+
+        Returns:
+          y: (..., samples), output samples that no later input affects
+        """
+        x = np.asarray(x, dtype=self.dtype)
+
+        if self.up == self.down:
+            self.buffer = x[..., 0 : 0]
+            return x
+
+        if self.buffer is None:
+            self.buffer = x
+        else:
+            self.buffer = np.concatenate((self.buffer, x), axis=-1)
+
+        self.input_len += x.shape[-1]
+
+        # Output j only uses input n <= (j + n_pre_remove) * down / up
+        output_fin = -(-self.input_len * self.up // self.down) - self.n_pre_remove
+        return self._resample(max(output_fin, self.output_len))
+
+    def flush(self):
+        """Resample the end of the signal, zero padded as in resample_poly().
+
+        Returns:
+          y: (..., samples)
+        """
+        if self.buffer is None:
+            return np.zeros(0, dtype=self.dtype)
+
+        if self.up == self.down:
+            return self.buffer
+
+        output_fin = -(-self.input_len * self.up // self.down)
+        pad_width = [(0, 0)] * (self.buffer.ndim - 1) + \
+            [(0, len(self.h) // self.up + 1)]
+        self.buffer = np.pad(self.buffer, pad_width)
+        return self._resample(output_fin)
+
+    def _resample(self, output_fin):
+        """Compute outputs self.output_len to output_fin and drop the input 
+        that later outputs do not use."""
+        from scipy.signal import upfirdn
+
+        # Outputs are aligned to the buffer because buffer_bgn is a multiple 
+        # of down
+        bgn = self.output_len + self.n_pre_remove - \
+            self.buffer_bgn * self.up // self.down
+        fin = bgn + output_fin - self.output_len
+        y = upfirdn(self.h, self.buffer, self.up, self.down, axis=-1)[..., bgn : fin]
+        self.output_len = output_fin
+
+        # Output j uses input n > ((j + n_pre_remove) * down - len(h)) / up
+        input_bgn = ((output_fin + self.n_pre_remove) * self.down - len(self.h)) \
+            // self.up + 1
+        input_bgn = max(input_bgn // self.down * self.down, self.buffer_bgn)
+        self.buffer = self.buffer[..., input_bgn - self.buffer_bgn :]
+        self.buffer_bgn = input_bgn
+
+        return np.ascontiguousarray(y, dtype=self.dtype)
+
+
+def stream_audio(path, sr=22050, mono=True, block_seconds=30., 
+    dtype=np.float32, backends=None):
+    """Load audio block by block. Each decoded buffer is downmixed and fed to a
+    StreamResampler right away, so memory is proportional to block_seconds 
+    instead of the duration of the file. The concatenated blocks are the same 
+    as load_audio(..., res_type='polyphase').
+
+    Args:
+      path: str
+      sr: int | None, target sample rate, None to keep the native rate
+      mono: bool
+      block_seconds: float, duration of each yielded block, the last one may be
+        shorter
+      dtype: numpy dtype
+      backends: list of audioread backends | None. None reads the formats in 
+        SOUNDFILE_FORMATS with soundfile in process and decodes other files 
+        with ffmpeg, see get_audio_backend().
+
+    Yields:
+      y: (block_samples,) if mono, else (channels_num, block_samples)
+    """
+    with contextlib.ExitStack() as stack:
+        if backends is None and get_audio_backend(path) == 'soundfile':
+            import soundfile
+
+            input_file = stack.enter_context(soundfile.SoundFile(path))
+            sr_native = input_file.samplerate
+            n_channels = input_file.channels
+            chunks = (x.T for x in input_file.blocks(
+                blocksize=int(np.round(sr_native * block_seconds)), 
+                dtype='float32', always_2d=True))
+
+        else:
+            input_file = stack.enter_context(audioread.audio_open(
+                os.path.realpath(path), 
+                backends=backends or [audioread.ffdec.FFmpegAudioFile]))
+            sr_native = input_file.samplerate
+            n_channels = input_file.channels
+            chunks = read_audioread_chunks(input_file, dtype)
+
+        resampler = StreamResampler(sr_native, sr or sr_native, dtype=dtype)
+        block_len = int(np.round((sr or sr_native) * block_seconds))
+
+        buffer = []
+        buffer_len = 0
+
+        def _blocks(y, last=False):
+            # Group resampled samples to blocks of block_len
+            nonlocal buffer, buffer_len
+            buffer.append(y)
+            buffer_len += y.shape[-1]
+
+            while buffer_len >= block_len or (last and buffer_len > 0):
+                y = np.concatenate(buffer, axis=-1)
+                yield np.ascontiguousarray(y[..., 0 : block_len])
+                buffer = [y[..., block_len :]]
+                buffer_len = buffer[0].shape[-1]
+
+        for x in chunks:
+            """(channels_num, samples)"""
+
+            if n_channels == 1:
+                y = x[0]
+            elif mono:
+                y = np.mean(x, axis=0, dtype=np.float32)
+            else:
+                y = x
+
+            for block in _blocks(resampler.process(y.astype(dtype, copy=False))):
+                yield block
+
+        for block in _blocks(resampler.flush(), last=True):
+            yield block
+
+
+def read_audioread_chunks(input_file, dtype=np.float32):
+    """Decoded buffers of an open audioread file as float samples. A buffer 
+    may end inside an interleaved frame, whose samples are carried over to 
+    the next buffer.
+
+    Args:
+      input_file: audioread file
+      dtype: numpy dtype
+
+    Yields:
+      x: (channels_num, samples)
+    """
+    import librosa
+
+    n_channels = input_file.channels
+    remainder = np.zeros(0, dtype=dtype)    # Incomplete interleaved frame
+
+    for frame in input_file:
+        frame = np.concatenate((remainder, 
+            librosa.util.buf_to_float(frame, dtype=dtype)))
+        samples_num = len(frame) // n_channels
+        remainder = frame[samples_num * n_channels :]
+
+        yield frame[0 : samples_num * n_channels].reshape((-1, n_channels)).T
+
+
+def prefetch(iterable, max_items=2):
+    """Run an iterator in a background thread, so that producing the next items,
+    e.g. decoding audio blocks, overlaps with consuming the current one.
+
+    Args:
+      iterable: iterable
+      max_items: int, items produced ahead of the consumer
+
+    Yields:
+      items of iterable, in order. Exceptions of the iterator are raised here.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(maxsize=max_items)
+    stop = threading.Event()
+    end = object()
+
+    def _put(item, error=None):
+        # Give up when the consumer has stopped
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    return
+            _put(end)
+        except Exception as e:
+            _put(end, e)
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            (item, error) = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()